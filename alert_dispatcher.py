@@ -0,0 +1,268 @@
+import time
+import queue
+import logging
+import threading
+from collections import deque, namedtuple
+import cv2
+from log_utils import RATE_LIMITED
+
+logger = logging.getLogger(__name__)
+
+# A motion detection event waiting to be emailed, with its images already in memory
+Alert = namedtuple("Alert", ["objects_detected", "event_time", "attachments"])
+
+class AlertDispatcher:
+    """
+    A background worker that emails the alerts, coalescing bursts of events into digests and rate limiting each recipient.
+    """
+
+    def __init__(self, email_alert, digest_window=60.0, rate_limit=10, rate_period=3600.0, max_retries=5,
+                 retry_backoff=5.0, max_attachments=6, image_max_dimension=1280, jpeg_quality=80, composite=False, queue_size=100):
+        """
+        Initializes the alert queue and starts the worker thread.
+
+        Args:
+            email_alert (EmailAlert): The SMTP connection and email formatting.
+            digest_window (float): Minimum seconds between two emails to a recipient, the events in between are sent as one digest.
+            rate_limit (int): Maximum number of emails sent to a recipient within rate_period.
+            rate_period (float): The period of the rate limit in seconds.
+            max_retries (int): How many times a failed email is retried before its alerts are dropped.
+            retry_backoff (float): Seconds before the first retry, doubled on each further retry.
+            max_attachments (int): Maximum number of images attached to a digest.
+            image_max_dimension (int): The longest side of the attached images in pixels, larger images are downscaled.
+            jpeg_quality (int): JPEG quality (0-100) of the attached images.
+            composite (bool): Whether to attach the images side by side as one image instead of separately.
+            queue_size (int): Maximum number of alerts waiting for the worker.
+        """
+        self.email_alert = email_alert
+        self.digest_window = digest_window
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_attachments = max_attachments
+        self.image_max_dimension = image_max_dimension
+        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+        self.composite = composite
+        self.alerts = queue.Queue(maxsize=queue_size)
+
+        # Per-recipient state, only touched by the worker thread
+        self.pending = {recipient: [] for recipient in email_alert.recipients} # Alerts waiting to be sent
+        self.sent_times = {recipient: deque() for recipient in email_alert.recipients} # Send times within the rate period
+        self.last_sent = {recipient: None for recipient in email_alert.recipients} # Time of the last email sent
+        self.retry_at = {recipient: 0.0 for recipient in email_alert.recipients} # Earliest time of the next attempt
+        self.attempts = {recipient: 0 for recipient in email_alert.recipients} # Failed attempts of the pending email
+
+        self.lock = threading.Lock()
+        self.alerts_submitted = 0 # Alerts accepted into the queue
+        self.alerts_rejected = 0 # Alerts refused because the queue was full
+        self.alerts_dropped = 0 # Alerts given up on after the retries
+        self.emails_sent = 0 # Emails sent, including digests
+        self.digests_sent = 0 # Emails that summarised several alerts
+        self.send_failures = 0 # Failed attempts to send an email
+
+        # Start the worker thread
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, objects_detected, event_time, images):
+        """
+        Queues an alert without waiting for the email to be sent.
+        The images are downscaled and encoded in memory here, so the alert never depends on files on disk.
+
+        Args:
+            objects_detected (list): A list of objects detected (e.g., ["person", "dog"]).
+            event_time (datetime): The time the event started.
+            images (list): (name, image) pairs of the images to attach, as numpy arrays.
+
+        Returns:
+            bool: True if the alert was queued, False if the queue was full.
+        """
+        attachments = self.encode_attachments(images)
+
+        try:
+            self.alerts.put_nowait(Alert(objects_detected, event_time, attachments))
+        except queue.Full:
+            with self.lock:
+                self.alerts_rejected += 1
+            logger.warning("Alert queue full, skipped the email", extra=RATE_LIMITED)
+            return False
+
+        with self.lock:
+            self.alerts_submitted += 1
+        return True
+
+    def encode_attachments(self, images):
+        """
+        Downscales the images and encodes them as JPEGs, or as one side-by-side composite.
+
+        Args:
+            images (list): (name, image) pairs of the images to attach.
+
+        Returns:
+            list: (filename, data) pairs of the attachments.
+        """
+        images = [(name, self.downscale(image)) for name, image in images]
+
+        if self.composite and len(images) > 1:
+            # Bring the images to a common height and place them next to each other
+            height = max(image.shape[0] for _, image in images)
+            resized = [image if image.shape[0] == height else cv2.resize(image, (max(1, round(image.shape[1] * height / image.shape[0])), height))
+                       for _, image in images]
+            images = [(f"{images[0][0].rsplit('_', 1)[0]}_composite", cv2.hconcat(resized))]
+
+        return [(f"{name}.jpg", cv2.imencode('.jpg', image, self.encode_params)[1].tobytes()) for name, image in images]
+
+    def downscale(self, image):
+        """
+        Shrinks an image so its longest side fits the maximum dimension, keeping the aspect ratio.
+
+        Args:
+            image (numpy.ndarray): The image.
+
+        Returns:
+            numpy.ndarray: The downscaled image, or the image itself if it already fits.
+        """
+        height, width = image.shape[:2]
+        scale = self.image_max_dimension / max(height, width)
+        if scale >= 1:
+            return image
+        return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+
+    def run(self):
+        """
+        Takes the alerts from the queue and sends the emails as they become due, until the process exits.
+        """
+        while True:
+            # Sleep until the next email is due, waking up early for new alerts
+            timeout = max(0.0, min(self.next_due_time(), time.monotonic() + self.email_alert.keepalive_interval) - time.monotonic())
+            try:
+                alert = self.alerts.get(timeout=timeout)
+                for pending in self.pending.values():
+                    pending.append(alert)
+            except queue.Empty:
+                pass
+
+            self.send_due()
+
+            # Keep the idle connection open, or notice that the server dropped it
+            self.email_alert.keepalive()
+
+    def due_time(self, recipient):
+        """
+        Works out when the next email to a recipient may be sent.
+
+        Args:
+            recipient (str): The email address of the recipient.
+
+        Returns:
+            float: The earliest monotonic time the email may be sent.
+        """
+        now = time.monotonic()
+        due = self.retry_at[recipient]
+
+        # Wait for the digest window to pass since the last email, so bursts are coalesced
+        if self.last_sent[recipient] is not None:
+            due = max(due, self.last_sent[recipient] + self.digest_window)
+
+        # Wait for the oldest email within the rate period to expire once the limit is reached
+        sent_times = self.sent_times[recipient]
+        while sent_times and sent_times[0] <= now - self.rate_period:
+            sent_times.popleft()
+        if len(sent_times) >= self.rate_limit:
+            due = max(due, sent_times[0] + self.rate_period)
+
+        return due
+
+    def next_due_time(self):
+        """
+        Works out when the next email to any recipient is due.
+
+        Returns:
+            float: The earliest monotonic time an email is due, or infinity if nothing is pending.
+        """
+        return min((self.due_time(recipient) for recipient, pending in self.pending.items() if pending), default=float("inf"))
+
+    def send_due(self):
+        """
+        Sends the pending alerts of each recipient whose next email is due, as one email or a digest.
+        """
+        for recipient, pending in self.pending.items():
+            if not pending or time.monotonic() < self.due_time(recipient):
+                continue
+
+            alerts = list(pending)
+            try:
+                self.send_alerts(recipient, alerts)
+            except Exception as error:
+                self.attempts[recipient] += 1
+                with self.lock:
+                    self.send_failures += 1
+
+                if self.attempts[recipient] > self.max_retries:
+                    # Give up on these alerts so the next ones are not held back forever
+                    logger.error("Failed to email recipient=%s dropped=%d error=%s", recipient, len(alerts), error)
+                    with self.lock:
+                        self.alerts_dropped += len(alerts)
+                    del pending[:len(alerts)]
+                    self.attempts[recipient] = 0
+                    self.retry_at[recipient] = 0.0
+                else:
+                    # Back off exponentially before retrying
+                    delay = self.retry_backoff * 2 ** (self.attempts[recipient] - 1)
+                    logger.warning("Failed to email recipient=%s retry_in=%.0fs error=%s", recipient, delay, error)
+                    self.retry_at[recipient] = time.monotonic() + delay
+                continue
+
+            # Only remove the alerts that were sent, others may have arrived in the meantime
+            del pending[:len(alerts)]
+            now = time.monotonic()
+            self.attempts[recipient] = 0
+            self.retry_at[recipient] = 0.0
+            self.last_sent[recipient] = now
+            self.sent_times[recipient].append(now)
+            with self.lock:
+                self.emails_sent += 1
+                self.digests_sent += len(alerts) > 1
+
+    def send_alerts(self, recipient, alerts):
+        """
+        Sends one email for the alerts, with the details of a single event or a digest of several.
+
+        Args:
+            recipient (str): The email address of the recipient.
+            alerts (list): The alerts to send, oldest first.
+        """
+        if len(alerts) == 1:
+            alert = alerts[0]
+            subject, body = self.email_alert.build_motion_detected_email(alert.objects_detected, alert.event_time.strftime("%I:%M:%S %p %d %B %Y"))
+            attachments = alert.attachments
+        else:
+            events = [(alert.event_time.strftime("%I:%M:%S %p %d %B %Y"), alert.objects_detected) for alert in alerts]
+            subject, body = self.email_alert.build_digest_email(events)
+
+            # Attach the first image of the most recent events, within the attachment limit
+            attachments = [alert.attachments[0] for alert in alerts if alert.attachments][-self.max_attachments:]
+
+        message = self.email_alert.build_message(recipient, subject, body, attachments)
+        self.email_alert.send_message(message, [recipient])
+        logger.info("Email sent recipient=%s alerts=%d subject=%s", recipient, len(alerts), subject)
+
+    def stats(self):
+        """
+        Returns the dispatcher counters.
+
+        Returns:
+            dict: Alert and email counts, and the number of alerts waiting.
+        """
+        with self.lock:
+            return {
+                "queue_depth": self.alerts.qsize(),
+                "pending": {recipient: len(pending) for recipient, pending in self.pending.items()},
+                "alerts_submitted": self.alerts_submitted,
+                "alerts_rejected": self.alerts_rejected,
+                "alerts_dropped": self.alerts_dropped,
+                "emails_sent": self.emails_sent,
+                "digests_sent": self.digests_sent,
+                "send_failures": self.send_failures,
+            }
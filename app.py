@@ -1,18 +1,142 @@
 import os
-import cv2
 import config
+import logging
+import threading
+import metrics
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 from config import clips_folder_path
-from video_handler import VideoHandler
-from generate_frames import generate_frames
-from flask import Flask, render_template, request, redirect, jsonify, url_for, Response
+from email_alert import EmailAlert
+from alert_dispatcher import AlertDispatcher
+from clip_catalog import ClipCatalog
+from camera_manager import CameraManager
+from retention_manager import RetentionManager
+from event_processor import EventProcessor
+from inference_service import InferenceService
+from log_utils import configure_logging
+from metrics import Counter, Gauge
+from clip_metadata import delete_clip_metadata, migrate_clip_metadata
+from flask import Flask, render_template, request, redirect, jsonify, url_for, Response, send_from_directory, abort
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Log as timestamped key=value lines, throttling the messages that can repeat on every frame
+configure_logging(config.log_level, config.log_rate_limit_interval)
+logger = logging.getLogger(__name__)
+
+# Camera used by the dashboard and the single-camera routes
+DEFAULT_CAMERA_ID = "default"
+
 app = Flask(__name__)
-video_capture = None
-camera_url = None
+app.config['USE_X_SENDFILE'] = config.use_x_sendfile
+
+# Open the clip catalog
+clip_catalog = ClipCatalog(os.path.join(app.root_path, config.catalog_database_path), os.path.join(app.root_path, clips_folder_path))
+catalog_ready = threading.Event() # Set once the clips already on disk are indexed
+catalog_error = None # The error raised while indexing the clips, if any
+
+# The services shared by all cameras, started by start_services() on the first request rather than on import,
+# so the CLI commands do not load the model, connect to the email server or delete clips
+services_lock = threading.Lock()
+retention_manager = None
+email_alert = None
+alert_dispatcher = None
+inference_service = None
+event_processor = None
+camera_manager = None
+
+def index_clips():
+    """
+    Index the clips already on disk the first time, in the background so the app starts straight away.
+    """
+    global catalog_error
+    try:
+        # A fresh checkout has no clips folder yet
+        os.makedirs(clip_catalog.clips_folder, exist_ok=True)
+        if clip_catalog.is_empty():
+            catalogued = clip_catalog.rebuild()
+            logger.info("Catalogued clips=%d", catalogued)
+        catalog_ready.set()
+    except Exception as error:
+        catalog_error = error
+        logger.error("Failed to index the clips folder=%s error=%s", clip_catalog.clips_folder, error)
+
+def start_services():
+    """
+    Start the background services once: the clip indexing, the retention, the model, the alerts and the event processing.
+    """
+    global retention_manager, email_alert, alert_dispatcher, inference_service, event_processor, camera_manager
+    with services_lock:
+        if camera_manager is not None:
+            return
+
+        threading.Thread(target=index_clips, daemon=True).start()
+
+        # Delete old clips in the background to stay within the storage quotas
+        retention_manager = RetentionManager(clip_catalog, os.path.join(app.root_path, clips_folder_path), config.retention_max_bytes,
+                                             config.retention_max_age_days, config.retention_class_days, config.retention_interval)
+
+        email_alert = EmailAlert(config.smtp_keepalive_interval, config.smtp_timeout)
+        alert_dispatcher = AlertDispatcher(email_alert, config.alert_digest_window, config.alert_rate_limit, config.alert_rate_period,
+                                           config.alert_max_retries, config.alert_retry_backoff, config.alert_max_attachments,
+                                           config.alert_image_max_dimension, config.alert_jpeg_quality, config.alert_composite)
+        inference_service = InferenceService(config.yolo_model_path, config.inference_max_batch, config.inference_max_wait, config.inference_warmup)
+        event_processor = EventProcessor(alert_dispatcher, inference_service, clip_catalog, config.event_workers, config.event_queue_size,
+                                         config.event_queue_timeout, config.tracking_suppress_repeat_alerts)
+        # Set last, the routes only run once it is
+        camera_manager = CameraManager(event_processor, config.max_cameras)
+
+@app.before_request
+def ensure_services_started():
+    """
+    Start the background services on the first request.
+    """
+    start_services()
+
+def camera_values(read):
+    """
+    Read a value from every running camera for the metrics.
+
+    Args:
+        read (callable): Returns the value for a camera.
+
+    Returns:
+        dict: (camera id,) -> value.
+    """
+    return {(camera.camera_id,): read(camera) for camera in camera_manager.list_cameras()}
+
+# Expose the counters and queue depths the services already keep, read when /metrics is scraped
+Gauge("mysentry_camera_fps", "Frame rate measured at the camera", ("camera",), lambda: camera_values(lambda camera: camera.capture_worker.fps))
+Counter("mysentry_frame_buffer_dropped_total", "Frames refused by the frame buffer", ("camera",), lambda: camera_values(lambda camera: camera.frame_buffer.frames_dropped))
+Counter("mysentry_frame_buffer_skipped_total", "Frames skipped by pipeline readers that fell behind", ("camera",), lambda: camera_values(lambda camera: camera.frame_buffer.frames_skipped))
+Counter("mysentry_stream_frames_dropped_total", "Encoded frames dropped because a video feed client was too slow", ("camera",), lambda: camera_values(lambda camera: camera.broadcaster.frames_dropped))
+Gauge("mysentry_motion_detector_active", "Whether the camera's motion detector is fully analysing frames rather than idling", ("camera",),
+      lambda: camera_values(lambda camera: camera.motion_detector.active))
+Gauge("mysentry_tracked_objects", "Distinct objects followed by the camera's tracker", ("camera", "class_name"), lambda: {
+    (camera.camera_id, class_name): count for camera in camera_manager.list_cameras() for class_name, count in camera.object_tracker.stats()["objects"].items()})
+Gauge("mysentry_stream_clients", "Clients watching the video feed", ("camera",), lambda: camera_values(lambda camera: len(camera.broadcaster.subscribers)))
+Gauge("mysentry_event_queue_depth", "Events waiting for post-processing", function=lambda: event_processor.jobs.qsize())
+Counter("mysentry_events_total", "Events by outcome of the post-processing", ("outcome",), lambda: {
+    (outcome,): event_processor.stats()[f"jobs_{outcome}"] for outcome in ("submitted", "rejected", "completed", "failed")})
+Gauge("mysentry_inference_queue_depth", "Images waiting for the model", function=lambda: inference_service.requests.qsize())
+Gauge("mysentry_model_ready", "Whether the model is loaded and warmed up", function=lambda: inference_service.is_ready())
+Gauge("mysentry_alert_queue_depth", "Alerts waiting for the dispatcher", function=lambda: alert_dispatcher.alerts.qsize())
+Counter("mysentry_alerts_total", "Alerts by outcome", ("outcome",), lambda: {
+    (outcome,): alert_dispatcher.stats()[f"alerts_{outcome}"] for outcome in ("submitted", "rejected", "dropped")})
+Counter("mysentry_alerts_suppressed_total", "Alerts skipped because every tracked object was reported by an earlier alert",
+        function=lambda: event_processor.stats()["alerts_suppressed"])
+Counter("mysentry_emails_sent_total", "Emails sent, including digests", function=lambda: alert_dispatcher.stats()["emails_sent"])
+Counter("mysentry_email_failures_total", "Failed attempts to send an email", function=lambda: alert_dispatcher.stats()["send_failures"])
+Gauge("mysentry_clips_bytes", "Disk space used by the clips", function=lambda: clip_catalog.total_size())
+
+def parse_camera_url(camera_url):
+    """
+    Convert the camera URL to an integer if it is a digit (for local webcam ID).
+    """
+    if camera_url.isdigit():
+        return int(camera_url)
+    return camera_url
 
 @app.route('/')
 def index():
@@ -20,76 +144,171 @@ def index():
     Render the main index page.
     This checks if the camera has started and passes the motion detection state to the template.
     """
-    camera_started = video_capture is not None and video_capture.isOpened()
-    return render_template('index.html', camera_started=camera_started, motion_detection_active=config.motion_detection_active)
+    camera = camera_manager.get_camera(DEFAULT_CAMERA_ID)
+    camera_started = camera is not None and camera.is_opened()
+    motion_detection_active = camera.motion_detection_active if camera else config.motion_detection_active
+    return render_template('index.html', camera_started=camera_started, motion_detection_active=motion_detection_active)
 
 @app.route('/start_camera', methods=['POST'])
 def start_camera():
     """
-    Start or switch the camera based on the URL provided by the user.
+    Start or switch the dashboard camera based on the URL provided by the user.
     If a new camera URL is provided, it closes the existing camera (if any)
     and starts capturing from the new one.
     """
-    global video_capture, camera_url
-    new_camera_url = request.form['camera_url']
-
-    # Convert to integer if the URL is a digit (for local webcam ID)
-    if new_camera_url.isdigit():
-        new_camera_url = int(new_camera_url)
-    
-    # Only switch cameras if a different URL is provided
-    if camera_url != new_camera_url:
-        # Close the existing camera if it is open
-        if video_capture and video_capture.isOpened():
-            video_capture.release()
-        
-        # Update the camera URL and start the new camera
-        camera_url = new_camera_url
-        video_capture = cv2.VideoCapture(camera_url)
-    
+    camera_manager.add_camera(DEFAULT_CAMERA_ID, parse_camera_url(request.form['camera_url']))
     return redirect(url_for('index'))
 
 @app.route('/toggle_motion_detection', methods=['POST'])
 def toggle_motion_detection():
     """
-    Toggle the motion detection state between active and inactive.
-    Returns the new state as JSON.
+    Toggle motion detection on the dashboard camera.
     """
-    if config.motion_detection_active:
-        config.motion_detection_active = False
-    else:
-        config.motion_detection_active = True
-
-    return jsonify({"motion_detection_active": config.motion_detection_active}), 200
+    return toggle_camera_motion_detection(DEFAULT_CAMERA_ID)
 
 @app.route('/set_exclusion_zones', methods=['POST'])
 def set_exclusion_zones():
     """
-    Set the exclusion zones for motion detection based on the coordinates received.
+    Set the exclusion zones of the dashboard camera.
     """
-    config.exclusion_zones = request.json.get('zones')
-    return '', 204
+    return set_camera_exclusion_zones(DEFAULT_CAMERA_ID)
 
 @app.route('/clear_exclusion_zones', methods=['POST'])
 def clear_exclusion_zones():
     """
-    Clear all the exclusion zones for motion detection.
+    Clear the exclusion zones of the dashboard camera.
     """
-    config.exclusion_zones = []
-    return '', 204
+    return clear_camera_exclusion_zones(DEFAULT_CAMERA_ID)
 
 @app.route('/video_feed')
 def video_feed():
     """
-    Provide a video feed from the camera if it is started.
+    Provide the video feed of the dashboard camera.
+    """
+    return camera_video_feed(DEFAULT_CAMERA_ID)
+
+@app.route('/cameras', methods=['GET'])
+def list_cameras():
+    """
+    List the running cameras and their counters as JSON.
+    """
+    return jsonify([camera.stats() for camera in camera_manager.list_cameras()]), 200
+
+@app.route('/cameras', methods=['POST'])
+def add_camera():
+    """
+    Start a camera from a form or JSON body with "camera_id" and "camera_url",
+    and optionally a "record_url" to record the clips from without re-encoding.
+    Returns the camera's state as JSON.
+    """
+    data = request.get_json(silent=True) or request.form
+    try:
+        camera = camera_manager.add_camera(data['camera_id'], parse_camera_url(str(data['camera_url'])), data.get('record_url') or None)
+    except KeyError:
+        return "camera_id and camera_url are required", 400
+    except ValueError as error:
+        return str(error), 400
+    except OSError as error:
+        return f"Could not start the camera: {error}", 503
+
+    return jsonify(camera.stats()), 201
+
+@app.route('/cameras/<camera_id>', methods=['GET'])
+def get_camera(camera_id):
+    """
+    Return the state and counters of a camera as JSON.
+    """
+    camera = camera_manager.get_camera(camera_id)
+    if camera is None:
+        return "Camera not found", 404
+    return jsonify(camera.stats()), 200
+
+@app.route('/cameras/<camera_id>/delete', methods=['POST'])
+def remove_camera(camera_id):
+    """
+    Stop and remove a camera.
+    """
+    if not camera_manager.remove_camera(camera_id):
+        return "Camera not found", 404
+    return '', 204
+
+@app.route('/cameras/<camera_id>/toggle_motion_detection', methods=['POST'])
+def toggle_camera_motion_detection(camera_id):
+    """
+    Toggle the motion detection state of a camera between active and inactive.
+    Returns the new state as JSON.
+    """
+    camera = camera_manager.get_camera(camera_id)
+    if camera is None:
+        return "Camera not started", 400
+
+    motion_detection_active = camera.toggle_motion_detection()
+    return jsonify({"motion_detection_active": motion_detection_active}), 200
+
+@app.route('/cameras/<camera_id>/set_exclusion_zones', methods=['POST'])
+def set_camera_exclusion_zones(camera_id):
+    """
+    Set the exclusion zones for motion detection of a camera based on the coordinates received.
+    Zones are rectangles or polygons, scaled from the "width" and "height" of the canvas they were drawn on.
+    Malformed zones, and zones without an area, are refused with a 400.
+    """
+    camera = camera_manager.get_camera(camera_id)
+    if camera is None:
+        return "Camera not started", 400
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return "Expected a JSON object with the zones", 400
+
+    # Without a canvas size the zones are taken to be in video frame coordinates
+    canvas_size = None
+    if data.get('width') is not None or data.get('height') is not None:
+        canvas_size = (data.get('width'), data.get('height'))
+
+    try:
+        camera.set_exclusion_zones(data.get('zones'), canvas_size)
+    except ValueError as error:
+        return str(error), 400
+    return '', 204
+
+@app.route('/cameras/<camera_id>/clear_exclusion_zones', methods=['POST'])
+def clear_camera_exclusion_zones(camera_id):
+    """
+    Clear all the exclusion zones for motion detection of a camera.
+    """
+    camera = camera_manager.get_camera(camera_id)
+    if camera is None:
+        return "Camera not started", 400
+
+    camera.set_exclusion_zones([])
+    return '', 204
+
+@app.route('/cameras/<camera_id>/video_feed')
+def camera_video_feed(camera_id):
+    """
+    Provide a video feed from a camera if it is started.
     Streams the frames to the client using a multipart response.
     """
-    if video_capture and video_capture.isOpened():
-        return Response(generate_frames(video_capture), 
+    camera = camera_manager.get_camera(camera_id)
+    if camera and camera.is_opened():
+        return Response(camera.broadcaster.stream(), 
                         mimetype='multipart/x-mixed-replace; boundary=frame')
     else:
         return "Camera not started", 400
 
+@app.route('/clips/<clip_name>')
+def clip_video(clip_name):
+    """
+    Serve a video clip for playback.
+    Supports range requests for seeking and conditional requests (ETag, Last-Modified) for caching,
+    and lets the WSGI server send the file without copying it through Python.
+    """
+    if not clip_name.endswith('.mp4'):
+        abort(404)
+
+    return send_from_directory(os.path.join(app.root_path, clips_folder_path), clip_name, mimetype='video/mp4',
+                               conditional=True, max_age=config.clip_cache_max_age)
+
 @app.route('/delete/<clip_name>')
 def delete_clip(clip_name):
     """
@@ -100,46 +319,109 @@ def delete_clip(clip_name):
     
     if os.path.exists(clip_path):
         os.remove(clip_path)
+    delete_clip_metadata(clip_path)
+    clip_catalog.remove_clip(clip_name)
     return redirect(url_for('clips'))
 
 @app.route('/delete_all_clips', methods=['POST'])
 def delete_all_clips():
     """
     Delete all video clips in the clips folder.
-    Redirects to the clips page after deletion.
+    The clips are deleted in the background, redirects to the clips page straight away.
+    """
+    retention_manager.delete_all()
+    return redirect(url_for('clips'))
+
+@app.route('/storage')
+def storage():
     """
-    clips_folder = os.path.join(app.root_path, clips_folder_path)
-    clips = [f for f in os.listdir(clips_folder) if f.endswith('.mp4')]
+    Return the storage quotas, the size of the clips and the space reclaimed by the retention as JSON.
+    """
+    return jsonify(retention_manager.stats()), 200
 
-    for clip in clips:
-        clip_path = os.path.join(clips_folder, clip)
-        if os.path.exists(clip_path):
-            os.remove(clip_path)
+@app.route('/ready')
+def ready():
+    """
+    Return whether the background services have finished starting up as JSON.
+    Responds with 503 until the model is loaded and the clips are indexed, the email server is reported but not required.
+    """
+    model = inference_service.stats()
+    status = {
+        "ready": model["ready"] and catalog_ready.is_set(),
+        "model": {key: model[key] for key in ("ready", "load_error", "load_seconds", "warmup_seconds")},
+        "catalog": {"ready": catalog_ready.is_set(), "error": str(catalog_error) if catalog_error else None},
+        "smtp": {"connected": email_alert.server is not None, **alert_dispatcher.stats()},
+    }
+    return jsonify(status), 200 if status["ready"] else 503
 
-    return redirect(url_for('clips'))
+@app.route('/metrics')
+def prometheus_metrics():
+    """
+    Return the pipeline metrics in the Prometheus text format.
+    """
+    return Response(metrics.REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route('/status')
+def status():
+    """
+    Return the state of the cameras and services, with the latency of each pipeline stage, as JSON.
+    """
+    return jsonify({
+        "cameras": [camera.stats() for camera in camera_manager.list_cameras()],
+        "events": event_processor.stats(),
+        "inference": inference_service.stats(),
+        "alerts": alert_dispatcher.stats(),
+        "storage": retention_manager.stats(),
+        "metrics": metrics.REGISTRY.snapshot(),
+    }), 200
 
 @app.route('/clips')
 def clips():
     """
-    Display the available video clips on the clips page.
-    Clips are sorted by creation time in descending order and shown with the metadata.
+    Display the video clips on the clips page, newest first, a page at a time.
+    The clips can be filtered by date range ("start" and "end", as YYYY-MM-DD) and by detected object class ("object").
     """
-    clips_folder = os.path.join(app.root_path, clips_folder_path)
-    clips = [f for f in os.listdir(clips_folder) if f.endswith('.mp4')]
-    
-    # Get the full path for each clip and sort by creation time
-    clips_full_path = [os.path.join(clips_folder, f) for f in clips]
-    clips_sorted = sorted(clips_full_path, key=os.path.getctime, reverse=True)
-
-    # Extract filenames and metadata for the sorted clips
-    formatted_clips = []
-    for clip_path in clips_sorted:
-        clip_name = os.path.basename(clip_path)
-        timestamp = VideoHandler.get_timestamp_from_filename(clip_path)
-        comment = VideoHandler.get_video_metadata(clip_path)
-        formatted_clips.append((clip_name, timestamp, comment))
-
-    return render_template('clips.html', clips=formatted_clips)
+    page = request.args.get('page', 1, type=int)
+    start = request.args.get('start', '')
+    end = request.args.get('end', '')
+    object_class = request.args.get('object', '')
+
+    # Include the whole end day by filtering on the start of the following day
+    try:
+        start_date = datetime.strptime(start, "%Y-%m-%d").isoformat() if start else None
+        end_date = (datetime.strptime(end, "%Y-%m-%d") + timedelta(days=1)).isoformat() if end else None
+    except ValueError:
+        return "Dates must be formatted as YYYY-MM-DD", 400
+
+    clips, total = clip_catalog.query(start_date, end_date, object_class or None, page, config.clips_per_page)
+
+    # Format the start time of each clip for display
+    for clip in clips:
+        clip['timestamp'] = datetime.fromisoformat(clip['start_time']).strftime("%I:%M:%S%p %d %B %Y")
+
+    return render_template('clips.html', clips=clips, page=page, pages=max(1, -(-total // config.clips_per_page)),
+                           total=total, start=start, end=end, object_class=object_class,
+                           object_classes=clip_catalog.object_classes())
+
+@app.cli.command('migrate-metadata')
+def migrate_metadata():
+    """
+    Create metadata sidecars for clips recorded before them, from their ffmpeg comment tags.
+    """
+    migrated = migrate_clip_metadata(os.path.join(app.root_path, clips_folder_path))
+    print(f"Migrated metadata for {migrated} clips")
+
+    # Pick up the migrated objects in the clip catalog
+    catalogued = clip_catalog.rebuild()
+    print(f"Catalogued {catalogued} clips")
+
+@app.cli.command('rebuild-catalog')
+def rebuild_catalog():
+    """
+    Rebuild the clip catalog from the clips and metadata sidecars on disk.
+    """
+    catalogued = clip_catalog.rebuild()
+    print(f"Catalogued {catalogued} clips")
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,373 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import cv2
+import config
+from config import clips_folder_path, thumbnail_width, thumbnail_jpeg_quality
+from clip_catalog import ClipCatalog
+from event_sampler import EventSampler
+from motion_detector import MotionDetector
+from video_handler import VideoHandler
+from inference_service import InferenceService
+from log_utils import configure_logging
+from clip_metadata import get_thumbnail_path, build_clip_metadata, read_clip_metadata, write_clip_metadata
+
+logger = logging.getLogger(__name__)
+
+# Extensions of the video files picked up from folders
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mkv", ".mov", ".ts")
+
+# FourCC codes of streams that can be copied into an mp4 clip without re-encoding
+COPYABLE_FOURCCS = ("avc1", "h264", "x264", "hvc1", "hev1", "hevc")
+
+# The model of a worker process, loaded once by init_worker()
+inference_service = None
+
+def init_worker(model_path):
+    """
+    Loads the model in a worker process. Each process uses a single thread, as the pool already spreads the files over the cores.
+
+    Args:
+        model_path (str): Path to the YOLO weights.
+    """
+    global inference_service
+    os.environ.setdefault("OMP_NUM_THREADS", "1") # Read when the model library is imported by the inference service
+    cv2.setNumThreads(1)
+    inference_service = InferenceService(model_path, config.inference_max_batch, config.inference_max_wait, warmup=False)
+
+def find_events(capture, stride, gap_frames=None, max_frames=None):
+    """
+    Runs motion detection over a video, grouping the motion into events the way the live pipeline does.
+
+    Args:
+        capture (cv2.VideoCapture): The opened video.
+        stride (int): Analyse every stride-th frame, the frames in between are only grabbed.
+        gap_frames (int, optional): Frames without motion that end an event. Without it, the whole video is one event.
+        max_frames (int, optional): Maximum length of an event in frames, longer motion is split.
+
+    Returns:
+        tuple: The number of frames read and the events, as (start frame, end frame, EventSampler of (regions, poster)) tuples.
+    """
+    motion_detector = MotionDetector(config.analysis_width, config.analysis_grayscale)
+    events = []
+    event = None # [start frame, last motion frame, sampler] of the open event
+    index = 0
+
+    while True:
+        # Skipped frames are grabbed without being converted, which is all the decoder needs
+        if index % stride:
+            if not capture.grab():
+                break
+            index += 1
+            continue
+
+        success, frame = capture.read()
+        if not success:
+            break
+
+        motion_boxes = motion_detector.detect_motion(frame)
+
+        # Close the event once the motion has stopped long enough, or it reached the maximum length
+        if event is not None and ((gap_frames is not None and index - event[1] >= gap_frames) or
+                                  (max_frames is not None and index - event[0] >= max_frames)):
+            events.append((event[0], index, event[2]))
+            event = None
+
+        if len(motion_boxes) > 0:
+            if event is None:
+                event = [index, index, EventSampler(config.roi_sample_limit)]
+            event[1] = index
+
+            # Keep the crops for object detection and a small poster of the frame
+            if event[2].offer():
+                frame_height, frame_width = frame.shape[:2]
+                poster = cv2.resize(frame, (thumbnail_width, max(1, round(frame_height * thumbnail_width / frame_width))), interpolation=cv2.INTER_AREA)
+                event[2].add(index, (MotionDetector.crop_regions(frame, motion_boxes, config.roi_padding), poster))
+
+        index += 1
+
+    if event is not None:
+        events.append((event[0], index, event[2]))
+    return index, events
+
+def detect_objects(sampler):
+    """
+    Runs the detector on the crops sampled during an event, in batches.
+
+    Args:
+        sampler (EventSampler): The (regions, poster) samples of the event.
+
+    Returns:
+        list: The Detection tuples of the sampled frame with the most detections, in frame coordinates.
+    """
+    crops = [crop for _, (regions, _) in sampler.samples for _, _, crop in regions]
+    results = iter(inference_service.detect_batch(crops)) if crops else iter(())
+
+    # Move the boxes back to frame coordinates and keep the frame where the most objects were seen
+    best = []
+    for _, (regions, _) in sampler.samples:
+        detections = []
+        for (x, y, _), result in zip(regions, results):
+            for detection in result.detections:
+                x1, y1, x2, y2 = detection.box
+                detections.append(detection._replace(box=(x1 + x, y1 + y, x2 + x, y2 + y)))
+        if len(detections) > len(best):
+            best = detections
+    return best
+
+def reserve_clip_path(clips_folder, start_time, camera_id):
+    """
+    Picks a clip filename no other clip has and creates the file empty, so events starting in the same second,
+    cut by this worker, another worker or the live cameras, never overwrite each other.
+
+    Args:
+        clips_folder (str): Path to the folder the clip is written to.
+        start_time (datetime): The time the clip starts.
+        camera_id (str): The camera the clip is filed under.
+
+    Returns:
+        str: The path of the reserved clip, suffixed with a number if the plain name was taken.
+    """
+    name = f"{start_time.strftime('%Y-%m-%d_%H-%M-%S')}_{camera_id}"
+    suffix = 0
+    while True:
+        clip_path = os.path.join(clips_folder, f"{name}_{suffix}.mp4" if suffix else f"{name}.mp4")
+        try:
+            # Creating the file exclusively claims the name, even against the other worker processes
+            os.close(os.open(clip_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+            return clip_path
+        except FileExistsError:
+            suffix += 1
+
+def cut_clip(path, clip_path, start_seconds, duration, copy):
+    """
+    Cuts an event out of a recording into an mp4 clip.
+
+    Args:
+        path (str): Path to the recording.
+        clip_path (str): Path of the clip to write, reserved by reserve_clip_path() and overwritten.
+        start_seconds (float): Where the clip starts in the recording, in seconds.
+        duration (float): Length of the clip in seconds.
+        copy (bool): Whether to copy the video stream instead of re-encoding it with the recording settings.
+
+    Raises:
+        subprocess.CalledProcessError: If ffmpeg fails.
+    """
+    cmd = ["ffmpeg", "-y", "-loglevel", "error", "-ss", f"{start_seconds:.3f}", "-i", path, "-t", f"{duration:.3f}", "-map", "0:v:0"]
+    if copy:
+        cmd += ["-c", "copy"] # Copying starts the clip at the keyframe before the start
+    else:
+        cmd += ["-c:v", config.recording_codec, "-pix_fmt", "yuv420p"] # Browsers only play H.264 mp4 reliably
+        if config.recording_preset:
+            cmd += ["-preset", config.recording_preset]
+        if config.recording_crf is not None:
+            cmd += ["-crf", str(config.recording_crf)]
+    cmd += ["-movflags", "+faststart", clip_path]
+    try:
+        subprocess.run(cmd, stdin=subprocess.DEVNULL, capture_output=True, check=True)
+    except subprocess.CalledProcessError:
+        # Free the reserved name rather than leaving an empty or partial clip behind
+        if os.path.exists(clip_path):
+            os.remove(clip_path)
+        raise
+
+def process_file(path, retag, options):
+    """
+    Finds the events in a video and the objects in them. Runs in a worker process.
+
+    Args:
+        path (str): Path to the video.
+        retag (bool): True to update the objects of a clip from the clips folder, False to cut the events of a recording into new clips.
+        options (dict): The backfill options: stride, gap, max_duration, camera_id and clips_folder.
+
+    Returns:
+        dict: The number of frames read and the metadata records of the clips tagged or created.
+    """
+    start = time.perf_counter()
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise OSError(f"Could not open {path}")
+
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    fourcc = (int(capture.get(cv2.CAP_PROP_FOURCC)) & 0xFFFFFFFF).to_bytes(4, "little").decode(errors="replace").lower()
+    try:
+        if retag:
+            # A clip is one event, however its motion is spread
+            frames, events = find_events(capture, options["stride"])
+        else:
+            max_frames = round(options["max_duration"] * fps) if options["max_duration"] else None
+            frames, events = find_events(capture, options["stride"], max(1, round(options["gap"] * fps)), max_frames)
+    finally:
+        capture.release()
+
+    clips = []
+    if retag:
+        # Keep what the live pipeline recorded about the clip and replace the objects
+        metadata = read_clip_metadata(path)
+        start_time = datetime.fromisoformat(metadata["start_time"]) if metadata.get("start_time") else VideoHandler.parse_timestamp_from_filename(path)
+        end_time = datetime.fromisoformat(metadata["end_time"]) if metadata.get("end_time") else start_time + timedelta(seconds=frames / fps)
+        detections = max((detect_objects(sampler) for _, _, sampler in events), key=len, default=[])
+        clips.append(build_clip_metadata(path, metadata.get("camera_id"), start_time, end_time, detections, metadata.get("thumbnail")))
+    else:
+        # Date the events from the recording's timestamped filename, or else from when the file was last written
+        try:
+            recording_start = VideoHandler.parse_timestamp_from_filename(path)
+        except ValueError:
+            recording_start = datetime.fromtimestamp(os.path.getmtime(path)) - timedelta(seconds=frames / fps)
+
+        for start_frame, end_frame, sampler in events:
+            # Start the clip before the motion, as the live pre-roll does
+            start_seconds = max(0.0, start_frame / fps - config.pre_roll_seconds)
+            end_seconds = end_frame / fps
+            start_time = recording_start + timedelta(seconds=start_seconds)
+            clip_path = reserve_clip_path(options["clips_folder"], start_time, options["camera_id"])
+
+            cut_clip(path, clip_path, start_seconds, end_seconds - start_seconds, fourcc in COPYABLE_FOURCCS)
+
+            sample = sampler.middle()
+            cv2.imwrite(get_thumbnail_path(clip_path), sample[1][1], [cv2.IMWRITE_JPEG_QUALITY, thumbnail_jpeg_quality])
+
+            clips.append(build_clip_metadata(clip_path, options["camera_id"], start_time, recording_start + timedelta(seconds=end_seconds),
+                                             detect_objects(sampler), os.path.basename(get_thumbnail_path(clip_path))))
+
+    return {"frames": frames, "clips": clips, "seconds": time.perf_counter() - start}
+
+def list_videos(paths):
+    """
+    Expands the input paths into the video files to process.
+
+    Args:
+        paths (list): Video files and folders of video files.
+
+    Returns:
+        list: Absolute paths of the videos.
+    """
+    videos = []
+    for path in paths:
+        if os.path.isdir(path):
+            videos.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if name.lower().endswith(VIDEO_EXTENSIONS))
+        else:
+            videos.append(path)
+    return [os.path.abspath(video) for video in videos]
+
+def load_progress(progress_path):
+    """
+    Reads the files completed by earlier runs.
+
+    Args:
+        progress_path (str): Path to the progress file.
+
+    Returns:
+        dict: Video path -> the size, modification time and settings it was processed with.
+    """
+    try:
+        with open(progress_path) as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_progress(progress_path, progress):
+    """
+    Writes the progress file atomically, so an interruption never leaves it half-written.
+
+    Args:
+        progress_path (str): Path to the progress file.
+        progress (dict): Video path -> the size, modification time and settings it was processed with.
+    """
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(progress_path) or ".", suffix=".tmp")
+    with os.fdopen(handle, "w") as file:
+        json.dump(progress, file)
+    os.replace(temp_path, progress_path)
+
+def main():
+    """
+    Runs motion and object detection over recorded video in a pool of processes, writing the results to the clip metadata and catalog.
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    clips_folder = os.path.join(root, clips_folder_path)
+
+    parser = argparse.ArgumentParser(description="Detect motion and objects in recorded video, re-tagging clips or cutting new clips from recordings.")
+    parser.add_argument("paths", nargs="*", default=[clips_folder],
+                        help="Videos or folders of videos. Clips in the clips folder are re-tagged, other recordings are cut into new clips. Defaults to the clips folder.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes.")
+    parser.add_argument("--stride", type=int, default=2, help="Analyse every stride-th frame.")
+    parser.add_argument("--gap", type=float, default=2.0, help="Seconds without motion that end an event in a recording.")
+    parser.add_argument("--max-duration", type=float, default=20.0, help="Maximum length of a clip cut from a recording, in seconds.")
+    parser.add_argument("--camera-id", default="backfill", help="Camera id given to the clips cut from recordings.")
+    parser.add_argument("--model", default=os.path.join(root, config.yolo_model_path), help="Path to the YOLO weights.")
+    parser.add_argument("--progress", default=os.path.join(root, "instance", "backfill_progress.json"), help="File recording the videos already processed.")
+    parser.add_argument("--restart", action="store_true", help="Process every video again, ignoring the progress file.")
+    parser.add_argument("--log-level", default="INFO", help="Minimum level of the log messages.")
+    args = parser.parse_args()
+
+    configure_logging(args.log_level)
+    os.makedirs(clips_folder, exist_ok=True)
+    os.makedirs(os.path.dirname(args.progress) or ".", exist_ok=True)
+    catalog = ClipCatalog(os.path.join(root, config.catalog_database_path), clips_folder)
+
+    options = {"stride": max(1, args.stride), "gap": args.gap, "max_duration": args.max_duration, "camera_id": args.camera_id, "clips_folder": clips_folder}
+
+    # Videos are processed again when the settings that change the results are tuned
+    settings = dict(options, model=args.model, analysis_width=config.analysis_width, analysis_grayscale=config.analysis_grayscale,
+                    roi_padding=config.roi_padding, roi_sample_limit=config.roi_sample_limit, pre_roll_seconds=config.pre_roll_seconds)
+    fingerprint = hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:12]
+
+    progress = {} if args.restart else load_progress(args.progress)
+    all_videos = list_videos(args.paths)
+    videos = []
+    for video in all_videos:
+        stat = os.stat(video)
+        done = progress.get(video)
+        if done and done["size"] == stat.st_size and done["mtime"] == stat.st_mtime and done["settings"] == fingerprint:
+            continue
+        videos.append((video, stat))
+
+    # Start with the largest files so the pool does not end waiting on one long recording
+    videos.sort(key=lambda item: item[1].st_size, reverse=True)
+    logger.info("Backfilling videos=%d skipped=%d workers=%d", len(videos), len(all_videos) - len(videos), args.workers)
+
+    start = time.perf_counter()
+    frames = 0
+    clips = 0
+    failures = 0
+    with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(args.model,)) as pool:
+        futures = {pool.submit(process_file, video, os.path.dirname(os.path.realpath(video)) == os.path.realpath(clips_folder), options): (video, stat)
+                   for video, stat in videos}
+        try:
+            for future in as_completed(futures):
+                video, stat = futures[future]
+                try:
+                    result = future.result()
+                except Exception as error:
+                    failures += 1
+                    logger.error("Failed to backfill file=%s error=%s", video, error)
+                    continue
+
+                # Store the results, then record the file as done so an interrupted run resumes after it
+                for metadata in result["clips"]:
+                    write_clip_metadata(os.path.join(clips_folder, metadata["clip"]), metadata)
+                    catalog.add_clip(metadata)
+                progress[video] = {"size": stat.st_size, "mtime": stat.st_mtime, "settings": fingerprint, "clips": len(result["clips"])}
+                save_progress(args.progress, progress)
+
+                frames += result["frames"]
+                clips += len(result["clips"])
+                logger.info("Backfilled file=%s frames=%d clips=%d seconds=%.1f", video, result["frames"], len(result["clips"]), result["seconds"])
+        except KeyboardInterrupt:
+            # The files finished so far are in the progress file, the next run picks up the others
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    elapsed = time.perf_counter() - start
+    logger.info("Backfill finished videos=%d frames=%d clips=%d failures=%d seconds=%.1f fps=%.1f",
+                len(videos), frames, clips, failures, elapsed, frames / elapsed if elapsed else 0.0)
+
+if __name__ == '__main__':
+    main()
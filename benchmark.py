@@ -0,0 +1,396 @@
+import os
+import ast
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+import psutil
+import config
+from frame_buffer import DROP_POLICIES
+
+# The values accepted by the settings that choose between code paths, so a mistyped variant fails
+# instead of silently benchmarking the default path
+SETTING_CHOICES = {
+    "object_detection_mode": ("roi", "masked"),
+    "frame_drop_policy": DROP_POLICIES,
+    "recorder_backend": ("ffmpeg", "opencv"),
+    "record_codec": ("h264", "hevc"),
+}
+
+class NullAlertDispatcher:
+    """
+    Counts the alerts instead of emailing them, so the benchmark runs without an SMTP server.
+    """
+
+    def __init__(self):
+        """
+        Initializes the alert count.
+        """
+        self.alerts_submitted = 0
+
+    def submit(self, objects_detected, event_time, images):
+        """
+        Counts an alert.
+
+        Args:
+            objects_detected (list): A list of objects detected (e.g., ["person", "dog"]).
+            event_time (datetime): The time the event started.
+            images (list): (name, image) pairs of the images to attach.
+
+        Returns:
+            bool: Always True.
+        """
+        self.alerts_submitted += 1
+        return True
+
+def synthesize_video(path, width, height, frames, fps=30.0):
+    """
+    Writes a test video of a textured background with a box moving across it during two motion periods.
+
+    Args:
+        path (str): Path of the mp4 file to write.
+        width (int): Width of the frames.
+        height (int): Height of the frames.
+        frames (int): Number of frames.
+        fps (float): Frame rate of the video.
+    """
+    rng = np.random.default_rng(0)
+    background = cv2.GaussianBlur(rng.integers(0, 256, (height, width, 3), dtype=np.uint8), (0, 0), 3)
+    box_width, box_height = max(8, width // 6), max(8, height // 3)
+
+    # Two motion periods separated by a quiet gap longer than the no-motion threshold, so two clips are recorded
+    periods = [(0.15, 0.40), (0.65, 0.80)]
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    for index in range(frames):
+        frame = background.copy()
+
+        # Sensor noise, so the background subtractor has something to ignore
+        cv2.add(frame, rng.integers(0, 8, frame.shape, dtype=np.uint8), dst=frame)
+
+        position = index / frames
+        for start, end in periods:
+            if start <= position < end:
+                x = int((position - start) / (end - start) * (width - box_width))
+                y = (height - box_height) // 2
+                cv2.rectangle(frame, (x, y), (x + box_width, y + box_height), (40, 40, 200), -1)
+
+        writer.write(frame)
+    writer.release()
+
+def parse_value(value):
+    """
+    Converts a setting from the command line to a Python value.
+
+    Args:
+        value (str): The value as typed, e.g. "320", "True", "None" or "roi".
+
+    Returns:
+        The literal value, or the string itself if it is not a literal.
+    """
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+def parse_variant(text):
+    """
+    Parses a configuration variant of the form NAME:KEY=VALUE,KEY=VALUE.
+
+    Args:
+        text (str): The variant, e.g. "masked:object_detection_mode=masked,analysis_width=None".
+
+    Returns:
+        tuple: The variant name and its config settings.
+    """
+    name, _, assignments = text.partition(":")
+    settings = {}
+    for assignment in filter(None, assignments.split(",")):
+        key, _, value = assignment.partition("=")
+        key, value = key.strip(), parse_value(value.strip())
+        if not hasattr(config, key):
+            raise argparse.ArgumentTypeError(f"Unknown setting: {key}")
+        if key in SETTING_CHOICES and value not in SETTING_CHOICES[key]:
+            raise argparse.ArgumentTypeError(f"Invalid value for {key}: {value!r} (expected one of {', '.join(SETTING_CHOICES[key])})")
+        settings[key] = value
+    return name, settings
+
+def summarise_histogram(histogram, group_label=None):
+    """
+    Merges the series of a histogram across cameras and summarises them.
+
+    Args:
+        histogram (Histogram): The histogram.
+        group_label (str, optional): The label the series are grouped by, e.g. "stage". Without it, all the series are merged.
+
+    Returns:
+        dict: Group -> count, average and estimated 50th and 99th percentiles in milliseconds.
+    """
+    groups = {}
+    for key, (counts, count, total) in histogram.collect().items():
+        labels = dict(zip(histogram.label_names, key))
+        group = groups.setdefault(labels.get(group_label, ""), [[0] * len(counts), 0, 0.0])
+        group[0] = [a + b for a, b in zip(group[0], counts)]
+        group[1] += count
+        group[2] += total
+
+    return {
+        group: {
+            "count": count,
+            "average_ms": total / count * 1000 if count else None,
+            "p50_ms": histogram.percentile(counts, count, 0.5) * 1000 if count else None,
+            "p99_ms": histogram.percentile(counts, count, 0.99) * 1000 if count else None,
+        }
+        for group, (counts, count, total) in sorted(groups.items())
+    }
+
+def run_benchmark(run):
+    """
+    Runs the pipeline of one configuration headless and measures it. Called in a fresh process for each run.
+
+    Args:
+        run (dict): The run settings: workdir, source, cameras, settings, model and log_level.
+
+    Returns:
+        dict: The throughput, stage latencies, resource usage and event counts of the run.
+    """
+    # Clips and the catalog go to the run's own folder, as the paths in config are relative
+    os.chdir(run["workdir"])
+    for folder in (config.clips_folder_path, config.temp_folder_path, "instance"):
+        os.makedirs(folder, exist_ok=True)
+
+    for key, value in run["settings"].items():
+        setattr(config, key, value)
+    config.motion_detection_active = True
+
+    # Imported after the settings are applied, as some modules read them at import time
+    from log_utils import configure_logging
+    from clip_catalog import ClipCatalog
+    from camera_manager import Camera
+    from event_processor import EventProcessor, EVENT_STAGE_SECONDS
+    from inference_service import InferenceService, BATCH_SECONDS
+    from capture_worker import FRAMES_CAPTURED, CAPTURE_READ_SECONDS
+    from generate_frames import FRAMES_PROCESSED, FRAME_STAGE_SECONDS, RECORDINGS
+
+    configure_logging(run["log_level"])
+
+    # Load the model before the clock starts
+    catalog = ClipCatalog(os.path.join("instance", "catalog.db"), config.clips_folder_path)
+    inference_service = InferenceService(run["model"], config.inference_max_batch, config.inference_max_wait)
+    inference_service.ready.wait()
+    if inference_service.load_error is not None:
+        raise inference_service.load_error
+    alert_dispatcher = NullAlertDispatcher()
+    event_processor = EventProcessor(alert_dispatcher, inference_service, catalog, config.event_workers, config.event_queue_size, config.event_queue_timeout,
+                                     config.tracking_suppress_repeat_alerts)
+
+    # Sample the memory of the process and its ffmpeg children while the pipeline runs
+    process = psutil.Process()
+    peak_rss = [process.memory_info().rss]
+    finished = threading.Event()
+
+    def sample_memory():
+        while not finished.wait(0.05):
+            rss = process.memory_info().rss
+            for child in process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            peak_rss[0] = max(peak_rss[0], rss)
+
+    sampler = threading.Thread(target=sample_memory, daemon=True)
+    sampler.start()
+
+    cpu_before = process.cpu_times()
+    start = time.perf_counter()
+
+    # Every camera replays the same source, as fast as the pipeline takes it
+    cameras = [Camera(f"bench{index}", run["source"], event_processor) for index in range(run["cameras"])]
+    for camera in cameras:
+        camera.start()
+    for camera in cameras:
+        camera.processing_thread.join()
+    pipeline_seconds = time.perf_counter() - start
+
+    # Include the post-processing of the last events
+    event_processor.jobs.join()
+    elapsed = time.perf_counter() - start
+
+    cpu_after = process.cpu_times()
+    finished.set()
+    sampler.join()
+
+    # The ffmpeg recorders have exited by now, so their CPU time is in the children's times
+    cpu_seconds = sum(getattr(cpu_after, field, 0.0) - getattr(cpu_before, field, 0.0)
+                      for field in ("user", "system", "children_user", "children_system"))
+    frames_captured = sum(FRAMES_CAPTURED.collect().values())
+    frames_processed = sum(FRAMES_PROCESSED.collect().values())
+
+    stages = {"capture_read": summarise_histogram(CAPTURE_READ_SECONDS)[""]} if CAPTURE_READ_SECONDS.collect() else {}
+    stages.update(summarise_histogram(FRAME_STAGE_SECONDS, "stage"))
+    stages.update({f"event_{stage}": summary for stage, summary in summarise_histogram(EVENT_STAGE_SECONDS, "stage").items()})
+    if BATCH_SECONDS.collect():
+        stages["inference_batch"] = summarise_histogram(BATCH_SECONDS)[""]
+
+    return {
+        "pipeline_seconds": pipeline_seconds,
+        "elapsed_seconds": elapsed,
+        "frames_captured": frames_captured,
+        "frames_processed": frames_processed,
+        "frames_skipped": sum(camera.frame_buffer.frames_skipped + camera.frame_buffer.frames_dropped for camera in cameras),
+        "fps_in": frames_captured / pipeline_seconds,
+        "fps_out": frames_processed / pipeline_seconds,
+        "fps_out_per_camera": frames_processed / pipeline_seconds / run["cameras"],
+        "cpu_percent": cpu_seconds / elapsed * 100,
+        "peak_rss_mb": peak_rss[0] / (1024 * 1024),
+        "recordings": sum(RECORDINGS.collect().values()),
+        "events": event_processor.stats(),
+        "alerts": alert_dispatcher.alerts_submitted,
+        "stages": stages,
+    }
+
+def git_commit():
+    """
+    Looks up the commit being benchmarked, so results can be traced back to a version.
+
+    Returns:
+        str: The short commit hash, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    """
+    Prints the change in throughput and motion latency against a previous results file.
+
+    Args:
+        results (dict): The results of this benchmark.
+        baseline (dict): The results loaded from the baseline file.
+    """
+    def key(run):
+        return run["variant"], run["resolution"], run["cameras"], run["source"] if run.get("input") else None
+
+    baseline_runs = {key(run): run for run in baseline["runs"]}
+    print(f"\nCompared with {baseline.get('git_commit') or 'baseline'} ({baseline.get('created')}):")
+    for run in results["runs"]:
+        previous = baseline_runs.get(key(run))
+        if previous is None or "error" in run or "error" in previous:
+            continue
+
+        change = (run["fps_out"] / previous["fps_out"] - 1) * 100
+        line = f"  {run['variant']:<12} {run['resolution']:>10} x{run['cameras']:<3} fps {previous['fps_out']:8.1f} -> {run['fps_out']:8.1f} ({change:+.1f}%)"
+        motion, previous_motion = run["stages"].get("motion"), previous["stages"].get("motion")
+        if motion and previous_motion and motion["p99_ms"] and previous_motion["p99_ms"]:
+            line += f"  motion p99 {previous_motion['p99_ms']:.2f} -> {motion['p99_ms']:.2f} ms"
+        print(line)
+
+def main():
+    """
+    Builds the benchmark matrix from the command line, runs each configuration in its own process and saves the results.
+    """
+    parser = argparse.ArgumentParser(description="Replay video through the motion detection pipeline headless and measure it.")
+    parser.add_argument("--input", nargs="*", default=[], help="Video files to replay. Without them, synthetic videos are generated at each resolution.")
+    parser.add_argument("--resolutions", default="640x480,1280x720,1920x1080", help="Resolutions of the synthetic videos, comma-separated WIDTHxHEIGHT.")
+    parser.add_argument("--frames", type=int, default=300, help="Number of frames of the synthetic videos.")
+    parser.add_argument("--cameras", default="1", help="Numbers of cameras replaying the video at once, comma-separated.")
+    parser.add_argument("--variant", action="append", type=parse_variant, default=[],
+                        help="A configuration to compare, as NAME:KEY=VALUE,KEY=VALUE with keys from config.py. Can be repeated.")
+    parser.add_argument("--model", default=config.yolo_model_path, help="Path to the YOLO weights.")
+    parser.add_argument("--output", help="Path of the JSON file the results are saved to.")
+    parser.add_argument("--compare", help="Path of a previous results file to compare the throughput against.")
+    parser.add_argument("--log-level", default="WARNING", help="Minimum level of the pipeline's log messages.")
+    parser.add_argument("--keep", action="store_true", help="Keep the working folder with the recorded clips.")
+    args = parser.parse_args()
+
+    variants = args.variant or [("default", {})]
+    camera_counts = [int(count) for count in args.cameras.split(",")]
+    model = os.path.abspath(args.model) if os.path.exists(args.model) else args.model
+    workdir = tempfile.mkdtemp(prefix="mysentry-benchmark-")
+
+    # Replay the given files, or generate a synthetic video at each resolution
+    sources = []
+    for path in args.input:
+        video = cv2.VideoCapture(path)
+        resolution = f"{int(video.get(cv2.CAP_PROP_FRAME_WIDTH))}x{int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))}"
+        video.release()
+        sources.append((os.path.abspath(path), resolution))
+    if not sources:
+        for resolution in args.resolutions.split(","):
+            width, height = (int(value) for value in resolution.lower().split("x"))
+            path = os.path.join(workdir, f"synthetic_{width}x{height}.mp4")
+            synthesize_video(path, width, height, args.frames)
+            sources.append((path, f"{width}x{height}"))
+
+    results = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "cpu_count": os.cpu_count(),
+        "runs": [],
+    }
+
+    try:
+        for name, settings in variants:
+            for source, resolution in sources:
+                for cameras in camera_counts:
+                    run = {
+                        "variant": name,
+                        "settings": settings,
+                        "source": source,
+                        "input": bool(args.input),
+                        "resolution": resolution,
+                        "cameras": cameras,
+                        "model": model,
+                        "log_level": args.log_level,
+                        "workdir": tempfile.mkdtemp(dir=workdir),
+                    }
+
+                    # A fresh process per run, so the model, metrics and peak memory of one run do not leak into the next
+                    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                        try:
+                            measurements = pool.submit(run_benchmark, run).result()
+                        except Exception as error:
+                            measurements = {"error": str(error)}
+
+                    run.update(measurements)
+                    del run["workdir"]
+                    results["runs"].append(run)
+
+                    if "error" in run:
+                        print(f"{name:<12} {resolution:>10} x{cameras:<3} failed: {run['error']}")
+                        continue
+
+                    motion = run["stages"].get("motion", {})
+                    print(f"{name:<12} {resolution:>10} x{cameras:<3} {run['fps_out']:8.1f} fps ({run['fps_out_per_camera']:.1f}/camera)"
+                          f"  motion p50 {motion.get('p50_ms') or 0:6.2f} ms p99 {motion.get('p99_ms') or 0:6.2f} ms"
+                          f"  cpu {run['cpu_percent']:6.1f}%  rss {run['peak_rss_mb']:7.1f} MB  skipped {run['frames_skipped']}")
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Saved the results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+if __name__ == '__main__':
+    main()
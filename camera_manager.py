@@ -0,0 +1,278 @@
+import re
+import config
+import logging
+import threading
+from frame_buffer import FrameBuffer
+from video_handler import VideoHandler
+from ffmpeg_recorder import FFmpegRecorder
+from capture_worker import CaptureWorker
+from motion_detector import MotionDetector
+from object_tracker import ObjectTracker
+from generate_frames import generate_frames, FRAME_STAGE_SECONDS
+from pre_roll_buffer import PreRollBuffer
+from frame_broadcaster import FrameBroadcaster
+from packet_source import PacketSource
+
+logger = logging.getLogger(__name__)
+
+class Camera:
+    """
+    A single camera with its own capture worker, processing thread, detector state and recorders.
+    """
+
+    def __init__(self, camera_id, camera_url, event_processor, record_url=None):
+        """
+        Initializes the camera's capture and processing pipeline.
+
+        Args:
+            camera_id (str): The identifier used in the camera routes and clip filenames.
+            camera_url (str or int): The camera URL or local webcam ID, decoded for motion detection and the video feed.
+            event_processor (EventProcessor): The shared pool that post-processes finished clips.
+            record_url (str, optional): The URL of an H.264/H.265 stream to cut the clips from without re-encoding.
+        """
+        self.camera_id = camera_id
+        self.camera_url = camera_url
+        self.record_url = record_url
+        self.event_processor = event_processor
+        self.motion_detection_active = config.motion_detection_active
+        self.error = None # The error that stopped the processing thread, if any
+
+        # Capture frames on their own thread into the camera's ring buffer
+        self.frame_buffer = FrameBuffer(config.frame_buffer_size, config.frame_drop_policy)
+        self.capture_worker = CaptureWorker(camera_url, self.frame_buffer, camera_id)
+
+        # Per-camera detector state and recorders
+        self.motion_detector = MotionDetector(config.analysis_width, config.analysis_grayscale, config.analysis_stride,
+                                              adaptive=config.adaptive_detection, idle_after=config.no_motion_threshold,
+                                              idle_stride=config.idle_stride, idle_width=config.idle_width, idle_threshold=config.idle_threshold,
+                                              idle_pixel_threshold=config.idle_pixel_threshold, idle_background_stride=config.idle_background_stride)
+        self.object_tracker = ObjectTracker(config.tracking_iou_threshold, config.tracking_max_distance, config.tracking_movement_threshold,
+                                            config.tracking_max_misses, config.tracking_max_age)
+        self.video_handler = self.create_recorder()
+        self.video_handler_masked = self.create_recorder()
+
+        # Compressed packets of the recorded stream, with their own pre-roll, when recording by pass-through
+        self.packet_source = None
+        if record_url:
+            self.packet_source = PacketSource(record_url, config.record_codec, config.pre_roll_seconds, config.packet_pre_roll_max_bytes)
+
+        # Frames from before the motion, flushed into the clip when recording starts
+        self.pre_roll_buffer = PreRollBuffer(config.pre_roll_seconds, config.pre_roll_max_bytes, config.pre_roll_jpeg_quality)
+
+        # Encode each processed frame once and fan it out to the clients watching the camera
+        self.broadcaster = FrameBroadcaster(config.stream_queue_size, config.stream_jpeg_quality)
+
+        # Run motion detection and recording independently of the clients
+        self.processing_thread = threading.Thread(target=self.run_processing, daemon=True)
+
+    def create_recorder(self):
+        """
+        Creates a recorder for the camera's clips with the configured backend.
+
+        Returns:
+            VideoHandler: The recorder.
+        """
+        if config.recorder_backend == "ffmpeg" or self.record_url:
+            return FFmpegRecorder(self.camera_id, config.recording_codec, config.recording_preset, config.recording_crf,
+                                  config.recording_threads, config.recording_max_fps, config.recording_queue_bytes)
+        return VideoHandler(self.camera_id)
+
+    def start(self):
+        """
+        Starts capturing and processing frames.
+
+        Raises:
+            OSError: If ffmpeg cannot be started for the record URL. Nothing is left running.
+        """
+        # Start the stream that can fail first, so a failure leaves no thread behind
+        if self.packet_source is not None:
+            try:
+                self.packet_source.start()
+            except OSError:
+                self.capture_worker.video_capture.release()
+                raise
+        self.capture_worker.start()
+        self.processing_thread.start()
+
+    def stop(self):
+        """
+        Stops the camera and waits for its processing thread to finish the current clip.
+        """
+        self.capture_worker.stop()
+        if self.processing_thread.is_alive():
+            self.processing_thread.join(2.0)
+        if self.packet_source is not None:
+            self.packet_source.stop()
+
+    def is_opened(self):
+        """
+        Checks whether the camera is still capturing frames.
+
+        Returns:
+            bool: True if the camera is running, False otherwise.
+        """
+        return self.capture_worker.is_opened()
+
+    def toggle_motion_detection(self):
+        """
+        Toggles motion detection on this camera.
+
+        Returns:
+            bool: The new motion detection state.
+        """
+        self.motion_detection_active = not self.motion_detection_active
+        return self.motion_detection_active
+
+    def set_exclusion_zones(self, zones, canvas_size=None):
+        """
+        Sets the areas of the video feed ignored by motion detection.
+
+        Args:
+            zones (list): The exclusion zones drawn on the video feed, rectangles or polygons.
+            canvas_size (tuple, optional): (width, height) of the canvas the zones were drawn on.
+        """
+        self.motion_detector.set_exclusion_zones(zones, canvas_size)
+
+    def run_processing(self):
+        """
+        Processes the captured frames and publishes each processed frame to the clients.
+        If the processing fails, the camera is stopped so it no longer reports itself as running.
+        """
+        try:
+            for frame in generate_frames(self):
+                with FRAME_STAGE_SECONDS.time(camera=self.camera_id, stage="stream_encode"):
+                    self.broadcaster.publish(frame)
+        except Exception as error:
+            self.error = error
+            logger.exception("Camera processing failed camera=%s", self.camera_id)
+        finally:
+            # Stop capturing, nothing reads the frames any more
+            self.capture_worker.stop()
+            if self.packet_source is not None:
+                self.packet_source.stop()
+
+            # Tell the clients the camera has stopped
+            self.broadcaster.close()
+
+    def stats(self):
+        """
+        Returns the camera's state and counters.
+
+        Returns:
+            dict: The camera settings, its measured frame rate, its frame buffer counters and its stream counters.
+        """
+        return {
+            "camera_id": self.camera_id,
+            "camera_url": str(self.camera_url),
+            "record_url": self.record_url,
+            "running": self.is_opened(),
+            "error": str(self.error) if self.error else None,
+            "fps": self.capture_worker.fps,
+            "motion_detection_active": self.motion_detection_active,
+            "exclusion_zones": len(self.motion_detector.exclusion_zones),
+            "motion_detector": self.motion_detector.stats(),
+            "tracker": self.object_tracker.stats(),
+            "frame_buffer": self.frame_buffer.stats(),
+            "pre_roll": self.pre_roll_buffer.stats(),
+            "stream": self.broadcaster.stats(),
+            "packets": self.packet_source.stats() if self.packet_source else None,
+        }
+
+class CameraManager:
+    """
+    A registry of the cameras running in this process.
+    """
+
+    def __init__(self, event_processor, max_cameras=16):
+        """
+        Initializes an empty camera registry.
+
+        Args:
+            event_processor (EventProcessor): The shared pool that post-processes finished clips.
+            max_cameras (int): Maximum number of cameras that can run at the same time.
+        """
+        self.event_processor = event_processor
+        self.max_cameras = max_cameras
+        self.cameras = {} # Camera id -> Camera
+        self.lock = threading.Lock()
+
+    def add_camera(self, camera_id, camera_url, record_url=None):
+        """
+        Starts a camera, replacing the existing one with the same id if its URLs changed.
+
+        Args:
+            camera_id (str): The identifier of the camera (letters, digits, "-" and "_").
+            camera_url (str or int): The camera URL or local webcam ID.
+            record_url (str, optional): The URL of an H.264/H.265 stream to cut the clips from without re-encoding.
+
+        Returns:
+            Camera: The running camera.
+
+        Raises:
+            ValueError: If the id is invalid or the camera limit is reached.
+            OSError: If the camera could not be started, in which case it is not registered.
+        """
+        if not re.fullmatch(r"[A-Za-z0-9_-]{1,32}", camera_id):
+            raise ValueError(f"Invalid camera id: {camera_id}")
+
+        with self.lock:
+            existing = self.cameras.get(camera_id)
+
+            # Keep the existing camera if it is already capturing from the same URLs
+            if existing is not None and existing.camera_url == camera_url and existing.record_url == record_url and existing.is_opened():
+                return existing
+
+            if existing is None and len(self.cameras) >= self.max_cameras:
+                raise ValueError(f"Camera limit of {self.max_cameras} reached")
+
+            # Close the existing camera before switching to the new URL
+            if existing is not None:
+                existing.stop()
+                del self.cameras[camera_id]
+
+            camera = Camera(camera_id, camera_url, self.event_processor, record_url)
+            camera.start()
+            self.cameras[camera_id] = camera
+            return camera
+
+    def remove_camera(self, camera_id):
+        """
+        Stops and removes a camera.
+
+        Args:
+            camera_id (str): The identifier of the camera.
+
+        Returns:
+            bool: True if the camera existed, False otherwise.
+        """
+        with self.lock:
+            camera = self.cameras.pop(camera_id, None)
+
+        if camera is None:
+            return False
+
+        camera.stop()
+        return True
+
+    def get_camera(self, camera_id):
+        """
+        Looks up a camera by id.
+
+        Args:
+            camera_id (str): The identifier of the camera.
+
+        Returns:
+            Camera: The camera, or None if it does not exist.
+        """
+        with self.lock:
+            return self.cameras.get(camera_id)
+
+    def list_cameras(self):
+        """
+        Lists the registered cameras.
+
+        Returns:
+            list: The registered cameras.
+        """
+        with self.lock:
+            return list(self.cameras.values())
@@ -0,0 +1,97 @@
+import time
+import threading
+import cv2
+from metrics import Counter, Histogram
+
+FRAMES_CAPTURED = Counter("mysentry_frames_captured_total", "Frames read from the camera", ("camera",))
+CAPTURE_READ_SECONDS = Histogram("mysentry_capture_read_seconds", "Time taken to read a frame from the camera", ("camera",))
+
+class CaptureWorker(threading.Thread):
+    """
+    A background thread that reads frames from a camera into a frame buffer.
+    """
+
+    def __init__(self, camera_url, frame_buffer, camera_id="default"):
+        """
+        Opens the camera and prepares the capture thread.
+
+        Args:
+            camera_url (str or int): The camera URL or local webcam ID.
+            frame_buffer (FrameBuffer): The buffer the captured frames are written to.
+            camera_id (str): The camera the frames are counted under in the metrics.
+        """
+        super().__init__(daemon=True)
+        self.camera_url = camera_url
+        self.camera_id = camera_id
+        self.frame_buffer = frame_buffer
+        self.video_capture = cv2.VideoCapture(camera_url)
+
+        # Keep the capture backend's own queue short so frames do not arrive stale
+        self.video_capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+        self.running = True # Cleared to ask the thread to stop
+        self.frame_interval = None # Smoothed time between two frames, measured from the capture times
+
+    def is_opened(self):
+        """
+        Checks whether the camera is open and the capture thread is still running.
+
+        Returns:
+            bool: True if frames are being captured, False otherwise.
+        """
+        return self.running and self.video_capture.isOpened()
+
+    @property
+    def fps(self):
+        """
+        Returns the frame rate the camera is delivering at.
+
+        Returns:
+            float: The measured frames per second, or None before two frames have been captured.
+        """
+        if not self.frame_interval:
+            return None
+        return 1.0 / self.frame_interval
+
+    def run(self):
+        """
+        Reads frames from the camera until it fails or the worker is stopped.
+        """
+        last_timestamp = None # Capture time of the previous frame
+
+        while self.running and self.video_capture.isOpened():
+            # Read a frame from the camera
+            start = time.perf_counter()
+            success, frame = self.video_capture.read()
+
+            if not success:
+                break
+            CAPTURE_READ_SECONDS.observe(time.perf_counter() - start, camera=self.camera_id)
+            FRAMES_CAPTURED.inc(camera=self.camera_id)
+
+            # Measure the real frame rate of the camera, smoothing out the jitter
+            timestamp = time.time()
+            if last_timestamp is not None:
+                interval = timestamp - last_timestamp
+                self.frame_interval = interval if self.frame_interval is None else 0.95 * self.frame_interval + 0.05 * interval
+            last_timestamp = timestamp
+
+            # Hand the frame to the consumers, the buffer applies its drop policy
+            self.frame_buffer.put(frame, timestamp)
+
+        self.running = False
+        self.video_capture.release()
+
+        # Let the consumers know no more frames will arrive
+        self.frame_buffer.close()
+
+    def stop(self, timeout=2.0):
+        """
+        Stops the capture thread and waits for it to exit.
+
+        Args:
+            timeout (float): Maximum time to wait for the thread in seconds.
+        """
+        self.running = False
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,242 @@
+import os
+import sqlite3
+import logging
+import threading
+from collections import Counter
+from datetime import datetime
+from video_handler import VideoHandler
+from clip_metadata import read_clip_metadata
+
+logger = logging.getLogger(__name__)
+
+class ClipCatalog:
+    """
+    A persistent SQLite index of the recorded clips, so the clips page never has to scan the folder.
+    """
+
+    def __init__(self, database_path, clips_folder):
+        """
+        Opens the catalog and creates its tables if needed.
+
+        Args:
+            database_path (str): Path to the SQLite database file.
+            clips_folder (str): Path to the folder holding the clips.
+        """
+        self.database_path = database_path
+        self.clips_folder = clips_folder
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(database_path) or ".", exist_ok=True)
+        with self.connect() as connection:
+            # Write-ahead logging lets the clips page read while the event workers write
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS clips (
+                    name TEXT PRIMARY KEY,
+                    camera_id TEXT,
+                    start_time TEXT NOT NULL,
+                    end_time TEXT,
+                    duration REAL,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    comment TEXT NOT NULL DEFAULT '',
+                    thumbnail TEXT
+                );
+                CREATE INDEX IF NOT EXISTS clips_start_time ON clips (start_time);
+                CREATE TABLE IF NOT EXISTS clip_objects (
+                    name TEXT NOT NULL REFERENCES clips (name) ON DELETE CASCADE,
+                    class_name TEXT NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (name, class_name)
+                );
+                CREATE INDEX IF NOT EXISTS clip_objects_class_name ON clip_objects (class_name);
+            """)
+
+    def connect(self):
+        """
+        Opens a connection to the catalog. Each call gets its own connection so threads never share one.
+
+        Returns:
+            sqlite3.Connection: The connection, usable as a context manager that commits on success.
+        """
+        connection = sqlite3.connect(self.database_path, timeout=10)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA foreign_keys=ON")
+        return connection
+
+    def add_clip(self, metadata):
+        """
+        Adds or updates a finalised clip.
+
+        Args:
+            metadata (dict): The clip's metadata record, as written to its sidecar.
+        """
+        name = metadata["clip"]
+        clip_path = os.path.join(self.clips_folder, name)
+        size = os.path.getsize(clip_path) if os.path.exists(clip_path) else 0
+
+        # Work out the duration from the event start and end, when both are known
+        duration = None
+        if metadata.get("start_time") and metadata.get("end_time"):
+            start_time = datetime.fromisoformat(metadata["start_time"])
+            end_time = datetime.fromisoformat(metadata["end_time"])
+            duration = (end_time - start_time).total_seconds()
+
+        with self.lock, self.connect() as connection:
+            connection.execute("""
+                INSERT OR REPLACE INTO clips (name, camera_id, start_time, end_time, duration, size, comment, thumbnail)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (name, metadata.get("camera_id"), metadata["start_time"], metadata.get("end_time"),
+                  duration, size, metadata.get("comment", ""), metadata.get("thumbnail")))
+
+            # Store a row per object class so clips can be filtered by class through an index
+            connection.execute("DELETE FROM clip_objects WHERE name = ?", (name,))
+            connection.executemany(
+                "INSERT INTO clip_objects (name, class_name, count) VALUES (?, ?, ?)",
+                [(name, class_name, count) for class_name, count in Counter(metadata.get("objects", [])).items()])
+
+    def remove_clip(self, name):
+        """
+        Removes a clip from the catalog.
+
+        Args:
+            name (str): The clip filename.
+        """
+        with self.lock, self.connect() as connection:
+            connection.execute("DELETE FROM clips WHERE name = ?", (name,))
+
+    def get_clip(self, name):
+        """
+        Looks up a clip.
+
+        Args:
+            name (str): The clip filename.
+
+        Returns:
+            dict: The clip's row, or None if it is not in the catalog.
+        """
+        with self.connect() as connection:
+            row = connection.execute("SELECT * FROM clips WHERE name = ?", (name,)).fetchone()
+        return dict(row) if row else None
+
+    def query(self, start_date=None, end_date=None, object_class=None, page=1, per_page=24):
+        """
+        Lists the clips matching the filters, newest first, one page at a time.
+
+        Args:
+            start_date (str, optional): Earliest start time to include, in ISO format.
+            end_date (str, optional): Start times from this ISO time onwards are excluded.
+            object_class (str, optional): Only include clips where this class of object was detected.
+            page (int): The page number, starting at 1.
+            per_page (int): The number of clips per page.
+
+        Returns:
+            tuple: The clips on the page as dicts, and the total number of matching clips.
+        """
+        conditions, parameters = [], []
+        if start_date:
+            conditions.append("start_time >= ?")
+            parameters.append(start_date)
+        if end_date:
+            conditions.append("start_time < ?")
+            parameters.append(end_date)
+        if object_class:
+            conditions.append("name IN (SELECT name FROM clip_objects WHERE class_name = ?)")
+            parameters.append(object_class)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with self.connect() as connection:
+            total = connection.execute(f"SELECT COUNT(*) FROM clips {where}", parameters).fetchone()[0]
+            rows = connection.execute(
+                f"SELECT * FROM clips {where} ORDER BY start_time DESC, name DESC LIMIT ? OFFSET ?",
+                parameters + [per_page, (max(1, page) - 1) * per_page]).fetchall()
+
+        return [dict(row) for row in rows], total
+
+    def object_classes(self):
+        """
+        Lists the object classes detected in any clip, for the clips page filter.
+
+        Returns:
+            list: The class names in alphabetical order.
+        """
+        with self.connect() as connection:
+            rows = connection.execute("SELECT DISTINCT class_name FROM clip_objects ORDER BY class_name").fetchall()
+        return [row[0] for row in rows]
+
+    def oldest_clips(self, before=None, limit=100):
+        """
+        Lists the oldest clips with the object classes detected in them, for retention.
+
+        Args:
+            before (str, optional): Only include clips that started before this ISO time.
+            limit (int): Maximum number of clips returned, or -1 for all of them.
+
+        Returns:
+            list: The clips as dicts with their "name", "start_time", "size" and "objects" (a list of class names), oldest first.
+        """
+        where = "WHERE clips.start_time < ?" if before else ""
+        parameters = [before] if before else []
+
+        with self.connect() as connection:
+            rows = connection.execute(f"""
+                SELECT clips.name, clips.start_time, clips.size, GROUP_CONCAT(clip_objects.class_name) AS objects
+                FROM clips LEFT JOIN clip_objects ON clip_objects.name = clips.name
+                {where}
+                GROUP BY clips.name
+                ORDER BY clips.start_time, clips.name
+                LIMIT ?
+            """, parameters + [limit]).fetchall()
+
+        return [dict(row, objects=row["objects"].split(",") if row["objects"] else []) for row in rows]
+
+    def total_size(self):
+        """
+        Adds up the size of the catalogued clips.
+
+        Returns:
+            int: The total size in bytes.
+        """
+        with self.connect() as connection:
+            return connection.execute("SELECT COALESCE(SUM(size), 0) FROM clips").fetchone()[0]
+
+    def is_empty(self):
+        """
+        Checks whether the catalog holds no clips.
+
+        Returns:
+            bool: True if the catalog is empty.
+        """
+        with self.connect() as connection:
+            return connection.execute("SELECT 1 FROM clips LIMIT 1").fetchone() is None
+
+    def rebuild(self):
+        """
+        Rebuilds the catalog from the clips and metadata sidecars on disk.
+
+        Returns:
+            int: The number of clips catalogued.
+        """
+        clips = [clip for clip in os.listdir(self.clips_folder) if clip.endswith(".mp4")]
+
+        with self.lock, self.connect() as connection:
+            connection.execute("DELETE FROM clips")
+
+        catalogued = 0
+        for clip in clips:
+            clip_path = os.path.join(self.clips_folder, clip)
+            metadata = read_clip_metadata(clip_path)
+
+            # Clips without a sidecar are catalogued with what their filename tells
+            if not metadata:
+                try:
+                    start_time = VideoHandler.parse_timestamp_from_filename(clip)
+                except ValueError:
+                    logger.warning("Skipped clip without a timestamp in its name clip=%s", clip)
+                    continue
+                metadata = {"clip": clip, "start_time": start_time.isoformat(timespec="seconds")}
+
+            metadata["clip"] = clip
+            self.add_clip(metadata)
+            catalogued += 1
+
+        return catalogued
@@ -0,0 +1,170 @@
+import os
+import json
+import logging
+import tempfile
+from datetime import datetime
+from video_handler import VideoHandler
+from utilities import format_object_detected, parse_object_detected
+
+logger = logging.getLogger(__name__)
+
+def get_metadata_path(clip_path):
+    """
+    Returns the path of the metadata sidecar stored next to a clip.
+
+    Args:
+        clip_path (str): Path to the video clip.
+
+    Returns:
+        str: The sidecar path (e.g., "static/clips/2024-08-15_12-34-56_default.json").
+    """
+    return os.path.splitext(clip_path)[0] + ".json"
+
+def get_thumbnail_path(clip_path):
+    """
+    Returns the path of the poster image stored next to a clip.
+
+    Args:
+        clip_path (str): Path to the video clip.
+
+    Returns:
+        str: The poster path (e.g., "static/clips/2024-08-15_12-34-56_default.jpg").
+    """
+    return os.path.splitext(clip_path)[0] + ".jpg"
+
+def build_clip_metadata(clip_path, camera_id, start_time, end_time, detections, thumbnail=None, tracks=None):
+    """
+    Builds the metadata record of a clip.
+
+    Args:
+        clip_path (str): Path to the video clip.
+        camera_id (str): The camera that recorded the clip.
+        start_time (datetime): The time the recording started.
+        end_time (datetime): The time the recording stopped.
+        detections (list): The Detection tuples found in the clip.
+        thumbnail (str, optional): Filename of the clip's poster image.
+        tracks (list, optional): Summaries of the distinct objects tracked during the event.
+            When given, the clip lists one object per track instead of one per detection.
+
+    Returns:
+        dict: The metadata record.
+    """
+    tracks = tracks or []
+    objects = [track["class_name"] for track in tracks] if tracks else [detection.class_name for detection in detections]
+    return {
+        "clip": os.path.basename(clip_path),
+        "camera_id": camera_id,
+        "start_time": start_time.isoformat(timespec="seconds"),
+        "end_time": end_time.isoformat(timespec="seconds") if end_time else None,
+        "objects": objects,
+        "detections": [
+            {"class_name": detection.class_name, "confidence": round(detection.confidence, 4), "box": [round(value, 1) for value in detection.box]}
+            for detection in detections
+        ],
+        "tracks": [
+            {
+                "track_id": track["track_id"],
+                "class_name": track["class_name"],
+                "first_seen": datetime.fromtimestamp(track["first_seen"]).isoformat(timespec="seconds"),
+                "last_seen": datetime.fromtimestamp(track["last_seen"]).isoformat(timespec="seconds"),
+                "dwell_seconds": track["dwell_seconds"],
+                "confidence": track["confidence"],
+                "known": track["known"],
+            }
+            for track in tracks
+        ],
+        "comment": format_object_detected(objects),
+        "thumbnail": thumbnail,
+    }
+
+def write_clip_metadata(clip_path, metadata):
+    """
+    Writes the metadata sidecar of a clip atomically, so readers never see a partial file.
+
+    Args:
+        clip_path (str): Path to the video clip.
+        metadata (dict): The metadata record.
+    """
+    metadata_path = get_metadata_path(clip_path)
+
+    # Write to a temporary file in the same folder, then swap it in with a single rename
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(metadata_path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(handle, "w") as file:
+            json.dump(metadata, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, metadata_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def read_clip_metadata(clip_path):
+    """
+    Reads the metadata sidecar of a clip.
+
+    Args:
+        clip_path (str): Path to the video clip.
+
+    Returns:
+        dict: The metadata record, or an empty dict if the clip has none.
+    """
+    try:
+        with open(get_metadata_path(clip_path)) as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def delete_clip_metadata(clip_path):
+    """
+    Deletes the metadata sidecar and poster image of a clip, if they exist.
+
+    Args:
+        clip_path (str): Path to the video clip.
+    """
+    for path in (get_metadata_path(clip_path), get_thumbnail_path(clip_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def migrate_clip_metadata(clips_folder):
+    """
+    Creates sidecars for clips recorded before them, reading the old comment tags with ffmpeg once.
+
+    Args:
+        clips_folder (str): Path to the folder holding the clips.
+
+    Returns:
+        int: The number of clips migrated.
+    """
+    migrated = 0
+    for clip in sorted(os.listdir(clips_folder)):
+        clip_path = os.path.join(clips_folder, clip)
+
+        # Skip anything that is not a clip, and clips that already have a sidecar
+        if not clip.endswith(".mp4") or os.path.exists(get_metadata_path(clip_path)):
+            continue
+
+        # Old clips only carry the start time in their filename and the camera after it, if any
+        try:
+            start_time = VideoHandler.parse_timestamp_from_filename(clip)
+        except ValueError:
+            logger.warning("Skipped clip without a timestamp in its name clip=%s", clip)
+            continue
+
+        comment = VideoHandler.get_video_metadata(clip_path)
+        objects = parse_object_detected(comment)
+
+        name = os.path.splitext(clip)[0]
+        write_clip_metadata(clip_path, {
+            "clip": clip,
+            "camera_id": name[20:] or None,
+            "start_time": start_time.isoformat(timespec="seconds"),
+            "end_time": None,
+            "objects": objects,
+            "detections": [],
+            "comment": comment or format_object_detected(objects),
+        })
+        migrated += 1
+
+    return migrated
@@ -1,12 +1,218 @@
-# Flag to indicate whether motion detection is currently active.
-# This is used to control the state of motion detection across the application.
+# Flag to indicate whether motion detection starts active on a newly connected camera.
+# Each camera then keeps its own motion detection state and exclusion zones.
 motion_detection_active = False
 
-# List to store the coordinates of exclusion zones on the video feed.
-exclusion_zones = []
+# Maximum number of cameras that can run at the same time.
+max_cameras = 16
 
 # Path to the temporary folder where temporary files, such as processed video frames, might be stored.
 temp_folder_path = "static/temp"
 
 # Path to the folder where recorded video clips are stored.
-clips_folder_path = "static/clips"
\ No newline at end of file
+clips_folder_path = "static/clips"
+
+# Number of preallocated frame slots in each camera's ring buffer.
+frame_buffer_size = 8
+
+# What to drop when a consumer falls behind the capture thread:
+# "oldest" overwrites the oldest frame, "newest" drops incoming frames until consumers catch up,
+# and "latest" makes lagging consumers skip straight to the most recent frame.
+frame_drop_policy = "oldest"
+
+# Number of worker threads that post-process finished clips (preview, object detection, metadata, email).
+event_workers = 2
+
+# Maximum number of finished clips waiting for post-processing.
+event_queue_size = 8
+
+# How long the capture loop waits for room in a full event queue before skipping post-processing, in seconds.
+event_queue_timeout = 0.0
+
+# Number of encoded frames a viewer may fall behind before its oldest frames are dropped.
+stream_queue_size = 2
+
+# JPEG quality (0-100) of the frames streamed to the viewers.
+stream_jpeg_quality = 80
+
+# Path to the YOLO weights shared by all cameras for object detection.
+yolo_model_path = "yolov8n.pt"
+
+# Maximum number of images run through the YOLO model in one batch.
+inference_max_batch = 8
+
+# How long the inference service waits for more requests to fill a batch, in seconds.
+inference_max_wait = 0.02
+
+# Whether the inference service runs one dummy inference after loading the model, so the first event does not pay for it.
+inference_warmup = True
+
+# How the event workers find objects in a clip:
+# "roi" runs the detector on crops of the motion regions taken straight from the frames in memory,
+# "masked" records a second, masked video and runs the detector on a frame decoded from it.
+object_detection_mode = "roi"
+
+# Padding added around each motion region before it is cropped, as a fraction of the region size.
+roi_padding = 0.1
+
+# Maximum number of motion frames whose crops are kept in memory during an event.
+roi_sample_limit = 8
+
+# Run object detection on every Nth frame while recording and follow the objects found with a tracker (0 disables tracking).
+# The tracker gives each object a stable id across frames and events, so an event reports distinct objects and how long they stayed,
+# and the recording carries on while an object that arrived during the event is still in view.
+tracking_stride = 15
+
+# Minimum overlap (intersection over union) between a detection and a tracked object's last box to be the same object.
+# Detections that overlap less still match if their centre is within tracking_max_distance box diagonals.
+tracking_iou_threshold = 0.3
+tracking_max_distance = 1.0
+
+# Centre shift between two detections, in box diagonals, above which a tracked object counts as moving.
+tracking_movement_threshold = 0.1
+
+# Detection runs in a row without an object, or seconds without it, before its track is dropped.
+# Objects still in view and stationary when an event ends (e.g., a parked car) keep their id into the next event, if they are found where they were left.
+tracking_max_misses = 10
+tracking_max_age = 600.0
+
+# Whether events whose objects were all reported by an earlier alert (e.g., the same parked car) are recorded without an alert.
+tracking_suppress_repeat_alerts = True
+
+# Stop a recording after this many detection runs in a row found only objects that were there before the event and did not move,
+# e.g. when swaying shadows around a parked car keep the motion going. Motion that carries on starts a new clip (0 disables it).
+tracking_end_after = 0
+
+# Width in pixels the frames are downscaled to for motion analysis (None analyses at full resolution).
+# Detected motion is mapped back to full-resolution coordinates for drawing, masking and exclusion checks.
+analysis_width = 320
+
+# Whether motion analysis runs on grayscale frames instead of colour.
+analysis_grayscale = True
+
+# Analyse every Nth frame for motion and reuse the last result in between.
+analysis_stride = 1
+
+# Frames in a row without motion before a recording stops.
+no_motion_threshold = 60
+
+# Whether motion detection idles while the scene is still, to save CPU on quiet cameras.
+# While idle, every idle_stride-th frame is downscaled to idle_width and compared with the previous one checked.
+# Once more than idle_threshold of the pixels change by more than idle_pixel_threshold, every frame gets the full
+# analysis again, until no_motion_threshold frames pass without motion. Motion is noticed at most idle_stride frames late,
+# which the pre-roll covers. The background model is updated every idle_background_stride-th frame while idle.
+adaptive_detection = True
+idle_stride = 5
+idle_width = 80
+idle_threshold = 0.005
+idle_pixel_threshold = 25
+idle_background_stride = 30
+
+# Seconds of video kept from before the motion and added to the start of each clip (0 disables the pre-roll).
+pre_roll_seconds = 3.0
+
+# Memory budget for each camera's pre-roll in bytes, the oldest frames are dropped beyond it.
+pre_roll_max_bytes = 8 * 1024 * 1024
+
+# JPEG quality (0-100) of the frames held in the pre-roll.
+pre_roll_jpeg_quality = 85
+
+# How clips are encoded:
+# "ffmpeg" streams the frames into an ffmpeg process on its own thread, with the real frame timing of the camera,
+# "opencv" encodes them with cv2.VideoWriter on the processing thread.
+recorder_backend = "ffmpeg"
+
+# FFmpeg video encoder for the clips, e.g. "libx264" or a hardware encoder such as "h264_nvenc", "h264_qsv" or "h264_vaapi".
+recording_codec = "libx264"
+
+# Encoder preset trading encoding speed for file size (None uses the encoder's default).
+recording_preset = "veryfast"
+
+# Constant rate factor of the encoder, lower is better quality (None uses the encoder's default).
+recording_crf = 23
+
+# Number of encoder threads per clip (0 lets ffmpeg choose).
+recording_threads = 0
+
+# Highest frame rate clips are recorded at, frames from faster cameras are skipped.
+recording_max_fps = 30.0
+
+# Memory in bytes the frames waiting to be written to ffmpeg may take per clip before the processing thread waits for it,
+# e.g. 64 MiB holds about 10 frames at 1080p or 70 at 640x480. The masked clip has its own queue.
+recording_queue_bytes = 64 * 1024 * 1024
+
+# Codec of the streams recorded by pass-through ("h264" or "hevc"), for cameras started with a record URL.
+# Those cameras run motion detection on their camera URL (e.g. a low-resolution sub-stream) and cut the clips
+# from the compressed packets of the record URL, without decoding or re-encoding them.
+record_codec = "h264"
+
+# Memory budget for each pass-through camera's packet pre-roll in bytes, the oldest groups of pictures are dropped beyond it.
+packet_pre_roll_max_bytes = 32 * 1024 * 1024
+
+# JPEG quality (0-100) of the frame kept in memory during an event for the preview image.
+preview_jpeg_quality = 90
+
+# Width in pixels of the poster image shown for each clip on the clips page.
+thumbnail_width = 320
+
+# JPEG quality (0-100) of the poster images.
+thumbnail_jpeg_quality = 75
+
+# Minimum seconds between two alert emails to a recipient, the events in between are sent together as one digest.
+alert_digest_window = 60.0
+
+# Maximum number of alert emails sent to a recipient within alert_rate_period seconds.
+alert_rate_limit = 10
+alert_rate_period = 3600.0
+
+# How many times a failed alert email is retried, waiting alert_retry_backoff seconds and doubling the wait each time.
+alert_max_retries = 5
+alert_retry_backoff = 5.0
+
+# Maximum number of images attached to a digest email.
+alert_max_attachments = 6
+
+# Longest side in pixels of the images attached to the alerts, larger images are downscaled.
+alert_image_max_dimension = 1280
+
+# JPEG quality (0-100) of the images attached to the alerts.
+alert_jpeg_quality = 80
+
+# Whether the preview and prediction images are attached side by side as one image.
+alert_composite = False
+
+# Seconds the SMTP connection may sit idle before it is checked with a NOOP, and how long to wait for the server.
+smtp_keepalive_interval = 60.0
+smtp_timeout = 30.0
+
+# Path to the SQLite catalog indexing the recorded clips for the clips page.
+catalog_database_path = "instance/catalog.db"
+
+# Number of clips shown on each page of the clips page.
+clips_per_page = 24
+
+# How long browsers may cache a clip before revalidating it with its ETag, in seconds.
+clip_cache_max_age = 3600
+
+# Whether clips are handed to the front-end web server (e.g., nginx or Apache) with an X-Sendfile header instead of being sent by Flask.
+use_x_sendfile = False
+
+# Maximum disk space used by the clips in bytes, the oldest clips are deleted beyond it (None for no limit), e.g. 50 * 1024 ** 3 for 50 GiB.
+# Off by default, so no clips are deleted until a quota is set.
+retention_max_bytes = None
+
+# Days a clip is kept (None keeps clips until the disk limit is reached), e.g. 30.
+retention_max_age_days = None
+
+# Days a clip is kept by the object classes detected in it, overriding retention_max_age_days.
+# A clip is kept as long as its longest-kept class, e.g. {"person": 30} with retention_max_age_days = 3
+# keeps person events 30 days and the others 3 days.
+retention_class_days = {}
+
+# Seconds between two runs of the background retention.
+retention_interval = 300.0
+
+# Minimum level of the log messages, e.g. "DEBUG", "INFO" or "WARNING".
+log_level = "INFO"
+
+# Minimum seconds between two log messages that can repeat on every frame, such as "Motion detected".
+log_rate_limit_interval = 10.0
@@ -1,5 +1,7 @@
 import os
+import time
 import smtplib
+import threading
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
@@ -7,69 +9,150 @@ from utilities import format_object_detected
 
 class EmailAlert:
     """
-    A class to handle sending email alerts for motion detection events.
+    A class to handle the SMTP connection and the emails sent for motion detection events.
     """
 
-    def __init__(self):
+    def __init__(self, keepalive_interval=60.0, timeout=30.0):
         """
-        Initializes the email server and stores the sender's email address.
+        Reads the email settings from the environment. The connection is opened on the first email.
+
+        Args:
+            keepalive_interval (float): Seconds a connection may sit idle before it is checked with a NOOP.
+            timeout (float): Seconds to wait for the SMTP server before giving up.
+        """
+        # Retrieve the SMTP server, the email and app password from environment variables
+        self.host = os.getenv("SMTP_HOST", "smtp.gmail.com")
+        self.port = int(os.getenv("SMTP_PORT", "587"))
+        self.use_starttls = os.getenv("SMTP_STARTTLS", "true").lower() in ("1", "true", "yes")
+        self.email_address = os.getenv("EMAIL_ADDRESS")
+        self.password = os.getenv("PASSWORD")
+
+        # Alerts go to the sender unless other recipients are listed, separated by commas
+        recipients = os.getenv("ALERT_RECIPIENTS", "")
+        self.recipients = [recipient.strip() for recipient in recipients.split(",") if recipient.strip()] or [self.email_address]
+
+        self.keepalive_interval = keepalive_interval
+        self.timeout = timeout
+        self.server = None # The open SMTP connection, or None
+        self.last_used = 0.0 # Time the connection was last used or checked
+
+        # The connection is used by the dispatcher's worker and the keep-alive, so access is serialised
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """
+        Opens the SMTP connection, upgrading it to TLS and logging in when configured.
+        """
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.use_starttls:
+                server.starttls() # Upgrade the connection to a secure encrypted SSL/TLS connection
+            if self.password:
+                server.login(self.email_address, self.password) # Log in to the email account using the credentials
+        except (smtplib.SMTPException, OSError):
+            server.close()
+            raise
+
+        self.server = server
+        self.last_used = time.monotonic()
+
+    def close(self):
         """
-        self.server, self.email_address = self.initialize_email_server()
-    
-    def initialize_email_server(self):
+        Closes the SMTP connection, if it is open.
         """
-        Initializes the SMTP server for sending emails.
+        if self.server is None:
+            return
 
-        Returns:
-            tuple: A tuple containing the SMTP server instance and the email address.
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            self.server.close()
+        self.server = None
+
+    def keepalive(self):
+        """
+        Checks an idle connection with a NOOP, dropping it if the server has closed it so the next email reconnects.
         """
-        # Retrieve the email and app password from environment variables
-        email_address = os.getenv("EMAIL_ADDRESS")
-        password = os.getenv("PASSWORD")
-        
-        # Connect to Gmail's SMTP server
-        server = smtplib.SMTP("smtp.gmail.com: 587")
-        server.starttls()   # Upgrade the connection to a secure encrypted SSL/TLS connection
-        server.login(email_address, password)   # Log in to the email account using the credentials
+        with self.lock:
+            if self.server is None or time.monotonic() - self.last_used < self.keepalive_interval:
+                return
+
+            try:
+                code, _ = self.server.noop()
+                self.last_used = time.monotonic()
+                if code != 250:
+                    self.close()
+            except (smtplib.SMTPException, OSError):
+                self.server.close()
+                self.server = None
+
+    def send_message(self, message, recipients):
+        """
+        Sends a message over the persistent connection, reconnecting once if the server dropped it.
 
-        return server, email_address
-    
-    def send_email(self, subject, body, attachments=[]):
+        Args:
+            message (MIMEMultipart): The message to send.
+            recipients (list): The email addresses to send the message to.
+
+        Raises:
+            smtplib.SMTPException: If the server refused the message or could not be reached.
+            OSError: If the connection failed.
+        """
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.server is None:
+                        self.connect()
+                    self.server.sendmail(self.email_address, recipients, message.as_string())
+                    self.last_used = time.monotonic()
+                    return
+                except smtplib.SMTPServerDisconnected:
+                    # Idle sessions get dropped by the server, so open a new one and try again
+                    self.server = None
+                    if attempt:
+                        raise
+                except (smtplib.SMTPException, OSError):
+                    self.close()
+                    raise
+
+    def build_message(self, recipient, subject, body, attachments=[]):
         """
-        Sends an email with the specified subject, body, and image attachments.
+        Builds an email with the specified subject, body, and image attachments.
 
         Args:
+            recipient (str): The email address of the recipient.
             subject (str): The subject of the email.
             body (str): The body text of the email.
-            attachments (list): A list of file paths to attach to the email.
+            attachments (list): (filename, data) pairs of the images to attach.
+
+        Returns:
+            MIMEMultipart: The message.
         """
         # Create a multipart email message to include text and attachments
         message = MIMEMultipart()
         message["From"] = self.email_address
-        message["To"] = self.email_address
+        message["To"] = recipient
         message["Subject"] = subject
         message.attach(MIMEText(body, "plain")) # Attach the plain text body to the email
 
-        # Attach each image file from the attachments list
-        for attachment_path in attachments:
-            with open(attachment_path, "rb") as attachment:
-                img = MIMEImage(attachment.read())
-                img.add_header('Content-Disposition', 'attachment', filename=os.path.basename(attachment_path))
-                message.attach(img) # Attach the image to the email
+        # Attach each image
+        for filename, data in attachments:
+            img = MIMEImage(data)
+            img.add_header('Content-Disposition', 'attachment', filename=filename)
+            message.attach(img) # Attach the image to the email
 
-        # Send the email
-        self.server.sendmail(self.email_address, self.email_address, message.as_string())
-        print(f"Email sent with subject: {subject}")
+        return message
 
-    def send_motion_detected_email(self, objects_detected, current_time, preview_image_path, prediction_image_path):
+    def build_motion_detected_email(self, objects_detected, current_time):
         """
-        Sends a motion detected alert email with details about the detected objects.
+        Builds the subject and body of a motion detected alert with details about the detected objects.
 
         Args:
             objects_detected (list): A list of objects detected (e.g., ["person", "dog"]).
             current_time (str): The time when motion was detected.
-            preview_image_path (str): The file path of the preview image to attach.
-            prediction_image_path (str): The file path of the prediction image to attach.
+
+        Returns:
+            tuple: The subject and the body of the email.
         """
         # Define the subject line with the current time
         subject = f"Motion Detected - {current_time}"
@@ -94,5 +177,37 @@ class EmailAlert:
         MySentry
         """
 
-        # Send the email with the subject, body, and attached images
-        self.send_email(subject, body, [preview_image_path, prediction_image_path])
\ No newline at end of file
+        return subject, body
+
+    def build_digest_email(self, events):
+        """
+        Builds the subject and body of one alert summarising several motion detection events.
+
+        Args:
+            events (list): (current_time, objects_detected) pairs of the events, oldest first.
+
+        Returns:
+            tuple: The subject and the body of the email.
+        """
+        subject = f"Motion Detected - {len(events)} events from {events[0][0]} to {events[-1][0]}"
+
+        # List each event with the objects detected in it
+        event_details = "\n        ".join(f"{current_time}: {format_object_detected(objects_detected)}" for current_time, objects_detected in events)
+
+        body = f"""
+        Hello,
+
+        This is an automated alert to inform you that motion has been detected {len(events)} times.
+
+        Objects detected:
+        {event_details}
+
+        See the attached images for more details.
+
+        Please visit the dashboard to view the recorded clips.
+
+        Thank you,
+        MySentry
+        """
+
+        return subject, body
@@ -0,0 +1,378 @@
+import os
+import time
+import uuid
+import queue
+import threading
+import subprocess
+import cv2
+import logging
+import numpy as np
+from contextlib import contextmanager
+from video_handler import VideoHandler
+from log_utils import RATE_LIMITED
+from metrics import Histogram
+from utilities import format_object_detected
+from config import thumbnail_width, thumbnail_jpeg_quality
+from clip_metadata import get_thumbnail_path, build_clip_metadata, write_clip_metadata
+
+logger = logging.getLogger(__name__)
+
+EVENT_STAGE_SECONDS = Histogram("mysentry_event_stage_seconds", "Time spent on an event in each stage of the post-processing", ("stage",))
+
+class EventJob:
+    """
+    A finished motion detection clip waiting for post-processing.
+    """
+
+    def __init__(self, camera_id, clip_path, masked_clip_path, motion_detected_frames, start_time, end_time, regions=None, preview_image=None, tracks=None,
+                 object_tracker=None, pending_clips=None, masked_clip_frames=None, detection=None):
+        """
+        Initializes the job and gives the event its own identifier.
+
+        Args:
+            camera_id (str): The camera that recorded the clip.
+            clip_path (str): Path to the recorded clip.
+            masked_clip_path (str): Path to the masked clip used for object detection, or None in ROI mode.
+            motion_detected_frames (list): Indices of the frames where motion was detected.
+            start_time (datetime): The time the recording started.
+            end_time (datetime): The time the recording stopped.
+            regions (list, optional): (x, y, crop) tuples of the motion regions used for object detection in ROI mode.
+            preview_image (bytes, optional): JPEG of a frame from the middle of the event, kept in memory during the recording.
+            tracks (list, optional): Summaries of the distinct objects the camera's tracker followed during the event.
+            object_tracker (ObjectTracker, optional): The camera's tracker, told which objects the alert reported.
+            pending_clips (list, optional): The PendingClips of the clip and masked clip, still being finished by ffmpeg.
+            masked_clip_frames (list, optional): Positions of the motion frames in the masked clip, which starts at the trigger
+                and only holds the motion frames, so they differ from motion_detected_frames.
+            detection (InferenceResult, optional): The annotated full-frame detection run of the tracker that found the most objects,
+                used instead of running the detector again on the regions or the masked clip.
+        """
+        self.camera_id = camera_id
+        self.clip_path = clip_path
+        self.masked_clip_path = masked_clip_path
+        self.motion_detected_frames = motion_detected_frames
+        self.start_time = start_time
+        self.end_time = end_time
+        self.regions = regions
+        self.preview_image = preview_image
+        self.tracks = tracks or []
+        self.object_tracker = object_tracker
+        self.pending_clips = pending_clips or []
+        self.masked_clip_frames = masked_clip_frames or []
+        self.detection = detection
+
+        # Unique identifier so concurrent events are told apart in the logs and alert attachments
+        self.event_id = f"{start_time.strftime('%Y-%m-%d_%H-%M-%S')}_{camera_id}_{uuid.uuid4().hex[:8]}"
+        self.thumbnail_path = get_thumbnail_path(clip_path) # Poster kept next to the clip
+
+        self.preview = None # Frame from the middle of the event, decoded for the poster and the alert
+        self.prediction = None # Image annotated with the detected objects, for the alert
+
+        self.detections = [] # Structured detections (class, confidence, box) found in the event
+        self.objects_detected = [] # Labels of the objects detected in the event
+        self.timings = {} # Stage name -> time taken in seconds
+
+    @property
+    def temporary_files(self):
+        """
+        Lists the temporary files created while processing the event.
+
+        Returns:
+            list: Paths of the files to remove once the job is done.
+        """
+        return [path for path in (self.masked_clip_path,) if path]
+
+class EventProcessor:
+    """
+    A pool of worker threads that runs the post-event pipeline off the capture loop.
+    """
+
+    def __init__(self, alert_dispatcher, inference_service, catalog, workers=2, queue_size=8, submit_timeout=0.0, suppress_repeat_alerts=False):
+        """
+        Initializes the job queue and starts the worker threads.
+
+        Args:
+            alert_dispatcher (AlertDispatcher): The dispatcher that emails the alerts about events.
+            inference_service (InferenceService): The shared model used to recognise objects.
+            catalog (ClipCatalog): The clip catalog updated as clips are finalised.
+            workers (int): The number of worker threads.
+            queue_size (int): Maximum number of jobs waiting to be processed.
+            submit_timeout (float): How long submit() waits for room in a full queue, in seconds.
+            suppress_repeat_alerts (bool): Whether to skip the alert when every object tracked in the event was reported by an earlier alert.
+        """
+        self.alert_dispatcher = alert_dispatcher
+        self.inference_service = inference_service
+        self.catalog = catalog
+        self.submit_timeout = submit_timeout
+        self.suppress_repeat_alerts = suppress_repeat_alerts
+        self.jobs = queue.Queue(maxsize=queue_size)
+
+        self.lock = threading.Lock()
+        self.stage_timings = {} # Stage name -> [count, total seconds, maximum seconds]
+        self.jobs_submitted = 0 # Jobs accepted into the queue
+        self.jobs_rejected = 0 # Jobs refused because the queue was full
+        self.jobs_completed = 0 # Jobs processed successfully
+        self.jobs_failed = 0 # Jobs that raised an error
+        self.alerts_suppressed = 0 # Alerts skipped because their objects were already reported
+
+        # Start the worker threads
+        self.workers = [threading.Thread(target=self.run_worker, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, job):
+        """
+        Queues a job for post-processing without stalling the capture loop.
+
+        Args:
+            job (EventJob): The job to process.
+
+        Returns:
+            bool: True if the job was queued, False if the queue was full.
+        """
+        try:
+            if self.submit_timeout > 0:
+                self.jobs.put(job, timeout=self.submit_timeout)
+            else:
+                self.jobs.put_nowait(job)
+        except queue.Full:
+            # Apply backpressure by skipping the post-processing, the clip itself is kept
+            with self.lock:
+                self.jobs_rejected += 1
+
+            # The clip may still be finishing, so list it from another thread rather than waiting here
+            threading.Thread(target=self.skip_processing, args=(job,), daemon=True).start()
+            logger.warning("Event queue full, skipped post-processing clip=%s", job.clip_path, extra=RATE_LIMITED)
+            return False
+
+        with self.lock:
+            self.jobs_submitted += 1
+        return True
+
+    def skip_processing(self, job):
+        """
+        Finishes a clip whose post-processing was skipped and still lists it on the clips page, without its detected objects.
+
+        Args:
+            job (EventJob): The rejected job.
+        """
+        try:
+            self.finish_clips(job)
+        finally:
+            self.remove_temporary_files(job)
+        self.catalog.add_clip(build_clip_metadata(job.clip_path, job.camera_id, job.start_time, job.end_time, []))
+
+    def run_worker(self):
+        """
+        Takes jobs from the queue and processes them until the process exits.
+        """
+        while True:
+            job = self.jobs.get()
+            try:
+                self.process(job)
+                with self.lock:
+                    self.jobs_completed += 1
+            except Exception:
+                with self.lock:
+                    self.jobs_failed += 1
+                logger.exception("Failed to process event=%s", job.event_id)
+            finally:
+                self.remove_temporary_files(job)
+                self.jobs.task_done()
+
+    def process(self, job):
+        """
+        Runs the post-event stages for a finished clip.
+
+        Args:
+            job (EventJob): The job to process.
+        """
+        # Wait for ffmpeg to write the end of the clips, which the capture loop no longer waits for
+        with self.time_stage(job, "finalize"):
+            self.finish_clips(job)
+
+        # Move the moov atom to the front of the clip so playback and seeking start without downloading it
+        with self.time_stage(job, "faststart"):
+            try:
+                VideoHandler.apply_faststart(job.clip_path)
+            except (OSError, subprocess.CalledProcessError) as error:
+                # The clip still plays without it, so carry on with the alert
+                logger.warning("Failed to apply faststart clip=%s error=%s", job.clip_path, error)
+
+        # Decode the preview frame kept in memory and save the clip's poster from it
+        with self.time_stage(job, "preview"):
+            self.load_preview(job)
+            self.save_thumbnail(job)
+
+        # Detect objects and keep the annotated prediction image
+        with self.time_stage(job, "detection"):
+            if job.detection is not None:
+                # The tracker already ran the detector on full frames during the event, so reuse its best run
+                job.detections = list(job.detection.detections)
+                job.prediction = job.detection.annotated_image
+            elif job.regions:
+                self.detect_objects_in_regions(job)
+            else:
+                self.detect_objects_in_masked_clip(job)
+            # Report each tracked object once, rather than whatever a single frame shows
+            if job.tracks:
+                job.objects_detected = [track["class_name"] for track in job.tracks]
+            else:
+                job.objects_detected = [detection.class_name for detection in job.detections]
+
+        # Store the event metadata in a sidecar next to the clip, without touching the video file
+        with self.time_stage(job, "metadata"):
+            thumbnail = os.path.basename(job.thumbnail_path) if os.path.exists(job.thumbnail_path) else None
+            metadata = build_clip_metadata(job.clip_path, job.camera_id, job.start_time, job.end_time, job.detections, thumbnail, job.tracks)
+            write_clip_metadata(job.clip_path, metadata)
+
+        # Index the finished clip so the clips page can list it without scanning the folder
+        with self.time_stage(job, "catalog"):
+            self.catalog.add_clip(metadata)
+
+        # Queue an email alert with the motion detection results, sent in the background
+        with self.time_stage(job, "alert"):
+            if self.suppress_repeat_alerts and job.tracks and all(track["alerted"] for track in job.tracks):
+                # The same objects (e.g., a parked car) were already reported, the clip is still kept
+                with self.lock:
+                    self.alerts_suppressed += 1
+                logger.info("Suppressed repeat alert event=%s objects=%s", job.event_id, format_object_detected(job.objects_detected))
+            else:
+                images = [(f"{job.event_id}_{name}", image) for name, image in (("preview", job.preview), ("prediction", job.prediction)) if image is not None]
+                # Only count the objects as reported once the dispatcher took the alert
+                if self.alert_dispatcher.submit(job.objects_detected, job.start_time, images) and job.object_tracker is not None:
+                    job.object_tracker.mark_alerted([track["track_id"] for track in job.tracks])
+
+        timings = " ".join(f"{stage}={seconds:.3f}s" for stage, seconds in job.timings.items())
+        logger.info("Processed event=%s objects=%d %s", job.event_id, len(job.objects_detected), timings)
+
+    @staticmethod
+    def finish_clips(job):
+        """
+        Waits for the recorders to finish the clips of the event.
+
+        Args:
+            job (EventJob): The job being processed.
+        """
+        for clip in job.pending_clips:
+            clip.finish()
+
+    @staticmethod
+    def load_preview(job):
+        """
+        Decodes the preview frame kept in memory during the recording.
+
+        Args:
+            job (EventJob): The job being processed.
+        """
+        if job.preview_image is not None:
+            job.preview = cv2.imdecode(np.frombuffer(job.preview_image, dtype=np.uint8), cv2.IMREAD_COLOR)
+        else:
+            # Events recorded without a preview in memory fall back to reading the middle motion frame from the clip
+            frame_number = job.motion_detected_frames[len(job.motion_detected_frames) // 2]
+            job.preview = VideoHandler.get_frame_from_clip(job.clip_path, frame_number)
+
+    @staticmethod
+    def save_thumbnail(job):
+        """
+        Writes a small poster of the clip for the clips page.
+
+        Args:
+            job (EventJob): The job being processed.
+        """
+        if job.preview is None:
+            return
+
+        # Downscale the frame to the poster width, keeping the aspect ratio
+        frame = job.preview
+        frame_height, frame_width = frame.shape[:2]
+        if frame_width > thumbnail_width:
+            frame = cv2.resize(frame, (thumbnail_width, max(1, round(frame_height * thumbnail_width / frame_width))), interpolation=cv2.INTER_AREA)
+        cv2.imwrite(job.thumbnail_path, frame, [cv2.IMWRITE_JPEG_QUALITY, thumbnail_jpeg_quality])
+
+    def detect_objects_in_regions(self, job):
+        """
+        Runs the detector on the motion regions cropped during the event, in one batch.
+
+        Args:
+            job (EventJob): The job being processed.
+        """
+        results = self.inference_service.detect_batch([crop for _, _, crop in job.regions], annotate=True)
+
+        # Move the boxes from crop coordinates back to frame coordinates
+        for (x, y, _), result in zip(job.regions, results):
+            for detection in result.detections:
+                x1, y1, x2, y2 = detection.box
+                job.detections.append(detection._replace(box=(x1 + x, y1 + y, x2 + x, y2 + y)))
+
+        # Use the annotated crop with the most detections as the prediction image
+        best = max(results, key=lambda result: len(result.detections))
+        job.prediction = best.annotated_image
+
+    def detect_objects_in_masked_clip(self, job):
+        """
+        Runs the detector on the middle frame of the masked clip, read straight into memory.
+
+        Args:
+            job (EventJob): The job being processed.
+        """
+        frame_number = job.masked_clip_frames[len(job.masked_clip_frames) // 2]
+        masked_frame = VideoHandler.get_frame_from_clip(job.masked_clip_path, frame_number)
+
+        result = self.inference_service.detect(masked_frame, annotate=True)
+        job.detections = list(result.detections)
+        job.prediction = result.annotated_image
+
+    @contextmanager
+    def time_stage(self, job, stage):
+        """
+        Measures how long a stage of the pipeline takes.
+
+        Args:
+            job (EventJob): The job being processed.
+            stage (str): The name of the stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            job.timings[stage] = elapsed
+            EVENT_STAGE_SECONDS.observe(elapsed, stage=stage)
+
+            # Aggregate the timing across all jobs
+            with self.lock:
+                count, total, maximum = self.stage_timings.get(stage, [0, 0.0, 0.0])
+                self.stage_timings[stage] = [count + 1, total + elapsed, max(maximum, elapsed)]
+
+    @staticmethod
+    def remove_temporary_files(job):
+        """
+        Deletes the temporary files created for a job.
+
+        Args:
+            job (EventJob): The processed job.
+        """
+        for path in job.temporary_files:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def stats(self):
+        """
+        Returns the queue counters and the per-stage timings.
+
+        Returns:
+            dict: Job counts, queue depth and the average and maximum time of each stage.
+        """
+        with self.lock:
+            return {
+                "queue_depth": self.jobs.qsize(),
+                "jobs_submitted": self.jobs_submitted,
+                "jobs_rejected": self.jobs_rejected,
+                "jobs_completed": self.jobs_completed,
+                "jobs_failed": self.jobs_failed,
+                "alerts_suppressed": self.alerts_suppressed,
+                "stages": {
+                    stage: {"count": count, "average_seconds": total / count, "maximum_seconds": maximum}
+                    for stage, (count, total, maximum) in self.stage_timings.items()
+                },
+            }
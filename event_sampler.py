@@ -0,0 +1,61 @@
+class EventSampler:
+    """
+    Keeps a bounded, evenly spread sample of items taken over a motion detection event.
+    """
+
+    def __init__(self, limit=8):
+        """
+        Initializes an empty sampler.
+
+        Args:
+            limit (int): Maximum number of samples kept in memory.
+        """
+        self.limit = limit
+        self.samples = [] # (frame number, item) pairs in the order they were taken
+        self.stride = 1 # Only every stride-th offer is sampled
+        self.offers = 0 # Number of offers since the sampler was cleared
+
+    def offer(self):
+        """
+        Counts a candidate frame and tells the caller whether to sample it.
+        Call add() only when this returns True, so frames that are not kept cost nothing.
+
+        Returns:
+            bool: True if the candidate frame should be sampled.
+        """
+        self.offers += 1
+        return (self.offers - 1) % self.stride == 0
+
+    def add(self, frame_number, item):
+        """
+        Stores a sample, thinning out the stored samples when the limit is reached.
+
+        Args:
+            frame_number (int): The index of the sampled frame in the clip.
+            item: The data kept for the frame.
+        """
+        self.samples.append((frame_number, item))
+
+        # Keep every other sample and sample half as often, so the samples stay spread over the whole event
+        if len(self.samples) > self.limit:
+            self.samples = self.samples[::2]
+            self.stride *= 2
+
+    def middle(self):
+        """
+        Returns the sample taken closest to the middle of the event.
+
+        Returns:
+            tuple: The frame number and the item, or None if nothing was sampled.
+        """
+        if not self.samples:
+            return None
+        return self.samples[len(self.samples) // 2]
+
+    def clear(self):
+        """
+        Forgets all samples before the next event.
+        """
+        self.samples = []
+        self.stride = 1
+        self.offers = 0
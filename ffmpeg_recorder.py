@@ -0,0 +1,310 @@
+import queue
+import logging
+import tempfile
+import threading
+import subprocess
+from video_handler import VideoHandler
+from metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+FRAMES_DUPLICATED = Counter("mysentry_recorder_frames_duplicated_total", "Frames repeated to fill gaps in the capture", ("camera",))
+FRAMES_SKIPPED = Counter("mysentry_recorder_frames_skipped_total", "Frames dropped because they arrived faster than the recorded frame rate", ("camera",))
+RECORDING_FAILURES = Counter("mysentry_recording_failures_total", "Clips ffmpeg failed to record", ("camera",))
+
+class PendingClip:
+    """
+    A clip whose recording has stopped while ffmpeg may still be encoding its last frames and writing the file.
+    """
+
+    def __init__(self, camera_id, filename, fps, process, errors, frames, writer_thread, frames_duplicated, frames_skipped):
+        """
+        Takes over the ffmpeg process of a clip and the thread feeding it.
+
+        Args:
+            camera_id (str): The camera that recorded the clip.
+            filename (str): Path to the clip.
+            fps (float): The frame rate the clip is recorded at.
+            process (subprocess.Popen): The ffmpeg process of the clip.
+            errors (file): The temporary file receiving ffmpeg's error output.
+            frames (queue.Queue): The queue of (data, repeats) pairs still being written to ffmpeg.
+            writer_thread (threading.Thread): The thread feeding the queue to ffmpeg.
+            frames_duplicated (int): Frames repeated to fill gaps in the capture.
+            frames_skipped (int): Frames dropped because their slot was already filled.
+        """
+        self.camera_id = camera_id
+        self.filename = filename
+        self.fps = fps
+        self.process = process
+        self.errors = errors
+        self.frames = frames
+        self.writer_thread = writer_thread
+        self.frames_duplicated = frames_duplicated
+        self.frames_skipped = frames_skipped
+        self.succeeded = None # Whether ffmpeg finished the clip, None until finish() returns
+        self.lock = threading.Lock()
+
+    def finish(self):
+        """
+        Writes the remaining frames and waits for ffmpeg to finish the clip. Calling it again returns the same result.
+
+        Returns:
+            bool: True if ffmpeg finished the clip, False if it failed.
+        """
+        with self.lock:
+            if self.succeeded is not None:
+                return self.succeeded
+
+            self.frames.put(None)
+            self.writer_thread.join()
+
+            # Closing stdin tells ffmpeg the input has ended
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+            self.succeeded = self.process.wait() == 0
+
+            if not self.succeeded:
+                self.errors.seek(0)
+                RECORDING_FAILURES.inc(camera=self.camera_id)
+                logger.error("FFmpeg failed to record clip=%s error=%s", self.filename, self.errors.read().decode(errors='replace').strip())
+            elif self.frames_duplicated or self.frames_skipped:
+                FRAMES_DUPLICATED.inc(self.frames_duplicated, camera=self.camera_id)
+                FRAMES_SKIPPED.inc(self.frames_skipped, camera=self.camera_id)
+                logger.info("Recorded clip=%s fps=%.1f repeated=%d skipped=%d", self.filename, self.fps, self.frames_duplicated, self.frames_skipped)
+
+            self.errors.close()
+            return self.succeeded
+
+class FFmpegRecorder(VideoHandler):
+    """
+    A recorder that streams frames into a long-lived ffmpeg process, so clips are encoded off the capture loop.
+    """
+
+    def __init__(self, camera_id=None, codec="libx264", preset="veryfast", crf=23, threads=0, max_fps=30.0, queue_bytes=64 * 1024 * 1024):
+        """
+        Initializes the recorder with its encoder settings.
+
+        Args:
+            camera_id (str, optional): The camera recorded by this recorder, added to the clip filenames.
+            codec (str): The ffmpeg video encoder, e.g. "libx264", or a hardware encoder such as "h264_nvenc".
+            preset (str, optional): The encoder preset, trading encoding speed for file size. None uses the encoder default.
+            crf (int, optional): The constant rate factor, lower is better quality. None uses the encoder default.
+            threads (int): The number of encoder threads, 0 lets ffmpeg choose.
+            max_fps (float): Highest frame rate recorded, faster cameras have frames skipped.
+            queue_bytes (int): Memory the frames waiting to be written to ffmpeg may take, at least 2 frames are queued whatever their size.
+        """
+        super().__init__(camera_id)
+        self.codec = codec
+        self.preset = preset
+        self.crf = crf
+        self.threads = threads
+        self.max_fps = max_fps
+        self.queue_bytes = queue_bytes
+
+        self.input_fps = None # Frame rate the frames arrive at, which can be above the recorded frame rate
+        self.process = None # The ffmpeg process of the current clip
+        self.errors = None # Temporary file receiving ffmpeg's error output
+        self.frames = None # Queue of (data, repeats) waiting for the writer thread
+        self.writer_thread = None # Thread feeding the queued data to ffmpeg
+        self.first_timestamp = None # Capture time of the first frame of the clip
+        self.frames_duplicated = 0 # Frames repeated to fill gaps in the capture
+        self.frames_skipped = 0 # Frames dropped because their slot was already filled
+
+    def initialize_recording(self, frame, filename=None, fps=None):
+        """
+        Starts an ffmpeg process encoding raw frames into a new clip.
+
+        Args:
+            frame (numpy.ndarray): The first frame of the video, used to determine frame size.
+            filename (str, optional): The name of the video file. Defaults to a timestamped filename.
+            fps (float, optional): The measured frame rate of the camera. Defaults to the last frame rate used.
+        """
+        self.input_fps = fps or self.input_fps
+        self.start_clip(filename, min(fps, self.max_fps) if fps else None)
+        frame_height, frame_width = frame.shape[:2]
+
+        # FFmpeg command reading BGR frames from stdin and encoding them with the configured encoder
+        cmd = [
+            "ffmpeg",
+            "-y",
+            "-loglevel", "error",
+            "-f", "rawvideo", # Input is raw frames
+            "-pix_fmt", "bgr24", # In OpenCV's pixel format
+            "-s", f"{frame_width}x{frame_height}", # With the camera's frame size
+            "-framerate", str(self.fps), # At the camera's frame rate
+            "-i", "-", # Read from stdin
+            "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", # Even dimensions, as required by yuv420p
+            "-c:v", self.codec,
+        ]
+        if self.preset:
+            cmd += ["-preset", self.preset]
+        if self.crf is not None:
+            cmd += ["-crf", str(self.crf)]
+        cmd += [
+            "-threads", str(self.threads),
+            "-pix_fmt", "yuv420p", # Pixel format supported by browsers
+            "-movflags", "+faststart", # Write the moov atom at the front for streaming playback
+            self.filename
+        ]
+
+        self.start_process(cmd, max(2, self.queue_bytes // frame.nbytes))
+
+    @property
+    def maximum_fps(self):
+        """
+        Calculates the maximum number of incoming frames based on the camera's frame rate and maximum duration.
+
+        Returns:
+            float: The maximum number of frames allowed for the recording.
+        """
+        return (self.input_fps or self.fps) * self.maximum_duration
+
+    def initialize_passthrough(self, input_format="h264", filename=None, fps=None):
+        """
+        Starts an ffmpeg process copying compressed camera packets into a new clip, without re-encoding them.
+
+        Args:
+            input_format (str): The format of the packets, "h264" or "hevc" Annex B elementary streams.
+            filename (str, optional): The name of the video file. Defaults to a timestamped filename.
+            fps (float, optional): The measured frame rate of the camera. Defaults to the last frame rate used.
+        """
+        self.start_clip(filename, fps)
+
+        # FFmpeg command reading the elementary stream from stdin and remuxing it into an mp4
+        cmd = [
+            "ffmpeg",
+            "-y",
+            "-loglevel", "error",
+            "-f", input_format, # Input is an elementary stream
+            "-framerate", str(self.fps), # At the camera's frame rate
+            "-i", "-", # Read from stdin
+            "-c", "copy", # Copy the packets without re-encoding
+            "-movflags", "+faststart", # Write the moov atom at the front for streaming playback
+            self.filename
+        ]
+
+        # Packets are small and bounded by the clip length, so they never wait for room,
+        # which keeps the packet reader from stalling on ffmpeg while it holds the source's lock
+        self.start_process(cmd, queue_size=0)
+
+    def start_process(self, cmd, queue_size):
+        """
+        Starts the ffmpeg process and the thread that feeds it.
+
+        Args:
+            cmd (list): The ffmpeg command.
+            queue_size (int): Maximum number of items waiting for the writer thread, 0 for no limit.
+        """
+        # Collect ffmpeg's errors in a file, a pipe nobody reads could fill up and stall the encoder
+        self.errors = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.errors)
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.first_timestamp = None
+        self.frames_placed = 0
+        self.frames_duplicated = 0
+        self.frames_skipped = 0
+
+        self.writer_thread = threading.Thread(target=self.run_writer, args=(self.process, self.frames), daemon=True)
+        self.writer_thread.start()
+
+    def write_frame(self, frame, timestamp=None):
+        """
+        Queues a frame for encoding, placed on the clip's timeline by its capture time.
+        Frames are repeated to fill gaps in the capture, up to a second, and skipped when they arrive faster than the frame rate,
+        so the clip plays back in real time. The frame must not be modified once it is queued.
+
+        Args:
+            frame (numpy.ndarray): The frame to write to the video.
+            timestamp (float, optional): The capture time of the frame in seconds. Without it, frames are written one after the other.
+        """
+        repeats = 1
+        if timestamp is not None:
+            if self.first_timestamp is None:
+                self.first_timestamp = timestamp
+
+            # Work out which frame slot the capture time falls in
+            slot = round((timestamp - self.first_timestamp) * self.fps)
+            repeats = slot - self.frames_placed + 1
+
+            # Fill a long gap in the capture (e.g. a stalled stream or a clock jump) with a second of video at most,
+            # moving the rest of the clip's timeline back so the frames after it are not repeated too
+            max_repeats = max(1, round(self.fps))
+            if repeats > max_repeats:
+                self.first_timestamp += (repeats - max_repeats) / self.fps
+                repeats = max_repeats
+
+            if repeats < 1:
+                self.frames_skipped += 1
+                return
+            self.frames_duplicated += repeats - 1
+
+        self.frames_placed += repeats
+        self.frames.put((frame, repeats))
+
+    def write_packet(self, packet):
+        """
+        Queues a compressed packet for a clip started with initialize_passthrough(), without waiting for ffmpeg.
+
+        Args:
+            packet (bytes): The packet data, as an Annex B access unit.
+        """
+        self.frames.put((packet, 1))
+
+    @staticmethod
+    def run_writer(process, frames):
+        """
+        Writes the queued frames to ffmpeg's stdin until the end of the clip.
+
+        Args:
+            process (subprocess.Popen): The ffmpeg process of the clip.
+            frames (queue.Queue): The queue of (data, repeats) pairs, ended by None.
+        """
+        failed = False
+        while True:
+            item = frames.get()
+            if item is None:
+                break
+
+            # Keep emptying the queue after a failure so the capture loop never blocks on it
+            if failed:
+                continue
+
+            data, repeats = item
+            try:
+                for _ in range(repeats):
+                    process.stdin.write(data)
+            except OSError:
+                failed = True
+
+    def is_recording(self):
+        """
+        Checks whether a recording is in progress.
+
+        Returns:
+            bool: True if an ffmpeg process is open, False otherwise.
+        """
+        return self.process is not None
+
+    def stop_recording(self, wait=True):
+        """
+        Ends the clip. The queued frames, the encoder's flush and the faststart pass can take a while,
+        so without waiting they are left to the returned PendingClip and the recorder is free for the next clip straight away.
+
+        Args:
+            wait (bool): Whether to wait for ffmpeg to finish the clip.
+
+        Returns:
+            PendingClip: The clip being finished.
+        """
+        clip = PendingClip(self.camera_id, self.filename, self.fps, self.process, self.errors, self.frames, self.writer_thread,
+                           self.frames_duplicated, self.frames_skipped)
+        if wait:
+            clip.finish()
+
+        self.process = None
+        self.errors = None
+        self.frames = None
+        self.writer_thread = None
+        return clip
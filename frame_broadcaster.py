@@ -0,0 +1,152 @@
+import queue
+import threading
+import cv2
+
+class FrameBroadcaster:
+    """
+    A single producer that JPEG-encodes each frame once and fans the bytes out to every client.
+    """
+
+    def __init__(self, queue_size=2, jpeg_quality=80):
+        """
+        Initializes the broadcaster with no subscribers.
+
+        Args:
+            queue_size (int): Number of encoded frames each client may fall behind before frames are dropped.
+            jpeg_quality (int): JPEG quality of the streamed frames (0-100).
+        """
+        self.queue_size = queue_size
+        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+        self.subscribers = {} # Subscriber id -> queue of encoded frames
+        self.next_subscriber_id = 0 # Identifier handed out to the next subscriber
+        self.frames_published = 0 # Frames handed to the broadcaster
+        self.frames_encoded = 0 # Frames actually encoded, skipped when nobody is watching
+        self.frames_dropped = 0 # Encoded frames dropped because a client was too slow
+        self.closed = False # Set once the producer stops
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        """
+        Registers a new client.
+
+        Returns:
+            tuple: The subscriber id and the queue the encoded frames are delivered to.
+        """
+        with self.lock:
+            subscriber_id = self.next_subscriber_id
+            self.next_subscriber_id += 1
+            self.subscribers[subscriber_id] = queue.Queue(maxsize=self.queue_size)
+            return subscriber_id, self.subscribers[subscriber_id]
+
+    def unsubscribe(self, subscriber_id):
+        """
+        Unregisters a client.
+
+        Args:
+            subscriber_id (int): The id returned by subscribe().
+        """
+        with self.lock:
+            self.subscribers.pop(subscriber_id, None)
+
+    def publish(self, frame):
+        """
+        Encodes a frame once and delivers it to every client without ever blocking.
+
+        Args:
+            frame (numpy.ndarray): The processed frame.
+        """
+        with self.lock:
+            self.frames_published += 1
+            subscribers = list(self.subscribers.values())
+
+        # Skip the encode entirely when nobody is watching
+        if not subscribers:
+            return
+
+        # Encode the frame as JPEG once for all clients
+        _, buffer = cv2.imencode('.jpg', frame, self.encode_params)
+        data = (b'--frame\r\n'
+                b'Content-Type: image/jpeg\r\n\r\n' + buffer.tobytes() + b'\r\n')
+
+        # Deliver the same bytes to every client
+        dropped = sum(self.put_latest(subscriber, data) for subscriber in subscribers)
+
+        with self.lock:
+            self.frames_encoded += 1
+            self.frames_dropped += dropped
+
+    @staticmethod
+    def put_latest(subscriber, item):
+        """
+        Adds an item to a client's queue, dropping the oldest item if the client is too slow.
+
+        Args:
+            subscriber (queue.Queue): The client's queue.
+            item (bytes): The item to deliver.
+
+        Returns:
+            int: The number of items dropped to make room.
+        """
+        dropped = 0
+        while True:
+            try:
+                subscriber.put_nowait(item)
+                return dropped
+            except queue.Full:
+                # Make room by discarding the oldest frame, the client only needs the latest
+                try:
+                    subscriber.get_nowait()
+                    dropped += 1
+                except queue.Empty:
+                    pass
+
+    def close(self):
+        """
+        Marks the broadcaster as closed and tells every client the stream has ended.
+        """
+        with self.lock:
+            self.closed = True
+            subscribers = list(self.subscribers.values())
+
+        for subscriber in subscribers:
+            self.put_latest(subscriber, None)
+
+    def stream(self):
+        """
+        Streams the encoded frames to a client using a multipart response.
+
+        Yields:
+            bytes: Encoded video frames to be streamed to the client.
+        """
+        subscriber_id, frames = self.subscribe()
+
+        try:
+            while not self.closed:
+                try:
+                    data = frames.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+
+                # A None item marks the end of the stream
+                if data is None:
+                    break
+
+                yield data
+        finally:
+            # Unregister the client when it disconnects
+            self.unsubscribe(subscriber_id)
+
+    def stats(self):
+        """
+        Returns the broadcaster counters.
+
+        Returns:
+            dict: Frames published, encoded and dropped, plus the number of clients.
+        """
+        with self.lock:
+            return {
+                "clients": len(self.subscribers),
+                "frames_published": self.frames_published,
+                "frames_encoded": self.frames_encoded,
+                "frames_dropped": self.frames_dropped,
+            }
@@ -0,0 +1,161 @@
+import threading
+import numpy as np
+
+# Policies applied when a consumer falls behind the capture thread
+DROP_OLDEST = "oldest" # Overwrite the oldest frame, lagging readers resume from the oldest frame still held
+DROP_NEWEST = "newest" # Refuse incoming frames until the slowest reader has caught up
+SKIP_TO_LATEST = "latest" # Overwrite the oldest frame, lagging readers jump straight to the newest frame
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST, SKIP_TO_LATEST)
+
+class FrameBuffer:
+    """
+    A fixed-size ring buffer of preallocated frames shared between one producer and many readers.
+    """
+
+    def __init__(self, capacity=8, drop_policy=DROP_OLDEST):
+        """
+        Initializes an empty frame buffer.
+
+        Args:
+            capacity (int): The number of frame slots in the buffer.
+            drop_policy (str): What to drop when a reader falls behind ("oldest", "newest" or "latest").
+        """
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy: {drop_policy}")
+
+        self.capacity = capacity # Number of frame slots
+        self.drop_policy = drop_policy # Policy applied when a reader falls behind
+        self.frames = None # Preallocated frame slots, allocated once the frame size is known
+        self.timestamps = [0.0] * capacity # Capture time of the frame held in each slot
+        self.next_sequence = 0 # Sequence number of the next frame to be written
+        self.readers = {} # Reader id -> sequence number of the next frame the reader expects
+        self.reader_dropped = {} # Reader id -> number of frames the reader skipped
+        self.next_reader_id = 0 # Identifier handed out to the next reader
+        self.frames_written = 0 # Total number of frames written into the buffer
+        self.frames_dropped = 0 # Incoming frames refused by the "newest" policy
+        self.frames_skipped = 0 # Frames skipped by readers that fell behind
+        self.closed = False # Set once the producer stops
+        self.condition = threading.Condition()
+
+    def put(self, frame, timestamp):
+        """
+        Copies a frame into the next slot of the buffer.
+
+        Args:
+            frame (numpy.ndarray): The captured frame.
+            timestamp (float): The capture time of the frame in seconds.
+
+        Returns:
+            bool: True if the frame was stored, False if it was dropped.
+        """
+        with self.condition:
+            # Allocate the slots on the first frame, or again if the camera resolution changes
+            if self.frames is None or self.frames.shape[1:] != frame.shape or self.frames.dtype != frame.dtype:
+                self.frames = np.empty((self.capacity,) + frame.shape, dtype=frame.dtype)
+
+                # Frames held in the old slots are gone, so move every reader to the next frame
+                for reader_id in self.readers:
+                    self.readers[reader_id] = self.next_sequence
+
+            # Drop the incoming frame if the slowest reader has not caught up yet
+            if self.drop_policy == DROP_NEWEST and self.readers:
+                if self.next_sequence - min(self.readers.values()) >= self.capacity:
+                    self.frames_dropped += 1
+                    return False
+
+            # Copy the frame into its slot without allocating a new array
+            slot = self.next_sequence % self.capacity
+            np.copyto(self.frames[slot], frame)
+            self.timestamps[slot] = timestamp
+            self.next_sequence += 1
+            self.frames_written += 1
+
+            # Wake up the readers waiting for a new frame
+            self.condition.notify_all()
+            return True
+
+    def add_reader(self):
+        """
+        Registers a new reader that starts from the next frame written.
+
+        Returns:
+            int: The reader id used with read() and remove_reader().
+        """
+        with self.condition:
+            reader_id = self.next_reader_id
+            self.next_reader_id += 1
+            self.readers[reader_id] = self.next_sequence
+            self.reader_dropped[reader_id] = 0
+            return reader_id
+
+    def remove_reader(self, reader_id):
+        """
+        Unregisters a reader so it no longer holds back the "newest" policy.
+
+        Args:
+            reader_id (int): The id returned by add_reader().
+        """
+        with self.condition:
+            self.readers.pop(reader_id, None)
+            self.reader_dropped.pop(reader_id, None)
+
+    def read(self, reader_id, timeout=None):
+        """
+        Returns a copy of the next frame for a reader, waiting for one if necessary.
+
+        Args:
+            reader_id (int): The id returned by add_reader().
+            timeout (float, optional): Maximum time to wait for a frame in seconds.
+
+        Returns:
+            tuple: The frame and its capture timestamp, or None on timeout or once the buffer is closed.
+        """
+        with self.condition:
+            # Wait until a frame the reader has not seen yet is available
+            has_frame = self.condition.wait_for(
+                lambda: self.closed or self.readers[reader_id] < self.next_sequence, timeout)
+            if not has_frame or self.readers[reader_id] >= self.next_sequence:
+                return None
+
+            # Pick the frame to hand out depending on the drop policy
+            cursor = self.readers[reader_id]
+            oldest_sequence = max(0, self.next_sequence - self.capacity)
+            if self.drop_policy == SKIP_TO_LATEST:
+                sequence = self.next_sequence - 1
+            else:
+                sequence = max(cursor, oldest_sequence)
+
+            # Count the frames the reader missed because it fell behind
+            skipped = sequence - cursor
+            self.reader_dropped[reader_id] += skipped
+            self.frames_skipped += skipped
+
+            # Copy the frame out so the slot can be overwritten while the reader works on it
+            slot = sequence % self.capacity
+            self.readers[reader_id] = sequence + 1
+            return self.frames[slot].copy(), self.timestamps[slot]
+
+    def close(self):
+        """
+        Marks the buffer as closed and wakes up all waiting readers.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def stats(self):
+        """
+        Returns the buffer counters.
+
+        Returns:
+            dict: Frames written, dropped and skipped, plus the number of readers.
+        """
+        with self.condition:
+            return {
+                "capacity": self.capacity,
+                "drop_policy": self.drop_policy,
+                "frames_written": self.frames_written,
+                "frames_dropped": self.frames_dropped,
+                "frames_skipped": self.frames_skipped,
+                "readers": len(self.readers),
+            }
@@ -1,125 +1,300 @@
+import os
+import time
 import cv2
 import config
+import logging
+from datetime import datetime
 from config import temp_folder_path
-from email_alert import EmailAlert
-from video_handler import VideoHandler
+from event_sampler import EventSampler
 from motion_detector import MotionDetector
+from event_processor import EventJob
+from log_utils import RATE_LIMITED
+from metrics import Counter, Histogram
 
-# Initialize necessary classes
-email_alert = EmailAlert()
-motion_detector = MotionDetector()
-video_handler = VideoHandler()
-video_handler_masked = VideoHandler()
+logger = logging.getLogger(__name__)
 
-def generate_frames(video_capture):
+FRAME_STAGE_SECONDS = Histogram("mysentry_frame_stage_seconds", "Time spent on a frame in each stage of the camera pipeline", ("camera", "stage"))
+FRAMES_PROCESSED = Counter("mysentry_frames_processed_total", "Frames processed by the camera pipeline", ("camera",))
+MOTION_FRAMES = Counter("mysentry_motion_frames_total", "Frames with valid motion", ("camera",))
+RECORDINGS = Counter("mysentry_recordings_total", "Clips started on motion", ("camera",))
+TRACKS_STARTED = Counter("mysentry_tracks_started_total", "Distinct objects the tracker started following", ("camera", "class_name"))
+
+def generate_frames(camera):
     """
-    Generates frames from the video capture and processes them for motion detection.
+    Generates frames from the camera's frame buffer and processes them for motion detection.
 
     Args:
-        video_capture (cv2.VideoCapture): Video capture object.
+        camera (Camera): The camera whose frames are processed.
 
     Yields:
-        bytes: Encoded video frames to be streamed to the client.
+        numpy.ndarray: The processed frames, with the detected motion drawn on them.
     """
+    camera_id = camera.camera_id
+    frame_buffer = camera.frame_buffer
+    motion_detector = camera.motion_detector
+    video_handler = camera.video_handler
+    video_handler_masked = camera.video_handler_masked
+    object_tracker = camera.object_tracker
+
     frame_count = 0 # Counter for the number of frames processed
     recording = False # Flag to indicate if recording is in progres
     no_motion_frame_count = 0  # Counter for consecutive frames without motion
-    no_motion_threshold = 60  # Threshold before stopping the recording in frames
+    no_motion_threshold = config.no_motion_threshold  # Threshold before stopping the recording in frames
     motion_detected_frames = [] # List to track frames where motion was detected
+    masked_clip_frames = [] # Positions in the masked clip of the motion frames written to it, which skips the pre-roll and still frames
     motion_detected = False # Flag to indicate if motion is detected in frame
+    roi_mode = config.object_detection_mode == "roi" # Detect objects on crops instead of a masked video
+    passthrough = camera.packet_source is not None # Cut the clips from the camera's compressed stream
+    region_sampler = EventSampler(config.roi_sample_limit) # Crops of the motion regions taken during the event
+    preview_sampler = EventSampler(config.roi_sample_limit) # JPEGs of motion frames, for the preview image and poster
+    preview_params = [cv2.IMWRITE_JPEG_QUALITY, config.preview_jpeg_quality]
+    tracking = config.tracking_stride > 0 # Follow the objects detected on every tracking_stride-th frame of an event
+    pending_detection = None # (future, capture time) of the detection running on a frame of the event
+    next_detection_frame = 0 # Frame count at which the next detection is started
+    stationary_checks = 0 # Detection runs in a row that found only objects from before the event, none of them moving
+    event_detection = None # The tracking detection run of the event that found the most objects, reused for the clip
 
-    while video_capture.isOpened():
-        # Read a frame from the video
-        success, frame = video_capture.read()
+    # Register as a reader so the camera's pipeline pulls frames at its own rate
+    reader_id = frame_buffer.add_reader()
 
-        if not success:
-            break
+    try:
+        while True:
+            # Wait for the next frame from the capture worker
+            item = frame_buffer.read(reader_id, timeout=1.0)
 
-        if config.motion_detection_active:
-            # Detect motion by analyzing the current frame
-            contours = motion_detector.detect_motion(frame)
-            motion_detected = False
+            if item is None:
+                # Stop once the capture worker has closed the buffer, otherwise keep waiting
+                if frame_buffer.closed:
+                    break
+                continue
 
-            for contour in contours:
-                # Check if the detected contour is valid (not too small/big or in an exclusion zone)
-                if motion_detector.is_valid_contour(frame, contour):
-                    print("Motion detected")
-                    motion_detected = True
+            frame, timestamp = item
+
+            if camera.motion_detection_active:
+                # Detect motion by analyzing the current frame, getting the boxes of the valid moving regions
+                # (not too small/big and outside the exclusion zones)
+                with FRAME_STAGE_SECONDS.time(camera=camera_id, stage="motion"):
+                    motion_boxes = motion_detector.detect_motion(frame)
+                motion_detected = len(motion_boxes) > 0
+
+                if motion_detected:
+                    MOTION_FRAMES.inc(camera=camera_id)
+                    logger.info("Motion detected camera=%s", camera_id, extra=RATE_LIMITED)
 
-                    # Draw a rectangle around the detected motion
-                    MotionDetector.draw_rectangle(frame, contour, (0, 255, 0), 2)
-                    
                     # Reset the counter whenever motion is detected
                     no_motion_frame_count = 0
 
                     if not recording:
-                        print("Recording started")
+                        start = time.perf_counter()
+                        RECORDINGS.inc(camera=camera_id)
                         recording = True
 
-                        # Initialize the video recording for both regular and masked videos
-                        video_handler.initialize_recording(frame)
-                        video_handler_masked.initialize_recording(frame, f"{temp_folder_path}/masked_video.mp4")
-                        
-            if recording:
-                # Write the current frame to the video file
-                video_handler.write_frame(frame)
-
-                # Count the number of frames while recording
-                frame_count += 1
-                
-                if not motion_detected:
-                    no_motion_frame_count += 1
-                else:
-                    # Apply the motion mask to the frame and write to the masked video file
-                    masked_frame = motion_detector.apply_mask(frame, contour)
-                    video_handler_masked.write_frame(masked_frame)
-
-                    # Track the frame where motion is detected
-                    motion_detected_frames.append(frame_count)
-
-                    # Reset the no-motion counter when motion is detected
-                    no_motion_frame_count = 0
+                        # Initialize the video recording, plus the masked video when objects are detected on it
+                        fps = camera.capture_worker.fps
+                        if passthrough:
+                            # Copy the packets from the keyframe before the pre-roll onwards into the clip
+                            camera.packet_source.start_recording(video_handler)
+                        else:
+                            video_handler.initialize_recording(frame, fps=fps)
+                        if not roi_mode:
+                            video_handler_masked.initialize_recording(frame, f"{temp_folder_path}/masked_{os.path.basename(video_handler.filename)}", fps)
+
+                        # Flush the frames from before the motion into the clip
+                        for pre_roll_timestamp, pre_roll_frame in camera.pre_roll_buffer.drain():
+                            if pre_roll_frame is not None and pre_roll_frame.shape == frame.shape:
+                                video_handler.write_frame(pre_roll_frame, pre_roll_timestamp)
+                                frame_count += 1
+
+                        # Collect the objects detected during this event, dropping a detection left over from the last one
+                        object_tracker.start_event(timestamp)
+                        pending_detection = None
+                        next_detection_frame = 0
+                        stationary_checks = 0
+                        event_detection = None
+
+                        FRAME_STAGE_SECONDS.observe(time.perf_counter() - start, camera=camera_id, stage="start_recording")
+                        logger.info("Recording started camera=%s clip=%s", camera_id, video_handler.filename)
+
+                if recording:
+                    # Count the number of frames while recording
+                    frame_count += 1
+
+                    if not motion_detected:
+                        no_motion_frame_count += 1
+                    else:
+                        if roi_mode:
+                            # Crop the motion regions from the frame in memory for object detection
+                            if region_sampler.offer():
+                                with FRAME_STAGE_SECONDS.time(camera=camera_id, stage="crop"):
+                                    region_sampler.add(frame_count, MotionDetector.crop_regions(frame, motion_boxes, config.roi_padding))
+                        else:
+                            # Apply the motion mask to the frame and write to the masked video file
+                            with FRAME_STAGE_SECONDS.time(camera=camera_id, stage="masked_write"):
+                                masked_frame = MotionDetector.apply_mask(frame, motion_boxes)
+                                video_handler_masked.write_frame(masked_frame, timestamp)
+                            masked_clip_frames.append(video_handler_masked.frames_placed - 1)
+
+                        # Track the frame where motion is detected
+                        motion_detected_frames.append(frame_count)
+
+                        # Reset the no-motion counter when motion is detected
+                        no_motion_frame_count = 0
+
+                    if tracking:
+                        # Pick up the finished detection without waiting for the model
+                        if pending_detection is not None and pending_detection[0].done():
+                            with FRAME_STAGE_SECONDS.time(camera=camera_id, stage="track"):
+                                tracks = track_objects(camera, *pending_detection)
+                            if tracks is not None and (event_detection is None or len(tracks) >= len(event_detection.detections)):
+                                event_detection = pending_detection[0].result()
+                            pending_detection = None
+
+                            if tracks and any(track.moved or track.hits == 1 for track in tracks):
+                                # An object just appeared or is moving, even if too slowly or too far for the motion detector, so keep recording
+                                no_motion_frame_count = 0
+                                stationary_checks = 0
+                            elif tracks and not any(object_tracker.is_new(track) for track in tracks):
+                                stationary_checks += 1
+                            else:
+                                stationary_checks = 0
+
+                        # Detect objects on a copy, as the frame is drawn on and its buffer slot reused
+                        if pending_detection is None and frame_count >= next_detection_frame:
+                            pending_detection = (camera.event_processor.inference_service.submit(frame.copy(), annotate=True), timestamp)
+                            next_detection_frame = frame_count + config.tracking_stride
+
+                    # Draw a rectangle around the detected motion
+                    for box in motion_boxes:
+                        MotionDetector.draw_rectangle(frame, box, (0, 255, 0), 2)
+
+                    # Keep a JPEG of the frame as drawn in the clip, so the preview never reopens the video
+                    if motion_detected and preview_sampler.offer():
+                        with FRAME_STAGE_SECONDS.time(camera=camera_id, stage="preview_encode"):
+                            preview_sampler.add(frame_count, cv2.imencode('.jpg', frame, preview_params)[1].tobytes())
+
+                    # Write the current frame to the video file, unless the clip is copied from the compressed stream
+                    if not passthrough:
+                        with FRAME_STAGE_SECONDS.time(camera=camera_id, stage="write"):
+                            video_handler.write_frame(frame, timestamp)
+
+                    # The length of a copied clip is measured on its own packets, the decoded frames can come at another rate
+                    if passthrough:
+                        clip_full = camera.packet_source.recorded_seconds >= video_handler.maximum_duration
+                    else:
+                        clip_full = frame_count >= video_handler.maximum_fps
+
+                    # Stop recording if no motion is detected for a certain number of frames, the video exceeds the maximum length,
+                    # or the detections keep finding only the objects that were already there
+                    if no_motion_frame_count >= no_motion_threshold or clip_full or 0 < config.tracking_end_after <= stationary_checks:
+                        logger.info("Recording stopped camera=%s frames=%d", camera_id, frame_count)
+                        recording = False
+                        with FRAME_STAGE_SECONDS.time(camera=camera_id, stage="finish_recording"):
+                            finish_recording(camera, motion_detected_frames, masked_clip_frames, region_sampler, preview_sampler, event_detection)
+
+                        # Clear the list for the next motion detection event
+                        motion_detected_frames.clear()
+                        masked_clip_frames.clear()
+
+                        # Reset the frame counter
+                        frame_count = 0
+
+                elif not passthrough:
+                    # Keep the most recent frames so the next clip starts before the motion
+                    with FRAME_STAGE_SECONDS.time(camera=camera_id, stage="pre_roll"):
+                        camera.pre_roll_buffer.add(frame, timestamp)
+
+            elif recording:
+                # Motion detection was switched off mid-event, so close the clip
+                recording = False
+                finish_recording(camera, motion_detected_frames, masked_clip_frames, region_sampler, preview_sampler, event_detection)
+                motion_detected_frames.clear()
+                masked_clip_frames.clear()
+                frame_count = 0
+
+            else:
+                # Stale frames are useless once motion detection resumes
+                camera.pre_roll_buffer.clear()
+
+            FRAMES_PROCESSED.inc(camera=camera_id)
+            yield frame
+    finally:
+        # Do not leave a half-written clip behind when the camera stops
+        if recording:
+            finish_recording(camera, motion_detected_frames, masked_clip_frames, region_sampler, preview_sampler, event_detection)
+
+        # Unregister the reader when the pipeline stops
+        frame_buffer.remove_reader(reader_id)
+
+def track_objects(camera, future, timestamp):
+    """
+    Feeds the result of a detection run during an event to the camera's tracker.
+
+    Args:
+        camera (Camera): The camera that is recording.
+        future (concurrent.futures.Future): The finished detection, resolving to an InferenceResult.
+        timestamp (float): The capture time of the frame the detection ran on.
+
+    Returns:
+        list: The tracks detected in the frame, or None if the detection failed.
+    """
+    error = future.exception()
+    if error is not None:
+        logger.warning("Object tracking failed camera=%s error=%s", camera.camera_id, error, extra=RATE_LIMITED)
+        return None
+
+    tracks = camera.object_tracker.update(future.result().detections, timestamp)
+    for track in tracks:
+        if track.hits == 1:
+            TRACKS_STARTED.inc(camera=camera.camera_id, class_name=track.class_name)
+    return tracks
+
+def finish_recording(camera, motion_detected_frames, masked_clip_frames, region_sampler, preview_sampler, event_detection):
+    """
+    Stops the camera's recordings and queues the finished clip for post-processing.
+
+    Args:
+        camera (Camera): The camera that was recording.
+        motion_detected_frames (list): Indices of the frames where motion was detected.
+        masked_clip_frames (list): Positions of the motion frames in the masked clip.
+        region_sampler (EventSampler): The crops of the motion regions taken during the event.
+        preview_sampler (EventSampler): The JPEGs of the motion frames taken during the event.
+        event_detection (InferenceResult): The annotated tracking detection run that found the most objects, or None without tracking.
+    """
+    # Stop the video recordings, leaving ffmpeg to finish the files on the event workers so the stream keeps flowing
+    if camera.packet_source is not None:
+        pending_clips = [camera.packet_source.stop_recording(wait=False)]
+    else:
+        pending_clips = [camera.video_handler.stop_recording(wait=False)]
+    masked_clip_path = None
+    if camera.video_handler_masked.is_recording():
+        pending_clips.append(camera.video_handler_masked.stop_recording(wait=False))
+        masked_clip_path = camera.video_handler_masked.filename
+
+    # Use the crops taken closest to the middle of the event
+    sample = region_sampler.middle()
+    regions = sample[1] if sample else None
+    region_sampler.clear()
+
+    sample = preview_sampler.middle()
+    preview_image = sample[1] if sample else None
+    preview_sampler.clear()
+
+    # The distinct objects followed during the event, empty when tracking is off
+    tracks = camera.object_tracker.finish_event()
 
-                # Stop recording if no motion is detected for a certain number of frames or the video exceeds the maximum length
-                if no_motion_frame_count >= no_motion_threshold or frame_count >= video_handler.maximum_fps:
-                    print("Stopped recording")
-                    recording = False
-
-                    # Stop the video recordings
-                    video_handler.stop_recording()
-                    video_handler_masked.stop_recording()
-                    
-                    # Save a preview image from the video and masked video
-                    video_handler.save_preview(motion_detected_frames)
-                    video_handler_masked.save_preview(motion_detected_frames, f"{temp_folder_path}/masked_preview.jpg")
-
-                    # Detect objects in the saved masked preview image and save the prediction results
-                    motion_detector.detect_objects(video_handler_masked.preview_path, f"{temp_folder_path}/prediction_image.jpg")
-
-                    # Add detected objects metadata to the video file
-                    video_handler.add_metadata_to_video(motion_detector.objects_detected)
-
-                    # Send an email alert with the motion detection results
-                    email_alert.send_motion_detected_email(
-                        motion_detector.objects_detected, 
-                        video_handler.start_time.strftime("%I:%M:%S %p %d %B %Y"), 
-                        video_handler.preview_path, 
-                        motion_detector.prediction_output_path
-                    )
-
-                    # Clear the both list for the next motion detection event
-                    motion_detector.objects_detected.clear()
-                    motion_detected_frames.clear()
-
-                    # Reset the frame counter
-                    frame_count = 0
-
-        # Encode the frame as JPEG to stream it to the client
-        _, buffer = cv2.imencode('.jpg', frame)
-        frame = buffer.tobytes()
-
-        # Yield the encoded frame in a format suitable for HTTP streaming
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-    
-    video_capture.release()
\ No newline at end of file
+    # Hand the finished clip to the event workers so the stream keeps flowing
+    camera.event_processor.submit(EventJob(
+        camera.camera_id,
+        camera.video_handler.filename,
+        masked_clip_path,
+        list(motion_detected_frames),
+        camera.video_handler.start_time,
+        datetime.now(),
+        regions,
+        preview_image,
+        tracks,
+        camera.object_tracker,
+        [clip for clip in pending_clips if clip is not None],
+        list(masked_clip_frames),
+        event_detection
+    ))
@@ -0,0 +1,233 @@
+import time
+import queue
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+import numpy as np
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+BATCH_SECONDS = Histogram("mysentry_inference_batch_seconds", "Time taken to run a batch through the model")
+BATCH_SIZE = Histogram("mysentry_inference_batch_size", "Number of images run through the model at once", buckets=(1, 2, 4, 8, 16, 32))
+
+# A single detected object, with the box given as (x1, y1, x2, y2) pixel coordinates
+Detection = namedtuple("Detection", ["class_name", "confidence", "box"])
+
+# The detections for one image, plus the image annotated with the boxes if it was requested
+InferenceResult = namedtuple("InferenceResult", ["detections", "annotated_image"])
+
+class InferenceRequest:
+    """
+    An image waiting to be run through the model.
+    """
+
+    def __init__(self, image, annotate):
+        """
+        Initializes the request.
+
+        Args:
+            image (numpy.ndarray): The frame or crop to run the model on.
+            annotate (bool): Whether to draw the detections on a copy of the image.
+        """
+        self.image = image
+        self.annotate = annotate
+        self.future = Future()
+
+class InferenceService:
+    """
+    A shared YOLO model that micro-batches the requests from all cameras and events.
+    """
+
+    def __init__(self, model_path="yolov8n.pt", max_batch=8, max_wait=0.02, warmup=True):
+        """
+        Starts the batching thread, which loads the model in the background so startup is not held up.
+        Requests submitted while the model loads wait in the queue.
+
+        Args:
+            model_path (str): Path to the YOLO weights.
+            max_batch (int): Maximum number of images run through the model at once.
+            max_wait (float): How long to wait for more requests to fill a batch, in seconds.
+            warmup (bool): Whether to run one dummy inference after loading, so the first event does not pay for it.
+        """
+        self.model_path = model_path
+        self.model = None # The YOLO model, once loaded
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.warmup = warmup
+        self.requests = queue.Queue()
+
+        self.ready = threading.Event() # Set once the model is loaded and warmed up
+        self.load_error = None # The error raised while loading the model, if any
+        self.load_seconds = None # Time taken to load the model
+        self.warmup_seconds = None # Time taken by the dummy inference
+
+        self.lock = threading.Lock()
+        self.batches_run = 0 # Number of batches run through the model
+        self.images_processed = 0 # Number of images run through the model
+
+        # Load and run the model on its own thread
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def load_model(self):
+        """
+        Imports the model library, loads the weights and runs the warm-up inference.
+        """
+        # Imported here, as importing torch alone takes seconds
+        from ultralytics import YOLO
+
+        start = time.perf_counter()
+        self.model = YOLO(self.model_path)
+        self.load_seconds = time.perf_counter() - start
+
+        # The first inference initialises the backend and allocates memory, so get it out of the way now.
+        # The model is loaded either way, so a failure here only leaves the first request to pay for it
+        if self.warmup:
+            start = time.perf_counter()
+            try:
+                self.model.predict(np.zeros((640, 640, 3), dtype=np.uint8), verbose=False)
+                self.warmup_seconds = time.perf_counter() - start
+            except Exception as error:
+                logger.warning("Model warm-up failed path=%s error=%s", self.model_path, error)
+
+    def is_ready(self):
+        """
+        Checks whether the model is loaded and warmed up.
+
+        Returns:
+            bool: True if requests are served straight away, False while the model is loading or if it failed to load.
+        """
+        return self.ready.is_set()
+
+    def submit(self, image, annotate=False):
+        """
+        Queues an in-memory image for object detection.
+
+        Args:
+            image (numpy.ndarray): The BGR frame or crop to run the model on.
+            annotate (bool): Whether to draw the detections on a copy of the image.
+
+        Returns:
+            concurrent.futures.Future: Resolves to an InferenceResult.
+        """
+        request = InferenceRequest(image, annotate)
+        self.requests.put(request)
+        return request.future
+
+    def detect(self, image, annotate=False, timeout=None):
+        """
+        Runs object detection on an in-memory image and waits for the result.
+
+        Args:
+            image (numpy.ndarray): The BGR frame or crop to run the model on.
+            annotate (bool): Whether to draw the detections on a copy of the image.
+            timeout (float, optional): Maximum time to wait in seconds.
+
+        Returns:
+            InferenceResult: The detections and, if requested, the annotated image.
+        """
+        return self.submit(image, annotate).result(timeout)
+
+    def detect_batch(self, images, annotate=False, timeout=None):
+        """
+        Runs object detection on several in-memory images and waits for all the results.
+
+        Args:
+            images (list): The BGR frames or crops to run the model on.
+            annotate (bool): Whether to draw the detections on copies of the images.
+            timeout (float, optional): Maximum time to wait in seconds.
+
+        Returns:
+            list: An InferenceResult per image, in the same order.
+        """
+        futures = [self.submit(image, annotate) for image in images]
+        return [future.result(timeout) for future in futures]
+
+    def run(self):
+        """
+        Loads the model, then collects requests into batches and runs them through the model.
+        """
+        try:
+            self.load_model()
+            self.ready.set()
+        except Exception as error:
+            self.load_error = error
+            logger.error("Failed to load the model path=%s error=%s", self.model_path, error)
+
+        while True:
+            # Wait for the first request, then give the others a short time to join the batch
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        """
+        Runs a batch of requests through the model and resolves their futures.
+
+        Args:
+            batch (list): The InferenceRequests to run.
+        """
+        if self.load_error is not None:
+            for request in batch:
+                request.future.set_exception(self.load_error)
+            return
+
+        start = time.perf_counter()
+        try:
+            results = self.model.predict([request.image for request in batch], verbose=False)
+        except Exception as error:
+            for request in batch:
+                request.future.set_exception(error)
+            return
+
+        # Convert the model output into structured detections
+        for request, result in zip(batch, results):
+            detections = []
+            for box in result.boxes:
+                class_id = int(box.cls[0])
+                detections.append(Detection(
+                    str(self.model.names[class_id]),
+                    float(box.conf[0]),
+                    tuple(float(value) for value in box.xyxy[0].tolist())
+                ))
+
+            annotated_image = result.plot() if request.annotate else None
+            request.future.set_result(InferenceResult(detections, annotated_image))
+
+        BATCH_SECONDS.observe(time.perf_counter() - start)
+        BATCH_SIZE.observe(len(batch))
+
+        with self.lock:
+            self.batches_run += 1
+            self.images_processed += len(batch)
+
+    def stats(self):
+        """
+        Returns the batching counters.
+
+        Returns:
+            dict: The model state, batches run, images processed, the average batch size and the queue depth.
+        """
+        with self.lock:
+            return {
+                "ready": self.is_ready(),
+                "load_error": str(self.load_error) if self.load_error else None,
+                "load_seconds": self.load_seconds,
+                "warmup_seconds": self.warmup_seconds,
+                "queue_depth": self.requests.qsize(),
+                "batches_run": self.batches_run,
+                "images_processed": self.images_processed,
+                "average_batch_size": self.images_processed / self.batches_run if self.batches_run else 0.0,
+            }
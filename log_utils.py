@@ -0,0 +1,79 @@
+import time
+import logging
+import threading
+from metrics import Counter
+
+# Passed as extra= to log calls that may fire on every frame, so repeats are throttled
+RATE_LIMITED = {"rate_limited": True}
+
+MESSAGES_SUPPRESSED = Counter("mysentry_log_messages_suppressed_total", "Log messages dropped by the rate limit")
+
+class RateLimitFilter(logging.Filter):
+    """
+    A logging filter that lets a rate-limited message through at most once per interval and reports how many repeats it dropped.
+    """
+
+    def __init__(self, interval=10.0):
+        """
+        Initializes the filter with no messages seen.
+
+        Args:
+            interval (float): Minimum seconds between two records of the same message.
+        """
+        super().__init__()
+        self.interval = interval
+        self.last_emitted = {} # (logger name, message, arguments) -> time the message was last let through
+        self.suppressed = {} # (logger name, message, arguments) -> repeats dropped since then
+        self.last_pruned = time.monotonic() # Time the messages no longer repeating were last forgotten
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        """
+        Decides whether a record is emitted.
+
+        Args:
+            record (logging.LogRecord): The record being logged.
+
+        Returns:
+            bool: True to emit the record, False to drop it.
+        """
+        if not getattr(record, "rate_limited", False):
+            return True
+
+        # Repeats are recognised by the message and its arguments, so e.g. each camera is throttled and counted on its own
+        key = (record.name, record.msg, repr(record.args))
+        now = time.monotonic()
+        with self.lock:
+            # Forget the messages that stopped repeating, as arguments such as error texts keep making new ones
+            if now - self.last_pruned >= self.interval:
+                self.last_pruned = now
+                self.last_emitted = {seen: emitted for seen, emitted in self.last_emitted.items()
+                                     if now - emitted < self.interval or seen in self.suppressed}
+
+            last_emitted = self.last_emitted.get(key)
+            if last_emitted is not None and now - last_emitted < self.interval:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                MESSAGES_SUPPRESSED.inc()
+                return False
+
+            self.last_emitted[key] = now
+            suppressed = self.suppressed.pop(key, 0)
+
+        if suppressed:
+            record.msg = f"{record.msg} suppressed={suppressed}"
+        return True
+
+def configure_logging(level="INFO", rate_limit_interval=10.0):
+    """
+    Sends the log records to stderr as timestamped key=value lines, throttling the rate-limited messages.
+
+    Args:
+        level (str): The minimum level logged, e.g. "INFO" or "DEBUG".
+        rate_limit_interval (float): Minimum seconds between two records of the same rate-limited message.
+    """
+    logging.basicConfig(level=level, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    # Filter on the handlers, so the records of every module's logger are covered
+    for handler in logging.getLogger().handlers:
+        if not any(isinstance(existing, RateLimitFilter) for existing in handler.filters):
+            handler.addFilter(RateLimitFilter(rate_limit_interval))
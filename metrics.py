@@ -0,0 +1,351 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from the sub-millisecond frame stages to the seconds taken by the post-event stages
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Registry:
+    """
+    The collection of metrics exposed by the process, rendered in the Prometheus text format or as a dict.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty registry.
+        """
+        self.metrics = {} # Metric name -> metric
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Adds a metric to the registry.
+
+        Args:
+            metric (Metric): The metric to add.
+
+        Raises:
+            ValueError: If a metric with the same name is already registered.
+        """
+        with self.lock:
+            if metric.name in self.metrics:
+                raise ValueError(f"Metric already registered: {metric.name}")
+            self.metrics[metric.name] = metric
+
+    def render(self):
+        """
+        Renders every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics, one sample per line.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        Returns the current value of every metric.
+
+        Returns:
+            dict: Metric name -> value, or label set -> value for labelled metrics.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+# The registry the metrics are added to unless another one is given
+REGISTRY = Registry()
+
+class Metric:
+    """
+    A named metric, optionally split by labels, whose values are either recorded as they happen or read from a function when collected.
+    """
+    type_name = "untyped"
+
+    def __init__(self, name, help_text, label_names=(), function=None, registry=REGISTRY):
+        """
+        Initializes the metric and adds it to the registry.
+
+        Args:
+            name (str): The metric name, e.g. "mysentry_frames_processed_total".
+            help_text (str): One line describing the metric.
+            label_names (tuple): The names of the labels the metric is split by.
+            function (callable, optional): Called when the metric is collected, returning the value,
+                or a dict of label values tuple -> value for labelled metrics.
+            registry (Registry): The registry the metric is added to.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.function = function
+        self.values = {} # Label values tuple -> value
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def label_values(self, labels):
+        """
+        Orders the label values as the label names.
+
+        Args:
+            labels (dict): Label name -> value.
+
+        Returns:
+            tuple: The label values as strings.
+        """
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def collect(self):
+        """
+        Reads the current values.
+
+        Returns:
+            dict: Label values tuple -> value.
+        """
+        if self.function is not None:
+            values = self.function()
+            return values if isinstance(values, dict) else {(): values}
+
+        with self.lock:
+            return dict(self.values)
+
+    def samples(self):
+        """
+        Lists the samples of the metric for the exposition format.
+
+        Returns:
+            list: (name suffix, labels dict, value) tuples.
+        """
+        return [("", dict(zip(self.label_names, key)), value) for key, value in sorted(self.collect().items()) if value is not None]
+
+    def snapshot(self):
+        """
+        Returns the current values for the JSON status.
+
+        Returns:
+            The value of an unlabelled metric, or a dict of "name=value,..." -> value.
+        """
+        values = self.collect()
+        if not self.label_names:
+            return values.get((), 0)
+        return {format_key(self.label_names, key): value for key, value in sorted(values.items())}
+
+class Counter(Metric):
+    """
+    A value that only goes up, such as the number of frames processed.
+    """
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        """
+        Increases the counter.
+
+        Args:
+            amount (float): How much to add.
+            **labels: The label values of the series to increase.
+        """
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, such as a queue depth.
+    """
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        """
+        Sets the gauge.
+
+        Args:
+            value (float): The new value.
+            **labels: The label values of the series to set.
+        """
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    """
+    A distribution of observed values, such as the latency of a pipeline stage, counted into fixed buckets.
+    """
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        """
+        Initializes the histogram and adds it to the registry.
+
+        Args:
+            name (str): The metric name, e.g. "mysentry_frame_stage_seconds".
+            help_text (str): One line describing the metric.
+            label_names (tuple): The names of the labels the metric is split by.
+            buckets (tuple): The upper bounds of the buckets, in increasing order.
+            registry (Registry): The registry the metric is added to.
+        """
+        super().__init__(name, help_text, label_names, registry=registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """
+        Records an observation.
+
+        Args:
+            value (float): The observed value.
+            **labels: The label values of the series to record it in.
+        """
+        key = self.label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), the count and the sum
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Records how long the body of a with statement takes, in seconds.
+
+        Args:
+            **labels: The label values of the series to record it in.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self):
+        """
+        Reads the current values.
+
+        Returns:
+            dict: Label values tuple -> (bucket counts, count, sum).
+        """
+        with self.lock:
+            return {key: (list(counts), count, total) for key, (counts, count, total) in self.values.items()}
+
+    def samples(self):
+        """
+        Lists the cumulative buckets, the sum and the count of each series.
+
+        Returns:
+            list: (name suffix, labels dict, value) tuples.
+        """
+        samples = []
+        for key, (counts, count, total) in sorted(self.collect().items()):
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", {**labels, "le": format_value(bound)}, cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return samples
+
+    def percentile(self, counts, count, fraction):
+        """
+        Estimates a percentile from the bucket counts, interpolating within the bucket it falls in.
+
+        Args:
+            counts (list): The per-bucket counts of a series.
+            count (int): The number of observations.
+            fraction (float): The percentile as a fraction, e.g. 0.99.
+
+        Returns:
+            float: The estimated value, or None without observations.
+        """
+        if not count:
+            return None
+
+        rank = fraction * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index == len(self.buckets):
+                    # Beyond the last bucket, the best estimate is its bound
+                    return lower
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+    def snapshot(self):
+        """
+        Summarises each series for the JSON status.
+
+        Returns:
+            dict: "name=value,..." -> count, average and estimated 50th and 99th percentiles.
+        """
+        summaries = {}
+        for key, (counts, count, total) in sorted(self.collect().items()):
+            summaries[format_key(self.label_names, key)] = {
+                "count": count,
+                "average": total / count if count else None,
+                "p50": self.percentile(counts, count, 0.5),
+                "p99": self.percentile(counts, count, 0.99),
+            }
+        return summaries
+
+def format_labels(labels):
+    """
+    Formats labels for the exposition format, escaping the values.
+
+    Args:
+        labels (dict): Label name -> value.
+
+    Returns:
+        str: The labels in braces, or an empty string without labels.
+    """
+    if not labels:
+        return ""
+
+    # Backslashes, quotes and newlines in the values must be escaped
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+def format_value(value):
+    """
+    Formats a sample value for the exposition format.
+
+    Args:
+        value (float): The value.
+
+    Returns:
+        str: The value, with infinities written as +Inf and -Inf.
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if value == float("-inf"):
+        return "-Inf"
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def format_key(label_names, key):
+    """
+    Formats a series' label values as a readable key for the JSON status.
+
+    Args:
+        label_names (tuple): The label names.
+        key (tuple): The label values.
+
+    Returns:
+        str: The labels as "name=value,...".
+    """
+    return ",".join(f"{name}={value}" for name, value in zip(label_names, key))
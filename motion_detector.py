@@ -1,181 +1,420 @@
 import cv2
+import math
 import numpy as np
-import config
-from ultralytics import YOLO
+from utilities import merge_boxes
 
 class MotionDetector:
     """
-    A class to handle motion detection and object recognition in video frames.
+    A class to handle motion detection in video frames.
     """
 
-    def __init__(self):
+    def __init__(self, analysis_width=None, grayscale=False, stride=1, min_area_ratio=0.05, max_area_ratio=0.9, adaptive=False,
+                 idle_after=60, idle_stride=5, idle_width=80, idle_threshold=0.005, idle_pixel_threshold=25, idle_background_stride=30):
         """
-        Initializes the motion detector with a YOLO model and a background subtractor.
+        Initializes the motion detector with a background subtractor.
+
+        Args:
+            analysis_width (int, optional): Width the frames are downscaled to before analysis. Defaults to full resolution.
+            grayscale (bool): Whether to analyse the frames in grayscale instead of BGR.
+            stride (int): Analyse every stride-th frame and reuse the last result in between.
+            min_area_ratio (float): Minimum area of a moving region relative to the frame.
+            max_area_ratio (float): Maximum area of a moving region relative to the frame.
+            adaptive (bool): Whether to idle while the scene is still, only checking frames with cheap frame differencing.
+            idle_after (int): Frames in a row without motion before the detector goes idle.
+            idle_stride (int): While idle, check every idle_stride-th frame.
+            idle_width (int): Width the frames are downscaled to for the idle check.
+            idle_threshold (float): Fraction of the pixels that must change between two idle checks to wake the detector.
+            idle_pixel_threshold (int): Difference in brightness (0-255) for a pixel to count as changed.
+            idle_background_stride (int): While idle, update the background model every idle_background_stride-th frame so it stays current.
         """
-        # Load the YOLO model for object detection
-        self.model = YOLO("yolov8n.pt")
+        self.analysis_width = analysis_width
+        self.grayscale = grayscale
+        self.stride = max(1, stride)
+        self.min_area_ratio = min_area_ratio
+        self.max_area_ratio = max_area_ratio
+
+        self.adaptive = adaptive
+        self.idle_after = idle_after
+        self.idle_stride = max(1, idle_stride)
+        self.idle_width = idle_width
+        self.idle_threshold = idle_threshold
+        self.idle_pixel_threshold = idle_pixel_threshold
+        self.idle_background_stride = max(1, idle_background_stride)
 
         # Create a background subtractor for motion detection
         self.background_subtractor = cv2.createBackgroundSubtractorMOG2(history=1000, varThreshold=24, detectShadows=False)
 
-        self.prediction_output_path = None 
-        self.objects_detected = []  
-    
-    def detect_motion(self, frame):
+        self.frame_size = None # Full-resolution (width, height) the detector was prepared for
+        self.analysis_size = None # (width, height) the frames are analysed at
+        self.scale = None # Factors mapping (x, y, width, height) boxes back to full resolution
+        self.kernel = None # Structuring element for the morphological operations, built once per frame size
+        self.frame_index = 0 # Number of frames seen, used for the stride
+        self.last_boxes = np.empty((0, 4), dtype=np.int32) # Motion boxes of the last analysed frame, reused on skipped frames
+
+        # Idle state of the adaptive mode
+        self.active = True # Whether every frame gets the full analysis, the adaptive mode starts active so the background model is learnt
+        self.idle_size = None # (width, height) of the frames compared while idle
+        self.reference = None # The previous frame checked while idle, at idle resolution
+        self.no_motion_frames = 0 # Frames in a row without motion while active
+        self.idle_frames = 0 # Frames handled by the idle check
+        self.analysed_frames = 0 # Frames given the full analysis
+        self.wakeups = 0 # Times the idle check woke the detector
+
+        # Exclusion zones drawn on this camera's video feed, compiled into a mask at analysis resolution
+        self.exclusion_zones = [] # Zones as received, rectangles or polygons
+        self.exclusion_zones_size = None # (width, height) of the canvas the zones were drawn on
+        self.exclusion_mask = None # 0 inside the zones and 255 elsewhere, or None without zones
+        self.idle_exclusion_mask = None # The exclusion mask at idle resolution
+        self.exclusion_mask_stale = False # Set when the zones change and the mask must be rebuilt
+
+    def set_exclusion_zones(self, zones, canvas_size=None):
         """
-        Detects motion in a given video frame by applying background subtraction.
+        Sets the exclusion zones. The mask is rebuilt once, on the next analysed frame.
 
         Args:
-            frame (numpy.ndarray): The current video frame.
+            zones (list): Rectangles as {"startX", "startY", "endX", "endY"} or polygons as {"points": [[x, y], ...]}.
+            canvas_size (tuple, optional): (width, height) of the canvas the zones were drawn on. Defaults to the frame size.
 
-        Returns:
-            contours (list): A list of contours representing the areas with detected motion.
+        Raises:
+            ValueError: If a zone or the canvas size is malformed, or a zone covers no area.
         """
-        # Apply the background subtractor to get the foreground mask
-        fg_mask = self.background_subtractor.apply(frame)
+        self.validate_exclusion_zones(zones, canvas_size)
+        self.exclusion_zones = zones or []
+        self.exclusion_zones_size = canvas_size
+        self.exclusion_mask_stale = True
 
-        # Apply thresholding to convert the mask to a binary image
-        _, thresh = cv2.threshold(fg_mask, 0, 255, cv2.THRESH_BINARY)
+    @staticmethod
+    def validate_exclusion_zones(zones, canvas_size=None):
+        """
+        Checks the exclusion zones before they are used, so a bad zone is refused rather than breaking the detection of every frame.
 
-        # Create a structuring element for morphological operations
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (10, 10))
+        Args:
+            zones (list): Rectangles as {"startX", "startY", "endX", "endY"} or polygons as {"points": [[x, y], ...]}.
+            canvas_size (tuple, optional): (width, height) of the canvas the zones were drawn on.
 
-        # Apply morphological operations to clean up the mask
-        fg_mask = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
-        fg_mask = cv2.morphologyEx(fg_mask, cv2.MORPH_CLOSE, kernel)
+        Raises:
+            ValueError: If a zone or the canvas size is malformed, or a zone covers no area.
+        """
+        def is_number(value):
+            return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+        if canvas_size is not None and not all(is_number(value) and value > 0 for value in canvas_size):
+            raise ValueError("The canvas width and height must be positive numbers")
+        if zones is None:
+            return
+        if not isinstance(zones, list):
+            raise ValueError("The zones must be a list")
+
+        for index, zone in enumerate(zones):
+            if not isinstance(zone, dict):
+                raise ValueError(f"Zone {index} must be an object")
+
+            if 'points' in zone:
+                points = zone['points']
+                if not isinstance(points, list) or len(points) < 3:
+                    raise ValueError(f"Zone {index} must have at least 3 points")
+                if not all(isinstance(point, (list, tuple)) and len(point) == 2 and all(is_number(value) for value in point) for point in points):
+                    raise ValueError(f"Zone {index} points must be [x, y] pairs of numbers")
+                # Shoelace formula, a polygon with all its points in a line covers nothing
+                area = sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1])) / 2
+                if area == 0:
+                    raise ValueError(f"Zone {index} covers no area")
+            else:
+                keys = ('startX', 'startY', 'endX', 'endY')
+                if not all(is_number(zone.get(key)) for key in keys):
+                    raise ValueError(f"Zone {index} must have numeric startX, startY, endX and endY")
+                if zone['startX'] == zone['endX'] or zone['startY'] == zone['endY']:
+                    raise ValueError(f"Zone {index} has no width or height")
+
+    def compile_exclusion_mask(self):
+        """
+        Rasterises the exclusion zones into a binary mask at analysis resolution.
+        """
+        self.exclusion_mask_stale = False
 
-        # Find contours in the mask, representing moving objects
-        contours, _ = cv2.findContours(fg_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if not self.exclusion_zones:
+            self.exclusion_mask = None
+            return
 
-        return contours
-    
-    def is_valid_contour(self, frame, contour):
+        # Scale the zones from the canvas they were drawn on to the analysis resolution
+        analysis_width, analysis_height = self.analysis_size
+        zones_width, zones_height = self.exclusion_zones_size or self.frame_size
+        scale = np.array([analysis_width / zones_width, analysis_height / zones_height], dtype=np.float32)
+
+        mask = np.full((analysis_height, analysis_width), 255, dtype=np.uint8)
+        for zone in self.exclusion_zones:
+            if 'points' in zone:
+                points = np.array(zone['points'], dtype=np.float32)
+            else:
+                points = np.array([[zone['startX'], zone['startY']], [zone['endX'], zone['startY']],
+                                   [zone['endX'], zone['endY']], [zone['startX'], zone['endY']]], dtype=np.float32)
+
+            # Fill the zone with zeros so motion inside it is removed from the foreground mask
+            cv2.fillPoly(mask, [np.round(points * scale).astype(np.int32)], 0)
+
+        self.exclusion_mask = mask
+        self.idle_exclusion_mask = cv2.resize(mask, self.idle_size, interpolation=cv2.INTER_NEAREST)
+
+    def prepare(self, frame):
+        """
+        Computes the analysis size and the structuring element for the frame size.
+        This runs once, or again if the camera resolution changes.
+
+        Args:
+            frame (numpy.ndarray): The current video frame.
+        """
+        frame_height, frame_width = frame.shape[:2]
+        self.frame_size = (frame_width, frame_height)
+
+        # Downscale only, keeping the aspect ratio
+        if self.analysis_width and self.analysis_width < frame_width:
+            analysis_height = max(1, round(frame_height * self.analysis_width / frame_width))
+            self.analysis_size = (self.analysis_width, analysis_height)
+        else:
+            self.analysis_size = self.frame_size
+        scale_x, scale_y = frame_width / self.analysis_size[0], frame_height / self.analysis_size[1]
+        self.scale = np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32)
+
+        # Scale the 10x10 kernel used at full resolution to the analysis resolution
+        kernel_size = max(3, round(10 * self.analysis_size[0] / frame_width))
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (kernel_size, kernel_size))
+
+        # The background model is tied to the analysis size, so start a new one
+        self.background_subtractor = cv2.createBackgroundSubtractorMOG2(history=1000, varThreshold=24, detectShadows=False)
+
+        # The exclusion mask is tied to the analysis size as well
+        self.exclusion_mask_stale = True
+
+        # The idle check compares tiny grayscale frames, so it costs a fraction of the full analysis
+        idle_width = min(self.idle_width, self.analysis_size[0])
+        self.idle_size = (idle_width, max(1, round(frame_height * idle_width / frame_width)))
+        self.reference = None
+
+        # Learn the new background from consecutive frames before idling
+        self.active = True
+        self.no_motion_frames = 0
+
+    def prepare_analysis_frame(self, frame):
         """
-        Checks if a contour is valid based on area bounds and exclusion zones.
+        Downscales and converts a frame to the analysis resolution and colour mode.
 
         Args:
             frame (numpy.ndarray): The current video frame.
-            contour (list): The contour to validate.
 
         Returns:
-            bool: True if the contour is valid, False otherwise.
+            numpy.ndarray: The frame to analyse.
         """
-        # Check if the contour is within the specified area bounds and not in an exclusion zone
-        is_within_area_bounds = self.is_within_area_bounds(frame, contour, 0.05, 0.9)
-        is_in_exclusion_zone = self.is_in_exclusion_zone(contour, config.exclusion_zones)
-        return is_within_area_bounds and not is_in_exclusion_zone
-    
-    def is_within_area_bounds(self, frame, contour, min_ratio, max_ratio):
+        if self.analysis_size != self.frame_size:
+            frame = cv2.resize(frame, self.analysis_size, interpolation=cv2.INTER_AREA)
+        if self.grayscale:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return frame
+
+    def detect_motion(self, frame):
         """
-        Checks if a contour's area is within the given bounds relative to the frame size.
+        Detects motion in a given video frame by applying background subtraction.
 
         Args:
             frame (numpy.ndarray): The current video frame.
-            contour (list): The contour to check.
-            min_ratio (float): Minimum area ratio relative to the frame.
-            max_ratio (float): Maximum area ratio relative to the frame.
 
         Returns:
-            bool: True if the contour's area is within the bounds, False otherwise.
+            numpy.ndarray: An (N, 4) array of (x, y, width, height) boxes around the valid moving regions, in full-resolution coordinates.
         """
-        # Calculate the area of the contour
-        object_area = cv2.contourArea(contour)
+        # Prepare the analysis size and kernel on the first frame or when the resolution changes
+        if self.frame_size != (frame.shape[1], frame.shape[0]):
+            self.prepare(frame)
 
-        # Calculate the area of the frame
-        frame_height, frame_width = frame.shape[:2]
-        frame_area = frame_width * frame_height
+        self.frame_index += 1
 
-        # Determine the minimum and maximum allowable areas for a valid contour
-        min_area = frame_area * min_ratio
-        max_area = frame_area * max_ratio
+        # While idle, only look for a change that is worth the full analysis
+        if not self.active:
+            if not self.check_idle(frame):
+                return self.last_boxes
 
-        # Check if the contour's area is within the specified bounds
-        return min_area < object_area < max_area
-    
-    def is_in_exclusion_zone(self, contour, exclusion_zones):
+            # Analyse the frame that woke the detector straight away
+            self.active = True
+            self.no_motion_frames = 0
+            self.wakeups += 1
+            self.frame_index = 1
+
+        # Reuse the last result on the frames skipped by the stride
+        if (self.frame_index - 1) % self.stride != 0:
+            return self.count_motion(self.last_boxes)
+        self.analysed_frames += 1
+
+        # Apply the background subtractor to the downscaled frame to get the foreground mask
+        fg_mask = self.background_subtractor.apply(self.prepare_analysis_frame(frame))
+
+        # Apply thresholding to convert the mask to a binary image
+        _, thresh = cv2.threshold(fg_mask, 0, 255, cv2.THRESH_BINARY)
+
+        # Apply morphological operations to clean up the mask
+        fg_mask = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, self.kernel)
+        fg_mask = cv2.morphologyEx(fg_mask, cv2.MORPH_CLOSE, self.kernel)
+
+        # Remove the motion inside the exclusion zones, at a constant cost however many zones there are
+        if self.exclusion_mask_stale:
+            self.compile_exclusion_mask()
+        if self.exclusion_mask is not None:
+            cv2.bitwise_and(fg_mask, self.exclusion_mask, dst=fg_mask)
+
+        # Label the moving regions, getting every bounding box and area in a single call
+        _, _, stats, _ = cv2.connectedComponentsWithStats(fg_mask, connectivity=8)
+
+        self.last_boxes = self.filter_regions(stats)
+        return self.count_motion(self.last_boxes)
+
+    def check_idle(self, frame):
         """
-        Checks if a contour is located within any exclusion zones.
+        Compares a downscaled frame with the one checked before it, keeping the background model current at a low rate.
 
         Args:
-            contour (list): The contour to check.
-            exclusion_zones (list): A list of exclusion zones defined by rectangles.
+            frame (numpy.ndarray): The current video frame.
 
         Returns:
-            bool: True if the contour is in an exclusion zone, False otherwise.
-        """
-        # Get the bounding rectangle of the contour
-        x, y, _, _ = cv2.boundingRect(contour)
-
-        # Check if the contour's bounding box intersects any exclusion zone
-        for zone in exclusion_zones:
-            zone_start_x = min(zone['startX'], zone['endX'])
-            zone_end_x = max(zone['startX'], zone['endX'])
-            zone_start_y = min(zone['startY'], zone['endY'])
-            zone_end_y = max(zone['startY'], zone['endY'])
-            if (zone_start_x <= x <= zone_end_x and zone_start_y <= y <= zone_end_y):
-                return True
-        return False
-    
-    def detect_objects(self, frame, prediction_output_path):
+            bool: True if enough of the frame changed to wake the detector, False otherwise.
+        """
+        self.idle_frames += 1
+        if (self.frame_index - 1) % self.idle_stride != 0:
+            return False
+
+        # Let the background model learn the slow changes of the scene (e.g., daylight), so it does not see them as motion on waking.
+        # Each update stands in for the frames skipped since the last one, so the model adapts at the same pace as when active
+        if (self.frame_index - 1) % self.idle_background_stride == 0:
+            learning_rate = min(1.0, self.idle_background_stride / self.background_subtractor.getHistory())
+            self.background_subtractor.apply(self.prepare_analysis_frame(frame), learningRate=learning_rate)
+
+        small = cv2.cvtColor(cv2.resize(frame, self.idle_size, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        reference, self.reference = self.reference, small
+        if reference is None:
+            return False
+
+        # Count the pixels that changed outside the exclusion zones
+        _, changed = cv2.threshold(cv2.absdiff(small, reference), self.idle_pixel_threshold, 255, cv2.THRESH_BINARY)
+        if self.exclusion_mask_stale:
+            self.compile_exclusion_mask()
+        if self.exclusion_mask is not None:
+            cv2.bitwise_and(changed, self.idle_exclusion_mask, dst=changed)
+        return cv2.countNonZero(changed) >= self.idle_threshold * changed.size
+
+    def count_motion(self, boxes):
         """
-        Detects objects in the given frame using the YOLO model and saves the prediction.
+        Tracks how long the scene has been still, sending the adaptive detector back to idle once it has been for idle_after frames.
 
         Args:
-            frame (numpy.ndarray): The current video frame.
-            prediction_output_path (str): The file path to save the prediction image.
+            boxes (numpy.ndarray): The motion boxes of the current frame.
+
+        Returns:
+            numpy.ndarray: The same boxes.
         """
-        self.prediction_output_path = prediction_output_path
+        if not self.adaptive:
+            return boxes
+
+        if len(boxes) > 0:
+            self.no_motion_frames = 0
+        else:
+            self.no_motion_frames += 1
+            if self.no_motion_frames >= self.idle_after:
+                self.active = False
+                self.reference = None
+        return boxes
+
+    def stats(self):
+        """
+        Returns the detector's state and counters.
 
-        # Predict objects in the frame using the YOLO model
-        results = self.model.predict(frame)
+        Returns:
+            dict: Whether the detector is active, and how many frames were checked while idle or fully analysed.
+        """
+        return {
+            "adaptive": self.adaptive,
+            "active": self.active,
+            "idle_frames": self.idle_frames,
+            "analysed_frames": self.analysed_frames,
+            "wakeups": self.wakeups,
+        }
+
+    def filter_regions(self, stats):
+        """
+        Keeps the moving regions whose area is within the bounds, using array operations instead of a per-region loop.
 
-        # Extract detected objects and save the prediction image
-        for result in results:
-            for box in result.boxes:
-                class_id = int(box.data[0][-1])
-                self.objects_detected.append(str(self.model.names[class_id]))
-            result.save(filename= prediction_output_path)
+        Args:
+            stats (numpy.ndarray): The region statistics from cv2.connectedComponentsWithStats, at analysis resolution.
 
-    def apply_mask(self, frame, contour):
+        Returns:
+            numpy.ndarray: An (N, 4) array of (x, y, width, height) boxes in full-resolution coordinates.
+        """
+        # Skip label 0, which is the background
+        areas = stats[1:, cv2.CC_STAT_AREA]
+        boxes = stats[1:, :4]
+
+        # Keep the regions that are not too small or too big relative to the frame
+        analysis_area = self.analysis_size[0] * self.analysis_size[1]
+        is_valid = (areas > analysis_area * self.min_area_ratio) & (areas < analysis_area * self.max_area_ratio)
+        boxes = boxes[is_valid]
+
+        # Map the boxes back to full-resolution coordinates for drawing, masking and recording
+        if self.analysis_size != self.frame_size:
+            boxes = np.round(boxes * self.scale)
+        return boxes.astype(np.int32)
+
+    @staticmethod
+    def apply_mask(frame, boxes):
         """
-        Applies a mask to the frame, keeping only the area inside the contour visible.
+        Applies a mask to the frame, keeping only the areas inside the motion boxes visible.
 
         Args:
             frame (numpy.ndarray): The current video frame.
-            contour (list): The contour to apply the mask to.
+            boxes (numpy.ndarray): The (x, y, width, height) motion boxes of the frame.
 
         Returns:
             masked_frame (numpy.ndarray): The masked video frame.
         """
-        # Get the bounding rectangle of the contour
-        x, y, w, h = cv2.boundingRect(contour)
-
         # Create a blank mask with the same dimensions as the frame
         frame_height, frame_width = frame.shape[:2]
         mask = np.zeros((frame_height, frame_width), dtype=np.uint8)
-        
-        if self.is_valid_contour(frame, contour):
-            # Draw a filled rectangle on the mask at the contour's location
-            cv2.rectangle(mask, (x, y), (x + w, y + h), (255, 255, 255), -1)
 
-        # Apply the mask to the frame, keeping only the area inside the contour visible
+        # Draw a filled rectangle on the mask at each box's location
+        for x, y, w, h in boxes:
+            cv2.rectangle(mask, (int(x), int(y)), (int(x + w), int(y + h)), 255, -1)
+
+        # Apply the mask to the frame, keeping only the areas inside the boxes visible
         masked_frame = cv2.bitwise_and(frame, frame, mask=mask)
 
         return masked_frame
     
     @staticmethod
-    def draw_rectangle(frame, contour, rgb_color, thickness):
+    def crop_regions(frame, boxes, padding):
+        """
+        Crops the regions around the given motion boxes straight from the frame.
+
+        Args:
+            frame (numpy.ndarray): The current video frame.
+            boxes (numpy.ndarray): The (x, y, width, height) motion boxes of the frame.
+            padding (float): Padding added around each box, as a fraction of its size.
+
+        Returns:
+            list: (x, y, crop) tuples with the top-left corner of each crop in the frame.
+        """
+        # Merge the padded bounding boxes so overlapping motion is cropped once
+        frame_height, frame_width = frame.shape[:2]
+        regions = merge_boxes(boxes.tolist(), padding, frame_width, frame_height)
+
+        # Copy the crops so they stay intact once the frame is drawn on and reused
+        return [(x1, y1, frame[y1:y2, x1:x2].copy()) for x1, y1, x2, y2 in regions]
+
+    @staticmethod
+    def draw_rectangle(frame, box, rgb_color, thickness):
         """
-        Draws a rectangle around the contour on the frame.
+        Draws a motion box on the frame.
 
         Args:
             frame (numpy.ndarray): The current video frame.
-            contour (list): The contour to draw the rectangle around.
+            box (tuple): The (x, y, width, height) box to draw.
             rgb_color (tuple): The color of the rectangle in RGB format.
             thickness (int): The thickness of the rectangle's border.
         """
-        # Get the bounding rectangle of the contour
-        x, y, w, h = cv2.boundingRect(contour)
+        x, y, w, h = (int(value) for value in box)
 
         # Draw the rectangle on the frame with the specified color and thickness
         cv2.rectangle(frame, (x, y), (x + w, y + h), rgb_color, thickness)
\ No newline at end of file
@@ -0,0 +1,291 @@
+import threading
+from collections import Counter
+
+class Track:
+    """
+    An object followed across the detections of a camera.
+    """
+
+    def __init__(self, track_id, detection, timestamp):
+        """
+        Initializes the track from its first detection.
+
+        Args:
+            track_id (int): The identifier of the track, unique within the camera.
+            detection (Detection): The detection that started the track.
+            timestamp (float): The capture time of the frame the object was detected in.
+        """
+        self.track_id = track_id
+        self.class_name = detection.class_name
+        self.box = detection.box # Last known (x1, y1, x2, y2) box
+        self.confidence = detection.confidence # Highest confidence the object was detected with
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+        self.hits = 1 # Detections matched to the track
+        self.misses = 0 # Detection runs in a row that did not find the object
+        self.moved = False # Whether the object moved between its last two detections
+        self.alerted = False # Whether an alert already reported the object
+        self.carried = False # Whether the track was carried over from an earlier event and not matched since
+
+    @property
+    def dwell_seconds(self):
+        """
+        Returns how long the object has been in view.
+
+        Returns:
+            float: Seconds between the first and the last detection of the object.
+        """
+        return self.last_seen - self.first_seen
+
+    def update(self, detection, timestamp, movement_threshold):
+        """
+        Moves the track to a newly matched detection.
+
+        Args:
+            detection (Detection): The matched detection.
+            timestamp (float): The capture time of the frame the object was detected in.
+            movement_threshold (float): Centroid shift, relative to the box diagonal, above which the object counts as moving.
+        """
+        self.moved = centroid_distance(self.box, detection.box) > movement_threshold * box_diagonal(self.box)
+        self.box = detection.box
+        self.confidence = max(self.confidence, detection.confidence)
+        self.last_seen = timestamp
+        self.hits += 1
+        self.misses = 0
+        self.carried = False
+
+    def summary(self, event_start):
+        """
+        Describes the track for the event metadata.
+
+        Args:
+            event_start (float): The capture time of the first frame of the event.
+
+        Returns:
+            dict: The track id, class, first and last detection times, dwell time, best confidence,
+                whether the object was already there before the event and whether an earlier alert reported it.
+        """
+        return {
+            "track_id": self.track_id,
+            "class_name": self.class_name,
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "dwell_seconds": round(self.dwell_seconds, 1),
+            "confidence": round(self.confidence, 4),
+            "known": self.first_seen < event_start,
+            "alerted": self.alerted,
+        }
+
+class ObjectTracker:
+    """
+    A lightweight multi-object tracker that matches the detections of a camera to the objects already seen, by box overlap or centroid distance.
+    Objects still in view and stationary when an event ends (e.g., a parked car) are carried into the next event, where they only match
+    a detection that overlaps their last box, so they keep their identity without being confused with a newcomer nearby.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_distance=1.0, movement_threshold=0.1, max_misses=10, max_age=600.0):
+        """
+        Initializes the tracker with no tracks.
+
+        Args:
+            iou_threshold (float): Minimum overlap (intersection over union) for a detection to continue a track.
+            max_distance (float): Maximum centroid distance, relative to the track's box diagonal, for a detection that does not
+                overlap enough to still continue the track.
+            movement_threshold (float): Centroid shift, relative to the box diagonal, above which an object counts as moving.
+            max_misses (int): Detection runs in a row without the object before its track is dropped.
+            max_age (float): Seconds without a detection before a track is dropped, also between events for the tracks carried over.
+        """
+        self.iou_threshold = iou_threshold
+        self.max_distance = max_distance
+        self.movement_threshold = movement_threshold
+        self.max_misses = max_misses
+        self.max_age = max_age
+
+        self.tracks = [] # Live tracks, oldest first
+        self.next_track_id = 1
+        self.event_start = None # Capture time of the first frame of the current event, or None between events
+        self.event_track_ids = set() # Ids of the tracks detected during the current event
+
+        self.lock = threading.Lock()
+        self.updates = 0 # Detection runs processed
+        self.tracks_started = 0 # Tracks created since the tracker started
+
+    def start_event(self, timestamp):
+        """
+        Starts collecting the tracks detected during a new event.
+
+        Args:
+            timestamp (float): The capture time of the first frame of the event.
+        """
+        with self.lock:
+            self.event_start = timestamp
+            self.event_track_ids = set()
+
+    def update(self, detections, timestamp):
+        """
+        Matches the detections of a frame to the tracks, starting new tracks for the objects not seen before.
+
+        Args:
+            detections (list): The Detection tuples found in the frame.
+            timestamp (float): The capture time of the frame.
+
+        Returns:
+            list: The tracks detected in the frame, including the new ones.
+        """
+        with self.lock:
+            self.updates += 1
+
+            # Forget the objects that left, or were not seen for too long
+            self.tracks = [track for track in self.tracks if track.misses < self.max_misses and timestamp - track.last_seen <= self.max_age]
+
+            # Score every pairing of a track and a detection of the same class, preferring overlap over centroid distance
+            pairs = []
+            for track_index, track in enumerate(self.tracks):
+                diagonal = box_diagonal(track.box)
+                for detection_index, detection in enumerate(detections):
+                    if detection.class_name != track.class_name:
+                        continue
+                    overlap = iou(track.box, detection.box)
+                    if overlap >= self.iou_threshold:
+                        pairs.append((0, -overlap, track_index, detection_index))
+                        continue
+                    # Nothing is detected between events, so a track carried over may only continue where it was left
+                    if track.carried:
+                        continue
+                    distance = centroid_distance(track.box, detection.box)
+                    if distance <= self.max_distance * diagonal:
+                        pairs.append((1, distance, track_index, detection_index))
+
+            # Greedily take the best pairs, each track and detection at most once
+            matched_tracks, matched_detections = set(), set()
+            for _, _, track_index, detection_index in sorted(pairs):
+                if track_index in matched_tracks or detection_index in matched_detections:
+                    continue
+                matched_tracks.add(track_index)
+                matched_detections.add(detection_index)
+                self.tracks[track_index].update(detections[detection_index], timestamp, self.movement_threshold)
+
+            for track_index, track in enumerate(self.tracks):
+                if track_index not in matched_tracks:
+                    track.misses += 1
+                    track.moved = False
+            visible = [self.tracks[track_index] for track_index in sorted(matched_tracks)]
+
+            # Every detection left over is an object not seen before
+            for detection_index, detection in enumerate(detections):
+                if detection_index not in matched_detections:
+                    track = Track(self.next_track_id, detection, timestamp)
+                    self.next_track_id += 1
+                    self.tracks_started += 1
+                    self.tracks.append(track)
+                    visible.append(track)
+
+            if self.event_start is not None:
+                self.event_track_ids.update(track.track_id for track in visible)
+            return visible
+
+    def finish_event(self):
+        """
+        Ends the current event, keeping only the objects that were in view and stationary at its last detection run.
+        The others may leave unseen before the next event, so their tracks are dropped.
+
+        Returns:
+            list: The summaries of the tracks detected during the event, oldest first. Their "alerted" flag tells
+                whether an earlier event already reported them.
+        """
+        with self.lock:
+            summaries = [track.summary(self.event_start) for track in self.tracks if track.track_id in self.event_track_ids]
+
+            self.tracks = [track for track in self.tracks if track.misses == 0 and not track.moved]
+            for track in self.tracks:
+                track.carried = True
+
+            self.event_start = None
+            self.event_track_ids = set()
+            return summaries
+
+    def mark_alerted(self, track_ids):
+        """
+        Records that an alert reported the objects, once the alert was accepted.
+
+        Args:
+            track_ids (list): The ids of the tracks reported.
+        """
+        track_ids = set(track_ids)
+        with self.lock:
+            for track in self.tracks:
+                if track.track_id in track_ids:
+                    track.alerted = True
+
+    def is_new(self, track):
+        """
+        Checks whether an object arrived during the current event, rather than being there before it started.
+
+        Args:
+            track (Track): The track.
+
+        Returns:
+            bool: True if the object was first detected during the current event.
+        """
+        return self.event_start is not None and track.first_seen >= self.event_start
+
+    def stats(self):
+        """
+        Returns the live tracks and the tracker counters.
+
+        Returns:
+            dict: Detection runs, tracks started and the number of distinct objects found by the last detection run per class.
+        """
+        with self.lock:
+            return {
+                "updates": self.updates,
+                "tracks_started": self.tracks_started,
+                "objects": dict(Counter(track.class_name for track in self.tracks if track.misses == 0)),
+            }
+
+def iou(box_a, box_b):
+    """
+    Computes the overlap of two boxes.
+
+    Args:
+        box_a (tuple): The first (x1, y1, x2, y2) box.
+        box_b (tuple): The second (x1, y1, x2, y2) box.
+
+    Returns:
+        float: The area of the intersection divided by the area of the union, between 0 and 1.
+    """
+    width = min(box_a[2], box_b[2]) - max(box_a[0], box_b[0])
+    height = min(box_a[3], box_b[3]) - max(box_a[1], box_b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+
+    intersection = width * height
+    union = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1]) + (box_b[2] - box_b[0]) * (box_b[3] - box_b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+def centroid_distance(box_a, box_b):
+    """
+    Computes the distance between the centres of two boxes.
+
+    Args:
+        box_a (tuple): The first (x1, y1, x2, y2) box.
+        box_b (tuple): The second (x1, y1, x2, y2) box.
+
+    Returns:
+        float: The distance in pixels.
+    """
+    dx = (box_a[0] + box_a[2] - box_b[0] - box_b[2]) / 2
+    dy = (box_a[1] + box_a[3] - box_b[1] - box_b[3]) / 2
+    return (dx * dx + dy * dy) ** 0.5
+
+def box_diagonal(box):
+    """
+    Computes the length of a box's diagonal, used to make distances relative to the object size.
+
+    Args:
+        box (tuple): The (x1, y1, x2, y2) box.
+
+    Returns:
+        float: The diagonal in pixels.
+    """
+    return ((box[2] - box[0]) ** 2 + (box[3] - box[1]) ** 2) ** 0.5
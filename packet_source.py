@@ -0,0 +1,335 @@
+import os
+import time
+import threading
+import subprocess
+from collections import deque
+
+START_CODE = b"\x00\x00\x01"
+
+class AccessUnitParser:
+    """
+    Splits an Annex B H.264 or H.265 elementary stream into access units (one per frame) and flags the keyframes.
+    """
+
+    def __init__(self, codec="h264"):
+        """
+        Initializes an empty parser.
+
+        Args:
+            codec (str): The codec of the stream, "h264" or "hevc".
+        """
+        self.codec = codec
+        self.buffer = bytearray() # Stream data not yet split into NAL units
+        self.searched = 0 # Offset in the buffer already searched for a start code
+        self.nal_units = [] # NAL units of the access unit being gathered
+        self.has_slices = False # Whether the access unit being gathered has picture data
+        self.keyframe = False # Whether the access unit being gathered is a keyframe
+
+    def feed(self, data):
+        """
+        Adds stream data and returns the access units it completes.
+
+        Args:
+            data (bytes): The next chunk of the stream.
+
+        Returns:
+            list: (data, keyframe) pairs, each access unit with 4-byte start codes.
+        """
+        self.buffer += data
+        access_units = []
+
+        start = self.buffer.find(START_CODE)
+        if start < 0:
+            # Keep the tail, it may hold the beginning of a start code
+            del self.buffer[:max(0, len(self.buffer) - 3)]
+            self.searched = 0
+            return access_units
+
+        # A NAL unit is complete once the start code of the next one arrives
+        while True:
+            end = self.buffer.find(START_CODE, max(start + 3, self.searched))
+            if end < 0:
+                break
+
+            # Leave the zero bytes before the next start code out of the NAL unit
+            nal_end = end
+            while nal_end > start + 3 and self.buffer[nal_end - 1] == 0:
+                nal_end -= 1
+
+            access_unit = self.add_nal_unit(bytes(self.buffer[start + 3:nal_end]))
+            if access_unit is not None:
+                access_units.append(access_unit)
+            start = end
+
+        # Drop the parsed data and remember how far the incomplete NAL unit has been searched
+        del self.buffer[:start]
+        self.searched = max(3, len(self.buffer) - 2)
+        return access_units
+
+    def add_nal_unit(self, nal_unit):
+        """
+        Adds a NAL unit to the access unit being gathered.
+
+        Args:
+            nal_unit (bytes): The NAL unit, without its start code.
+
+        Returns:
+            tuple: The (data, keyframe) of the previous access unit if this NAL unit starts a new one, None otherwise.
+        """
+        if len(nal_unit) < 3:
+            return None
+
+        if self.codec == "hevc":
+            nal_type = (nal_unit[0] >> 1) & 0x3F
+            is_slice = nal_type < 32
+            is_keyframe = 16 <= nal_type <= 21 # IRAP pictures
+            first_slice = is_slice and nal_unit[2] & 0x80 # first_slice_segment_in_pic_flag
+            starts_access_unit = nal_type in (32, 33, 34, 35, 39) or 41 <= nal_type <= 44 or 48 <= nal_type <= 55
+        else:
+            nal_type = nal_unit[0] & 0x1F
+            is_slice = 1 <= nal_type <= 5
+            is_keyframe = nal_type == 5 # IDR pictures
+            first_slice = is_slice and nal_unit[1] & 0x80 # first_mb_in_slice is 0
+            starts_access_unit = nal_type in (6, 7, 8, 9) or 14 <= nal_type <= 18
+
+        # Parameter sets, SEI and delimiters after a picture, or the first slice of a new picture, start a new access unit
+        access_unit = None
+        if self.has_slices and (starts_access_unit or first_slice):
+            access_unit = (b"".join(b"\x00" + START_CODE + unit for unit in self.nal_units), self.keyframe)
+            self.nal_units = []
+            self.has_slices = False
+            self.keyframe = False
+
+        self.nal_units.append(nal_unit)
+        self.has_slices = self.has_slices or is_slice
+        self.keyframe = self.keyframe or is_keyframe
+        return access_unit
+
+class PacketSource(threading.Thread):
+    """
+    A background thread that reads a camera's compressed video stream, so clips can be cut from it without decoding or re-encoding.
+    """
+
+    def __init__(self, record_url, codec="h264", pre_roll_seconds=3.0, max_bytes=32 * 1024 * 1024):
+        """
+        Prepares the ffmpeg command copying the camera's video stream and the reader thread, both started by start().
+
+        Args:
+            record_url (str): The URL of the camera stream to record, e.g. the main stream of an RTSP camera.
+            codec (str): The codec of the stream, "h264" or "hevc".
+            pre_roll_seconds (float): How many seconds of packets to keep from before the motion.
+            max_bytes (int): Memory budget for the pre-roll, the oldest groups of pictures are evicted beyond it.
+        """
+        super().__init__(daemon=True)
+        self.record_url = record_url
+        self.codec = codec
+        self.pre_roll_seconds = pre_roll_seconds
+        self.max_bytes = max_bytes
+        self.parser = AccessUnitParser(codec)
+
+        # FFmpeg command copying the first video stream to stdout as an Annex B elementary stream
+        cmd = ["ffmpeg", "-loglevel", "error"]
+        if str(record_url).startswith("rtsp://"):
+            cmd += ["-rtsp_transport", "tcp"] # Avoid losing packets over UDP
+        elif os.path.exists(str(record_url)):
+            cmd += ["-re"] # Read recorded files at their native rate, like a camera
+        cmd += [
+            "-i", str(record_url),
+            "-map", "0:v:0", # First video stream only
+            "-c", "copy", # Copy the packets without decoding them
+            "-bsf:v", f"{codec}_mp4toannexb,dump_extra=freq=keyframe", # Annex B, with the parameter sets before each keyframe so every clip can be decoded
+            "-f", codec, # As an elementary stream
+            "pipe:1"
+        ]
+        self.cmd = cmd
+        self.process = None # The ffmpeg process, once started
+
+        self.lock = threading.Lock()
+        self.gops = deque() # Groups of pictures in the pre-roll, each [keyframe timestamp, packets, bytes]
+        self.total_bytes = 0 # Size of the packets in the pre-roll
+        self.recorder = None # The recorder the packets are copied to while a clip is recorded
+        self.clip_start = None # Arrival time of the first packet copied into the clip
+        self.clip_end = None # Arrival time of the last packet copied into the clip
+        self.waiting_for_keyframe = False # Set when a clip starts without a keyframe in the pre-roll
+        self.packet_interval = None # Smoothed time between two packets
+        self.last_timestamp = None # Arrival time of the previous packet
+        self.packets_received = 0 # Access units read from the stream
+        self.keyframes_received = 0 # Keyframes read from the stream
+
+    @property
+    def fps(self):
+        """
+        Returns the frame rate of the stream.
+
+        Returns:
+            float: The measured frames per second, or None before two packets have arrived.
+        """
+        if not self.packet_interval:
+            return None
+        return 1.0 / self.packet_interval
+
+    def is_opened(self):
+        """
+        Checks whether ffmpeg is still reading the stream.
+
+        Returns:
+            bool: True if packets are being read, False otherwise.
+        """
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        """
+        Starts ffmpeg and the thread reading its output.
+
+        Raises:
+            OSError: If ffmpeg cannot be started, e.g. it is not installed.
+        """
+        self.process = subprocess.Popen(self.cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        super().start()
+
+    def run(self):
+        """
+        Reads the stream and splits it into access units until ffmpeg exits.
+        """
+        while True:
+            data = self.process.stdout.read1(65536)
+            if not data:
+                break
+
+            for packet, keyframe in self.parser.feed(data):
+                self.add_packet(time.time(), packet, keyframe)
+
+        self.stop_recording()
+
+    def add_packet(self, timestamp, packet, keyframe):
+        """
+        Copies a packet into the clip being recorded, or keeps it in the pre-roll.
+
+        Args:
+            timestamp (float): The arrival time of the packet in seconds.
+            packet (bytes): The access unit.
+            keyframe (bool): Whether the packet is a keyframe.
+        """
+        # Measure the frame rate of the stream, smoothing out the bursts of the network
+        if self.last_timestamp is not None:
+            interval = timestamp - self.last_timestamp
+            self.packet_interval = interval if self.packet_interval is None else 0.95 * self.packet_interval + 0.05 * interval
+        self.last_timestamp = timestamp
+
+        with self.lock:
+            self.packets_received += 1
+            self.keyframes_received += keyframe
+
+            if self.recorder is not None:
+                # A clip can only start on a keyframe
+                if self.waiting_for_keyframe and not keyframe:
+                    return
+                self.waiting_for_keyframe = False
+                self.recorder.write_packet(packet)
+                if self.clip_start is None:
+                    self.clip_start = timestamp
+                self.clip_end = timestamp
+                return
+
+            if keyframe:
+                self.gops.append([timestamp, [], 0])
+            elif not self.gops:
+                # Packets before the first keyframe cannot be decoded on their own
+                return
+
+            gop = self.gops[-1]
+            gop[1].append(packet)
+            gop[2] += len(packet)
+            self.total_bytes += len(packet)
+
+            # Keep the groups of pictures covering the pre-roll, so the pre-roll always starts on a keyframe
+            while len(self.gops) > 1 and self.gops[1][0] <= timestamp - self.pre_roll_seconds:
+                self.total_bytes -= self.gops.popleft()[2]
+
+            # Keep within the memory budget, even if that shortens the pre-roll
+            while len(self.gops) > 1 and self.total_bytes > self.max_bytes:
+                self.total_bytes -= self.gops.popleft()[2]
+
+    def start_recording(self, recorder):
+        """
+        Starts a clip from the keyframe at the beginning of the pre-roll, then copies the live packets into it.
+
+        Args:
+            recorder (FFmpegRecorder): The recorder the packets are written to.
+        """
+        with self.lock:
+            recorder.initialize_passthrough(self.codec, fps=self.fps)
+
+            # Flush the pre-roll into the clip
+            for _, packets, _ in self.gops:
+                for packet in packets:
+                    recorder.write_packet(packet)
+            self.clip_start = self.gops[0][0] if self.gops else None
+            self.clip_end = self.gops[-1][0] if self.gops else None
+            self.waiting_for_keyframe = not self.gops
+            self.gops.clear()
+            self.total_bytes = 0
+
+            self.recorder = recorder
+
+    @property
+    def recorded_seconds(self):
+        """
+        Returns the length of the clip being recorded, from the arrival times of its packets,
+        as the frames decoded from the camera URL may come at another rate than the recorded stream.
+
+        Returns:
+            float: The seconds of video copied into the clip, including the pre-roll, or 0 without a clip.
+        """
+        with self.lock:
+            if self.recorder is None or self.clip_start is None:
+                return 0.0
+            return self.clip_end - self.clip_start
+
+    def stop_recording(self, wait=True):
+        """
+        Stops copying packets into the clip.
+
+        Args:
+            wait (bool): Whether to wait for the recorder to finish the clip.
+
+        Returns:
+            PendingClip: The clip being finished, or None if no clip was being recorded.
+        """
+        with self.lock:
+            recorder = self.recorder
+            self.recorder = None
+
+        if recorder is not None:
+            return recorder.stop_recording(wait)
+        return None
+
+    def stop(self, timeout=2.0):
+        """
+        Stops ffmpeg and waits for the reader thread to exit.
+
+        Args:
+            timeout (float): Maximum time to wait for the thread in seconds.
+        """
+        if self.is_opened():
+            self.process.terminate()
+        if self.is_alive():
+            self.join(timeout)
+
+    def stats(self):
+        """
+        Returns the stream counters.
+
+        Returns:
+            dict: The packets and keyframes read, the measured frame rate and the size of the pre-roll.
+        """
+        with self.lock:
+            return {
+                "codec": self.codec,
+                "fps": self.fps,
+                "packets_received": self.packets_received,
+                "keyframes_received": self.keyframes_received,
+                "pre_roll_gops": len(self.gops),
+                "pre_roll_bytes": self.total_bytes,
+                "recording": self.recorder is not None,
+            }
@@ -0,0 +1,90 @@
+import threading
+from collections import deque
+import cv2
+import numpy as np
+
+class PreRollBuffer:
+    """
+    A memory-bounded buffer of the most recent frames, kept JPEG-encoded so clips can include the seconds before motion.
+    """
+
+    def __init__(self, seconds=3.0, max_bytes=8 * 1024 * 1024, jpeg_quality=85):
+        """
+        Initializes an empty pre-roll buffer.
+
+        Args:
+            seconds (float): How many seconds of frames to keep.
+            max_bytes (int): Memory budget for the encoded frames, the oldest frames are evicted beyond it.
+            jpeg_quality (int): JPEG quality of the stored frames (0-100).
+        """
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.encode_params = [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]
+        self.items = deque() # (timestamp, encoded frame) pairs, oldest first
+        self.total_bytes = 0 # Size of the encoded frames currently held
+        self.frames_evicted = 0 # Frames evicted because of the memory budget
+        self.lock = threading.Lock()
+
+    def add(self, frame, timestamp):
+        """
+        Encodes and stores a frame, evicting the frames that are too old or over the memory budget.
+
+        Args:
+            frame (numpy.ndarray): The frame to store.
+            timestamp (float): The capture time of the frame in seconds.
+        """
+        if self.seconds <= 0:
+            return
+
+        _, buffer = cv2.imencode('.jpg', frame, self.encode_params)
+        data = buffer.tobytes()
+
+        with self.lock:
+            self.items.append((timestamp, data))
+            self.total_bytes += len(data)
+
+            # Drop the frames older than the pre-roll window
+            while self.items and timestamp - self.items[0][0] > self.seconds:
+                self.total_bytes -= len(self.items.popleft()[1])
+
+            # Keep within the memory budget, even if that shortens the pre-roll
+            while self.total_bytes > self.max_bytes and len(self.items) > 1:
+                self.total_bytes -= len(self.items.popleft()[1])
+                self.frames_evicted += 1
+
+    def drain(self):
+        """
+        Empties the buffer and returns the stored frames, decoded, oldest first.
+
+        Returns:
+            list: (timestamp, frame) pairs.
+        """
+        with self.lock:
+            items = list(self.items)
+            self.items.clear()
+            self.total_bytes = 0
+
+        return [(timestamp, cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)) for timestamp, data in items]
+
+    def clear(self):
+        """
+        Empties the buffer.
+        """
+        with self.lock:
+            self.items.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """
+        Returns the buffer counters.
+
+        Returns:
+            dict: The number of frames held, their size and the frames evicted by the memory budget.
+        """
+        with self.lock:
+            return {
+                "frames": len(self.items),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "frames_evicted": self.frames_evicted,
+            }
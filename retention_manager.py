@@ -0,0 +1,168 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from clip_metadata import delete_clip_metadata
+
+logger = logging.getLogger(__name__)
+
+class RetentionManager:
+    """
+    A background thread that deletes old clips to keep the clips folder within its age and disk quotas.
+    """
+
+    def __init__(self, catalog, clips_folder, max_bytes=None, max_age_days=None, class_days=None, interval=300.0):
+        """
+        Initializes the quotas and starts the background thread.
+
+        Args:
+            catalog (ClipCatalog): The clip catalog, used to find the oldest clips without scanning the folder.
+            clips_folder (str): Path to the folder holding the clips.
+            max_bytes (int, optional): Maximum total size of the clips, the oldest clips are deleted beyond it.
+            max_age_days (float, optional): Days clips are kept, unless their object classes are kept longer or shorter.
+            class_days (dict, optional): Object class -> days clips with that class are kept, overriding max_age_days.
+            interval (float): Seconds between two retention runs.
+        """
+        self.catalog = catalog
+        self.clips_folder = clips_folder
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.class_days = class_days or {}
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.wake = threading.Event() # Set to run the retention before the interval is up
+        self.delete_all_requested = False # Set by delete_all() for the thread to pick up
+        self.clips_deleted = 0 # Clips deleted since startup
+        self.bytes_reclaimed = 0 # Size of the deleted clips
+        self.last_run = None # Time the last retention run finished
+        self.last_run_seconds = 0.0 # How long the last retention run took
+
+        # Start the background thread
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """
+        Applies the retention rules every interval, and deletes all the clips when requested.
+        """
+        while True:
+            start = time.perf_counter()
+            try:
+                if self.delete_all_requested:
+                    self.delete_all_requested = False
+                    self.delete_all_clips()
+                self.prune()
+            except Exception:
+                logger.exception("Failed to apply clip retention")
+
+            with self.lock:
+                self.last_run = datetime.now()
+                self.last_run_seconds = time.perf_counter() - start
+
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def retention_days(self, objects):
+        """
+        Works out how long a clip is kept, which is as long as the longest-kept object class detected in it.
+
+        Args:
+            objects (list): The object classes detected in the clip.
+
+        Returns:
+            float: The number of days the clip is kept, or None to keep it until the disk quota is reached.
+        """
+        days = [self.class_days.get(class_name, self.max_age_days) for class_name in objects] or [self.max_age_days]
+        if None in days:
+            return None
+        return max(days)
+
+    def prune(self):
+        """
+        Deletes the clips past their retention age, then the oldest clips until the total size is within the quota.
+        """
+        now = datetime.now()
+
+        # Only clips older than the shortest retention can be expired, so the catalog is asked for those alone
+        all_days = [days for days in [self.max_age_days, *self.class_days.values()] if days is not None]
+        if all_days:
+            before = (now - timedelta(days=min(all_days))).isoformat(timespec="seconds")
+            for clip in self.catalog.oldest_clips(before, limit=-1):
+                days = self.retention_days(clip["objects"])
+                if days is not None and datetime.fromisoformat(clip["start_time"]) < now - timedelta(days=days):
+                    self.delete_clip(clip["name"], clip["size"])
+
+        if self.max_bytes is None:
+            return
+
+        # Evict the oldest clips, whatever was detected in them, until the clips fit in the quota
+        total_size = self.catalog.total_size()
+        while total_size > self.max_bytes:
+            clips = self.catalog.oldest_clips(limit=100)
+            if not clips:
+                break
+
+            for clip in clips:
+                self.delete_clip(clip["name"], clip["size"])
+                total_size -= clip["size"]
+                if total_size <= self.max_bytes:
+                    break
+
+    def delete_clip(self, name, size):
+        """
+        Deletes a clip, its metadata and poster, and removes it from the catalog.
+
+        Args:
+            name (str): The clip filename.
+            size (int): The size of the clip in bytes, as catalogued.
+        """
+        clip_path = os.path.join(self.clips_folder, name)
+        if os.path.exists(clip_path):
+            os.remove(clip_path)
+        delete_clip_metadata(clip_path)
+        self.catalog.remove_clip(name)
+
+        with self.lock:
+            self.clips_deleted += 1
+            self.bytes_reclaimed += size
+
+    def delete_all(self):
+        """
+        Asks the background thread to delete all the clips, without waiting for it.
+        """
+        self.delete_all_requested = True
+        self.wake.set()
+
+    def delete_all_clips(self):
+        """
+        Deletes all the catalogued clips, oldest first.
+        """
+        while True:
+            clips = self.catalog.oldest_clips(limit=100)
+            if not clips:
+                break
+
+            for clip in clips:
+                self.delete_clip(clip["name"], clip["size"])
+
+    def stats(self):
+        """
+        Returns the retention counters.
+
+        Returns:
+            dict: The quotas, the size of the clips, and the clips deleted and bytes reclaimed since startup.
+        """
+        with self.lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "max_age_days": self.max_age_days,
+                "class_days": self.class_days,
+                "total_bytes": self.catalog.total_size(),
+                "clips_deleted": self.clips_deleted,
+                "bytes_reclaimed": self.bytes_reclaimed,
+                "last_run": self.last_run.isoformat(timespec="seconds") if self.last_run else None,
+                "last_run_seconds": self.last_run_seconds,
+                "delete_all_pending": self.delete_all_requested,
+            }
@@ -29,8 +29,8 @@ if (canvas) {
 	// Start drawing on mousedown event
 	canvas.addEventListener('mousedown', (e) => {
 		let pos = getMousePos(canvas, e);
-		startX = pos.x;
-		startY = pos.y;
+		startX = endX = pos.x;
+		startY = endY = pos.y;
 		drawing = true;
 	});
 
@@ -53,7 +53,12 @@ if (canvas) {
 
 	// Finish drawing on mouseup event
 	canvas.addEventListener('mouseup', () => {
+		if (!drawing) return;
 		drawing = false; // Stop drawing
+
+		// A click without a drag draws nothing, so there is no zone to save
+		if (Math.abs(endX - startX) < 1 || Math.abs(endY - startY) < 1) return;
+
 		// Save the drawn rectangle as an exclusion zone
 		exclusionZones.push({ startX, startY, endX, endY });
 
@@ -68,7 +73,8 @@ if (canvas) {
 			headers: {
 				'Content-Type': 'application/json'
 			},
-			body: JSON.stringify({ zones: exclusionZones })
+			// Include the canvas size so the server can scale the zones to the video resolution
+			body: JSON.stringify({ zones: exclusionZones, width: canvas.width, height: canvas.height })
 		});
 	});
 
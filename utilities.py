@@ -28,3 +28,68 @@ def format_object_detected(labels):
     # Format the count and label into a string for each unique label
     objects_detected = ", ".join([f"{count} {label}" for label, count in object_counter.items()])
     return objects_detected
+
+def merge_boxes(boxes, padding, frame_width, frame_height):
+    """
+    Pads bounding boxes and merges the ones that overlap, so each region of interest is cropped once.
+
+    Example:
+    - Input: [(10, 10, 20, 20), (25, 10, 20, 20)], padding 0.25, frame 100x100
+    - Output: [(5, 5, 50, 35)]
+
+    Args:
+    boxes (list of tuple): Bounding boxes as (x, y, width, height).
+    padding (float): Padding added on each side, as a fraction of the box size.
+    frame_width (int): Width of the frame, used to clip the boxes.
+    frame_height (int): Height of the frame, used to clip the boxes.
+
+    Returns:
+    list of tuple: The merged boxes as (x1, y1, x2, y2).
+    """
+    # Pad each box and clip it to the frame
+    regions = []
+    for x, y, w, h in boxes:
+        pad_x, pad_y = int(w * padding), int(h * padding)
+        regions.append([max(0, x - pad_x), max(0, y - pad_y), min(frame_width, x + w + pad_x), min(frame_height, y + h + pad_y)])
+
+    # Merge overlapping regions until none overlap
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                a, b = regions[i], regions[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    regions[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del regions[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    return [tuple(region) for region in regions]
+
+def parse_object_detected(comment):
+    """
+    Reverses format_object_detected, turning a formatted string back into a list of labels.
+
+    Example:
+    - Input: "2 person, 1 toilet"
+    - Output: ['person', 'person', 'toilet']
+
+    If the string is empty or "Unidentifiable object", it returns an empty list.
+
+    Args:
+    comment (str): A string produced by format_object_detected.
+
+    Returns:
+    list of str: The labels of the detected objects.
+    """
+    labels = []
+    for part in comment.split(","):
+        count, _, label = part.strip().partition(" ")
+
+        # Skip anything that is not "<count> <label>", such as "Unidentifiable object"
+        if count.isdigit() and label:
+            labels.extend([label] * int(count))
+    return labels
@@ -1,95 +1,113 @@
 import os
 import cv2
+import struct
 import subprocess
 from datetime import datetime
-from utilities import format_object_detected
-from config import temp_folder_path, clips_folder_path
+from config import clips_folder_path
 
 class VideoHandler:
     """
     A class to handle video recording, processing, and metadata management.
     """
 
-    def __init__(self):
+    def __init__(self, camera_id=None):
         """
         Initializes the VideoHandler with default settings.
+
+        Args:
+            camera_id (str, optional): The camera recorded by this handler, added to the clip filenames.
         """
+        self.camera_id = camera_id # Camera recorded by this handler
         self.fourcc = cv2.VideoWriter_fourcc(*"avc1") # Codec for encoding video
         self.fps = 24.0 # Frames per second for the output video
         self.video_writer = None # Video writer object
         self.start_time = None # Start time of the recording
         self.filename = None # File path for the output video
-        self.preview_path = None # Path for the preview image
         self.maximum_duration = 20 # Maximum duration for video recording in seconds
+        self.frames_placed = 0 # Number of frames placed on the clip's timeline
 
-    def initialize_recording(self, frame, filename=None):
+    def initialize_recording(self, frame, filename=None, fps=None):
         """
         Initializes video recording.
 
         Args:
             frame (numpy.ndarray): The first frame of the video, used to determine frame size.
             filename (str, optional): The name of the video file. Defaults to a timestamped filename.
+            fps (float, optional): The frame rate of the camera. Defaults to the last frame rate used.
+        """
+        self.start_clip(filename, fps)
+
+        # Initialize the VideoWriter object with the frame size, codec, and fps
+        self.video_writer = cv2.VideoWriter(self.filename, self.fourcc, self.fps, (frame.shape[1], frame.shape[0]))
+
+    def start_clip(self, filename=None, fps=None):
+        """
+        Records the start time, frame rate and filename of a new clip.
+
+        Args:
+            filename (str, optional): The name of the video file. Defaults to a timestamped filename.
+            fps (float, optional): The frame rate of the camera. Defaults to the last frame rate used.
         """
         self.start_time = datetime.now() # Record the start time of the video
+        self.frames_placed = 0
+        if fps:
+            self.fps = fps
 
-        # Generate a filename if not provided
+        # Generate a filename if not provided, suffixed with the camera so clips from different cameras never collide
         if filename is None:
-            self.filename = f"{clips_folder_path}/{self.start_time.strftime('%Y-%m-%d_%H-%M-%S')}.mp4"
+            timestamp = self.start_time.strftime('%Y-%m-%d_%H-%M-%S')
+            suffix = f"_{self.camera_id}" if self.camera_id is not None else ""
+            self.filename = f"{clips_folder_path}/{timestamp}{suffix}.mp4"
         else:
             self.filename = filename
 
-        # Initialize the VideoWriter object with the frame size, codec, and fps
-        self.video_writer = cv2.VideoWriter(self.filename, self.fourcc, self.fps, (frame.shape[1], frame.shape[0]))
-    
-    def write_frame(self, frame):
+    def write_frame(self, frame, timestamp=None):
         """
         Writes a single frame to the video file.
 
         Args:
             frame (numpy.ndarray): The frame to write to the video.
+            timestamp (float, optional): The capture time of the frame in seconds, unused by OpenCV which writes at a constant rate.
         """
         self.video_writer.write(frame)
+        self.frames_placed += 1
 
-    def stop_recording(self):
+    def is_recording(self):
         """
-        Stops the video recording and releases the VideoWriter object.
+        Checks whether a recording is in progress.
+
+        Returns:
+            bool: True if the VideoWriter is open, False otherwise.
         """
-        self.video_writer.release()
-    
-    def save_preview(self, total_frames, preview_path=None):
+        return self.video_writer is not None
+
+    def stop_recording(self, wait=True):
         """
-        Saves a preview image extracted from the middle of the video.
+        Stops the video recording and releases the VideoWriter object.
 
         Args:
-            total_frames (list): A list of frame indices for the video.
-            preview_path (str, optional): The path to save the preview image. Defaults to a temp folder.
+            wait (bool): Unused, OpenCV always finishes the clip before returning.
+
+        Returns:
+            None: The clip is already finished.
         """
-        # Calculate the middle frame index and extract the corresponding frame
-        index = len(total_frames) // 2
-        middle_frame_number = total_frames[index]
-        frame = self.get_frame_from_clip(middle_frame_number)
-        
-        # Generate the preview path if not provided
-        if preview_path is None:
-            self.preview_path = f"{temp_folder_path}/preview.jpg"
-        else:
-            self.preview_path = preview_path
-        
-        # Save the extracted frame as the preview image
-        cv2.imwrite(self.preview_path, frame)
+        self.video_writer.release()
+        self.video_writer = None
     
-    def get_frame_from_clip(self, frame_number):
+    @staticmethod
+    def get_frame_from_clip(filename, frame_number):
         """
-        Retrieves a specific frame from the video file.
+        Retrieves a specific frame from a video file.
 
         Args:
+            filename (str): Path to the video file.
             frame_number (int): The index of the frame to retrieve.
 
         Returns:
             numpy.ndarray: The requested frame.
         """
         # Open the video file and set the frame position
-        cap = cv2.VideoCapture(self.filename)
+        cap = cv2.VideoCapture(filename)
         cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
 
         # Read the frame from the video
@@ -98,36 +116,6 @@ class VideoHandler:
 
         return frame
     
-    def add_metadata_to_video(self, metadata):
-        """
-        Adds metadata (e.g., detected objects) to the video file.
-
-        Args:
-            metadata (list): List of detected objects to be added as metadata.
-        """
-        # Input and output must be different so temporary file is created
-        # Extract the filename and extension and create a temporary filename
-        filename = os.path.basename(self.filename)
-        temp_filename = f"{temp_folder_path}/temp_{filename}"
-
-        # Format the metadata comment using the utility function
-        comment = format_object_detected(metadata)
-
-        # FFmpeg command to add metadata to the video
-        cmd = [
-            "ffmpeg",
-            "-i", self.filename, # Input video file
-            "-metadata", f"comment={comment}", # Add metadata as a comment
-            "-codec", "copy", # Copy the original codec (no re-encoding)
-            temp_filename # Output to a temporary file
-        ]
-        
-        # Execute the command to add metadata
-        subprocess.run(cmd)
-
-        # Replace the original video with the new one containing metadata
-        os.replace(temp_filename, self.filename)
-        
     @property
     def maximum_fps(self):
         """
@@ -139,28 +127,111 @@ class VideoHandler:
         return self.fps * self.maximum_duration
     
     @staticmethod
-    def get_timestamp_from_filename(filename):
+    def parse_timestamp_from_filename(filename):
         """
-        Extracts and formats the timestamp from the video filename.
+        Extracts the recording start time from the video filename.
 
         Args:
             filename (str): The video filename.
 
         Returns:
-            str: Formatted timestamp (e.g., "12:34:56PM 15 August 2024").
+            datetime: The time the recording started.
         """
-        # Extract the filename and remove the extension to get the timestamp string
+        # Extract the filename and keep the leading timestamp, dropping the camera suffix and extension
         filename = os.path.basename(filename)
-        timestamp_str = filename.split('.')[0]  
+        timestamp_str = filename.split('.')[0][:19]
 
         # Parse the timestamp string into a datetime object
-        timestamp = datetime.strptime(timestamp_str, "%Y-%m-%d_%H-%M-%S")
+        return datetime.strptime(timestamp_str, "%Y-%m-%d_%H-%M-%S")
+
+    @staticmethod
+    def get_timestamp_from_filename(filename):
+        """
+        Extracts and formats the timestamp from the video filename.
+
+        Args:
+            filename (str): The video filename.
+
+        Returns:
+            str: Formatted timestamp (e.g., "12:34:56PM 15 August 2024").
+        """
+        timestamp = VideoHandler.parse_timestamp_from_filename(filename)
 
         # Format the datetime object into the string new format
         formatted_timestamp = timestamp.strftime("%I:%M:%S%p %d %B %Y")
         
         return formatted_timestamp
     
+    @staticmethod
+    def has_faststart(filename):
+        """
+        Checks whether the moov atom of an mp4 comes before its media data, so playback can start before the whole file is downloaded.
+
+        Args:
+            filename (str): Path to the video file.
+
+        Returns:
+            bool: True if the moov atom comes first, False otherwise.
+        """
+        with open(filename, "rb") as file:
+            # Walk the top-level atoms, reading only their headers
+            while True:
+                header = file.read(8)
+                if len(header) < 8:
+                    return False
+
+                size, atom_type = struct.unpack(">I4s", header)
+                if atom_type == b"moov":
+                    return True
+                if atom_type == b"mdat":
+                    return False
+
+                # Size 1 means a 64-bit size follows the header, size 0 means the atom runs to the end of the file
+                if size == 1:
+                    size = struct.unpack(">Q", file.read(8))[0] - 16
+                elif size == 0:
+                    return False
+                else:
+                    size -= 8
+                file.seek(size, os.SEEK_CUR)
+
+    @staticmethod
+    def apply_faststart(filename):
+        """
+        Moves the moov atom of an mp4 to the front of the file, without re-encoding the video.
+
+        Args:
+            filename (str): Path to the video file.
+
+        Returns:
+            bool: True if the file was rewritten, False if it already had the moov atom first.
+        """
+        if VideoHandler.has_faststart(filename):
+            return False
+
+        # FFmpeg command to copy the streams into a new file with the moov atom first.
+        # The file stays in the clip's folder so the rename is atomic, but without the .mp4 extension, so it is never taken for a clip
+        temp_filename = f"{filename}.faststart.tmp"
+        cmd = [
+            "ffmpeg",
+            "-y",
+            "-i", filename, # Input video file
+            "-c", "copy", # Copy the streams without re-encoding
+            "-movflags", "+faststart", # Write the moov atom at the front
+            "-f", "mp4", # As an mp4, which the extension no longer tells ffmpeg
+            temp_filename
+        ]
+
+        # Execute the command, then swap the new file in with a single rename
+        try:
+            subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+            os.replace(temp_filename, filename)
+        finally:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+
+        return True
+
     @staticmethod
     def get_video_metadata(file_path):
         """